@@ -0,0 +1,174 @@
+"""Provide benchmark fixtures to all test_*.py files.
+
+Each benchmark records the duration of a phase relative to a reference workload measured in the same run, so that
+results do not depend on the speed of the machine, and compares it to the baseline stored in baseline.json. A benchmark
+fails when it is slower than its baseline times the tolerance.
+
+Run with `uv run tox -e benchmark`, and refresh the baseline with `uv run tox -e benchmark -- --benchmark-save-baseline`.
+"""
+
+import json
+import os
+import pathlib
+import textwrap
+import time
+
+import pytest
+import yaml
+
+from unittest import mock
+
+import claranet_tfwrapper as tfwrapper
+
+BASELINE_FILE = pathlib.Path(__file__).parent / "baseline.json"
+
+TOOL_VERSION = "1.1.4"
+
+# parsed with the pure Python YAML loader as reference workload, it takes about 2ms
+REFERENCE_DOCUMENT = "\n".join("key{0}:\n  name: value{0}\n  items: [1, 2, 3]\n  enabled: true".format(i) for i in range(5))
+REFERENCE_ROUNDS = 11
+
+# slack in reference units so that phases much shorter than the reference do not fail on scheduler noise
+MIN_MARGIN = 0.5
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark-save-baseline",
+        action="store_true",
+        default=False,
+        help="Store measured durations as the new baseline instead of comparing against it.",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=float(os.environ.get("TFWRAPPER_BENCHMARK_TOLERANCE", 2.0)),
+        help="Fail when a phase is slower than its baseline multiplied by this factor (default: 2.0).",
+    )
+
+
+def measure_reference():
+    """Measure the reference workload, in seconds."""
+    durations = []
+    for _ in range(REFERENCE_ROUNDS):
+        start = time.perf_counter()
+        yaml.load(REFERENCE_DOCUMENT, Loader=yaml.SafeLoader)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+class Benchmark:
+    """Minimal offline benchmark runner with a pytest-benchmark like interface."""
+
+    def __init__(self, name, results, baseline, tolerance):
+        """Initialize the runner of a named phase."""
+        self.name = name
+        self.results = results
+        self.baseline = baseline
+        self.tolerance = tolerance
+
+    def __call__(self, target, *args, rounds=20, **kwargs):
+        """Run the target for some rounds and record its fastest duration."""
+        return self.pedantic(target, args=args, kwargs=kwargs, rounds=rounds)
+
+    def pedantic(self, target, args=(), kwargs=None, setup=None, rounds=20):
+        """Run the target for some rounds and record its fastest duration.
+
+        If given, setup is called before each round and returns the args and kwargs of the target.
+        """
+        durations = []
+        result = None
+        for _ in range(rounds):
+            if setup:
+                args, kwargs = setup()
+            start = time.perf_counter()
+            result = target(*args, **(kwargs or {}))
+            durations.append(time.perf_counter() - start)
+        # scheduler noise only makes rounds slower
+        self.record(min(durations))
+        return result
+
+    def record(self, duration):
+        """Record the duration of the phase in seconds, relative to the reference workload, and compare it to its baseline.
+
+        The reference is measured right after the phase, so that both are affected by the same CPU frequency and load.
+        """
+        reference = measure_reference()
+        self.results[self.name] = round(duration / reference, 3)
+        if self.baseline is None:
+            return
+        if self.name not in self.baseline:
+            pytest.skip("No baseline for {}, run with --benchmark-save-baseline".format(self.name))
+        limit = round(max(self.baseline[self.name] * self.tolerance, self.baseline[self.name] + MIN_MARGIN), 3)
+        assert self.results[self.name] <= limit, "{} regressed: {} > {} times the reference workload (baseline {})".format(
+            self.name, self.results[self.name], limit, self.baseline[self.name]
+        )
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request):
+    results = {}
+    yield results
+
+    if request.config.getoption("--benchmark-save-baseline") and results:
+        baseline = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+        baseline.update(results)
+        BASELINE_FILE.write_text(json.dumps(dict(sorted(baseline.items())), indent=2) + "\n")
+
+
+@pytest.fixture(scope="session")
+def benchmark_baseline(request):
+    if request.config.getoption("--benchmark-save-baseline"):
+        return None
+    return json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+
+
+@pytest.fixture
+def benchmark(request, benchmark_results, benchmark_baseline):
+    return Benchmark(request.node.name, benchmark_results, benchmark_baseline, request.config.getoption("--benchmark-tolerance"))
+
+
+@pytest.fixture
+def synthetic_project(tmp_path, monkeypatch):
+    """Provide an offline project with a single regional stack and a fake terraform binary."""
+    home = tmp_path / "home"
+    tool_dir = home / ".terraform.d" / "versions" / TOOL_VERSION.rsplit(".", 1)[0] / TOOL_VERSION
+    tool_dir.mkdir(parents=True)
+    tool = tool_dir / "terraform"
+    tool.write_text("#!/bin/sh\nexit 0\n")
+    tool.chmod(0o755)
+
+    # use path with more than 5 directories to avoid getting an unrelated conf dir outside tmp_path
+    rootdir = tmp_path / "a" / "b" / "c" / "d" / "e"
+    conf_dir = rootdir / "conf"
+    conf_dir.mkdir(parents=True)
+    (rootdir / ".run").mkdir()
+    (conf_dir / "config.yml").write_text("---\nalways_trigger_init: False\n")
+    (conf_dir / "state.yml").write_text("---\n")
+    (conf_dir / "testaccount_testenvironment_testregion_teststack.yml").write_text(
+        textwrap.dedent(
+            """
+            ---
+            terraform:
+              vars:
+                myvar: myvalue
+                version: "{}"
+            """.format(TOOL_VERSION)
+        )
+    )
+    stack_dir = rootdir / "testaccount" / "testenvironment" / "testregion" / "teststack"
+    stack_dir.mkdir(parents=True)
+    (stack_dir / "main.tf").write_text("# Empty terraform configuration\n")
+
+    tfwrapper.CachedRequestsSession.set_cache_dir(str(home / ".terraform.d" / "http-cache"))
+    monkeypatch.chdir(stack_dir)
+    # isolate the environment, tfwrapper exports credentials and terraform variables in it
+    with mock.patch.dict(os.environ, {"PATH": os.environ["PATH"], "HOME": str(home)}, clear=True):
+        yield {
+            "home": home,
+            "rootdir": rootdir,
+            "conf_dir": conf_dir,
+            "stack_dir": stack_dir,
+            "stack_conf": conf_dir / "testaccount_testenvironment_testregion_teststack.yml",
+        }
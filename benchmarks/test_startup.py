@@ -0,0 +1,147 @@
+"""Benchmark tfwrapper startup, phase by phase and end to end."""
+
+import os
+import pickle
+import re
+import subprocess
+import sys
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+
+from .conftest import TOOL_VERSION
+
+STACK_ARGS = ["-atestaccount", "-etestenvironment", "-rtestregion", "-steststack"]
+
+
+def base_wrapper_config():
+    wrapper_config = deepcopy(vars(tfwrapper.parse_args(STACK_ARGS + ["plan"])))
+    tfwrapper.detect_config_dir(wrapper_config)
+    return wrapper_config
+
+
+def clear_process_caches():
+    """Forget what previous rounds cached in this process, so that each round runs like a new tfwrapper process."""
+    tfwrapper.clear_caches()
+    tfwrapper._valid_stack_config_digests.clear()
+
+
+def test_phase_imports(benchmark):
+    durations = []
+    for _ in range(5):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import claranet_tfwrapper"],
+            stderr=subprocess.PIPE,
+            check=True,
+            encoding="utf-8",
+        )
+        m = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| claranet_tfwrapper$", process.stderr, re.MULTILINE)
+        durations.append(int(m.group(1)) / 1000000)
+    benchmark.record(min(durations))
+
+
+def test_phase_detect_config_dir(benchmark, synthetic_project):
+    benchmark.pedantic(
+        tfwrapper.detect_config_dir,
+        setup=lambda: ((deepcopy(vars(tfwrapper.parse_args(["plan"]))),), {}),
+    )
+
+
+def test_phase_load_wrapper_config(benchmark, synthetic_project):
+    def setup():
+        clear_process_caches()
+        return (base_wrapper_config(),), {}
+
+    benchmark.pedantic(tfwrapper.load_wrapper_config, setup=setup)
+
+
+def test_phase_load_stack_config_from_file(benchmark, synthetic_project):
+    def setup():
+        clear_process_caches()
+        return (str(synthetic_project["stack_conf"]),), {}
+
+    benchmark.pedantic(tfwrapper.load_stack_config_from_file, setup=setup)
+
+
+def test_phase_parse_args(benchmark, synthetic_project):
+    benchmark(tfwrapper.parse_args, STACK_ARGS + ["plan"])
+
+
+def test_phase_parse_args_help(benchmark, synthetic_project, capsys):
+    def parse_help():
+        with pytest.raises(SystemExit):
+            tfwrapper.parse_args([])
+
+    benchmark(parse_help)
+
+
+def test_phase_tool_resolution(benchmark, synthetic_project):
+    benchmark(tfwrapper.select_terraform_version, TOOL_VERSION)
+
+
+def test_phase_credentials_aws(benchmark, synthetic_project):
+    from botocore.credentials import ReadOnlyCredentials
+
+    wrapper_config = {"rootdir": str(synthetic_project["rootdir"])}
+    session_cache_file = "{}/.run/session_cache_{}_{}.pickle".format(wrapper_config["rootdir"], "123456789012", "benchmark")
+    with open(session_cache_file, "wb") as f:
+        pickle.dump(
+            {
+                "credentials": ReadOnlyCredentials("AKIAEXAMPLE", "secret", "token"),
+                "region": "eu-west-1",
+                "expiration_time": datetime.now(timezone.utc) + timedelta(hours=1),
+            },
+            f,
+        )
+
+    def setup():
+        clear_process_caches()
+        return (wrapper_config, "123456789012", "eu-west-1", "benchmark", "aws"), {}
+
+    benchmark.pedantic(tfwrapper.get_session, setup=setup)
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        ["apply", "--unsafe"],
+        ["bootstrap"],
+        ["console"],
+        ["destroy"],
+        ["fmt"],
+        ["force-unlock"],
+        ["foreach", "--", "true"],
+        ["get"],
+        ["graph"],
+        ["import"],
+        ["init"],
+        ["output"],
+        ["plan"],
+        ["providers"],
+        ["refresh"],
+        ["show"],
+        ["state"],
+        ["taint"],
+        ["untaint"],
+        ["validate"],
+        ["version"],
+        ["workspace"],
+    ],
+    ids=lambda command: command[0],
+)
+def test_main(benchmark, synthetic_project, command):
+    environ = dict(os.environ)
+
+    def run_main():
+        # main() exports variables in the environment, restore it between rounds
+        os.environ.clear()
+        os.environ.update(environ)
+        clear_process_caches()
+        with pytest.raises(SystemExit) as e:
+            tfwrapper.main(command)
+        assert e.value.code == 0
+
+    benchmark(run_main, rounds=5)
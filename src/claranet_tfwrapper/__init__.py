@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 """Python wrapper for Terraform."""
 
-import argcomplete
 import argparse
+import functools
+import hashlib
+import json
 import logging
 import os
 import pathlib
@@ -17,37 +19,48 @@ import subprocess
 import tempfile
 import textwrap
 import time
-import shlex
 import sys
 import zipfile
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
-from urllib3.util.retry import Retry
-
-import boto3
-import botocore
-import colorlog
-import jinja2
-import requests
-import yaml
-from cachecontrol import CacheControlAdapter
-from cachecontrol.heuristics import ExpiresAfter
-from cachecontrol.caches import FileCache
-from natsort import natsorted
-from schema import Schema, SchemaError, Optional, Or
-from semver import Version
+
 from termcolor import colored
 
-from . import azure
-from .utils import format_env, get_dict_value
+from . import azure, output, timings
+from .utils import (
+    clear_yaml_cache,
+    format_env,
+    get_dict_value,
+    get_files_signature,
+    load_pickle_file,
+    load_yaml_file,
+    save_pickle_file,
+    set_yaml_cache_dir,
+)
+
+# Heavy third party dependencies (boto3, jinja2, requests, cachecontrol, schema, natsort, semver, argcomplete...)
+# are imported on the code paths which need them to keep tfwrapper startup fast.
+
+
+def __getattr__(name):
+    """Resolve lazily computed module attributes."""
+    if name == "__version__":
+        return get_version()
+    if name == "stack_configuration_schema":
+        return get_stack_configuration_schema()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
-try:
-    import importlib.metadata as importlib_metadata
-except ModuleNotFoundError:
-    import importlib_metadata
+@functools.cache
+def get_version():
+    """Get tfwrapper version from the installed package metadata."""
+    try:
+        import importlib.metadata as importlib_metadata
+    except ModuleNotFoundError:
+        import importlib_metadata
 
-__version__ = importlib_metadata.version(__name__)
+    return importlib_metadata.version(__name__)
 
 
 def get_architecture():
@@ -76,7 +89,6 @@ TERRAFORM_PATCH_REGEX = r"[0-9]+(((-alpha|-beta|-rc)[0-9]+)|(?P<dev>-dev))?"
 TOOL_PROVIDER = "provider"
 TOOL_OPENTOFU = "tofu"  # FIXME: maybe set this to "opentofu", and only name the binary "tofu"
 TOOL_TERRAFORM = "terraform"
-TOOL_BIN_PATH = None
 
 ARCH_NAME = get_architecture()
 PLATFORM_SYSTEM = platform.system().lower()
@@ -89,39 +101,166 @@ TFWRAPPER_DEFAULT_CONFIG = {
 
 HOME_DIR = str(Path.home())
 DEFAULT_CONF_DIRNAME = "conf"
+COMPLETION_DATA_FILENAME = "completion.json"
+CONTEXT_CACHE_FILENAME = "context_cache.pickle"
+YAML_CACHE_DIRNAME = "yaml_cache"
+SCHEMA_CACHE_DIRNAME = "schema_cache"
+# limits of foreach commands, set by arguments and overridden in the foreach section of stack configurations:
+# timeout and inactivity timeout in seconds, memory limit in MiB, 0 for no limit
+FOREACH_LIMITS = ("timeout", "inactivity_timeout", "memory_limit")
+MODULE_INDEX_FILENAME = "module_index.pickle"
+STACK_INDEX_FILENAME = "stack_index.pickle"
+# bumped when the format of the stack index changes
+STACK_INDEX_VERSION = 5
+CONTEXT_CACHE_MAX_ENTRIES = 64
+# environment variables the resolved context depends on, by name and by prefix, which are part of the cache key
+CONTEXT_CACHE_ENV_VARS = ("HOME", "PATH")
+CONTEXT_CACHE_ENV_PREFIXES = ("AWS_", "ARM_", "AZURE_", "GOOGLE_", "TFWRAPPER_")
+# tools selected from a partial version constraint like "1.5" are resolved again after this delay, in seconds, as
+# releases listed by HTTP requests are cached for as long
+CONTEXT_CACHE_TOOL_TTL = 15 * 60
+# wrapper config keys set by resolve_context()
+CONTEXT_KEYS = ("account", "environment", "region", "stack", "config", "state", "default_state_backend_type")
 DEFAULT_HTTP_CACHE_DIR = "{}/.terraform.d/http-cache".format(
     HOME_DIR
 )  # FIXME: maybe move this to $XDG_CACHE_DIR/claranet-tfwrapper/http-cache
 
 # setup logging parameters
 LOG_FORMAT = "{log_color}{levelname: <7}{reset} {purple}tfwrapper{reset} : {bold}{message}{reset}"
-handler = colorlog.StreamHandler()
-handler.setFormatter(colorlog.ColoredFormatter(LOG_FORMAT, style="{"))
-logger = colorlog.getLogger()
-logger.addHandler(handler)
-
-stack_configuration_schema = Schema(
-    {
-        Optional("state_configuration_name"): str,
-        Optional("aws"): {"general": {"account": str, "region": str}, "credentials": {"profile": str}},
-        Optional("azure"): {
-            "general": {"mode": str, "subscription_id": str, "directory_id": str, Optional("credentials"): {"profile": str}},
-            Optional(str): {"mode": str, "subscription_id": str, "directory_id": str, Optional("credentials"): {"profile": str}},
-            Optional("credential"): {"profile": str},
-            Optional("credentials"): {"profile": str},
-        },
-        Optional("gcp"): {
-            "general": {"project": str, "mode": str},
-            Optional("gke"): [{Or("zone", "region"): str, "name": str, Optional("refresh_kubeconfig"): Or("always", "never")}],
-        },
-        "terraform": {
-            Optional("legacy"): bool,
-            Optional("version"): str,
-            "vars": {str: str},
-            Optional("custom-providers"): {str: Or(str, {"version": str, "extension": str})},
-        },
-    }
-)
+logger = logging.getLogger()
+handler = None
+
+
+def setup_logging():
+    """Attach the colored log handler to the root logger, once."""
+    global handler
+    if handler is None:
+        import colorlog
+
+        handler = colorlog.StreamHandler()
+        handler.setFormatter(colorlog.ColoredFormatter(LOG_FORMAT, style="{"))
+        logger.addHandler(handler)
+
+
+@functools.cache
+def get_stack_configuration_schema():
+    """Build the schema used to validate stack configurations."""
+    from schema import And, Schema, Optional, Or
+
+    azure_provider = {"mode": str, "subscription_id": str, "directory_id": str, Optional("credentials"): {"profile": str}}
+    gke_cluster = {Or("zone", "region"): str, "name": str, Optional("refresh_kubeconfig"): Or("always", "never")}
+    return Schema(
+        {
+            Optional("state_configuration_name"): str,
+            Optional("depends_on"): [str],
+            Optional("foreach"): {Optional(limit): And(int, lambda n: n >= 0) for limit in FOREACH_LIMITS},
+            Optional("aws"): {"general": {"account": str, "region": str}, "credentials": {"profile": str}},
+            Optional("azure"): {
+                "general": azure_provider,
+                Optional(str): azure_provider,
+                Optional("credential"): {"profile": str},
+                Optional("credentials"): {"profile": str},
+            },
+            Optional("gcp"): {
+                "general": {"project": str, "mode": str},
+                Optional("gke"): [gke_cluster],
+            },
+            "terraform": {
+                Optional("legacy"): bool,
+                Optional("version"): str,
+                "vars": {str: str},
+                Optional("custom-providers"): {str: Or(str, {"version": str, "extension": str})},
+            },
+        }
+    )
+
+
+def is_valid_stack_config(stack_config):
+    """Check a stack configuration against the stack configuration schema, without the schema library.
+
+    Mirrors get_stack_configuration_schema() but only tells whether the configuration is valid, the schema
+    library is still used to report errors. Dict schemas with a type key require at least one such key.
+    """
+
+    def is_str(value):
+        return isinstance(value, str)
+
+    def has_keys(data, required, optional=()):
+        return isinstance(data, dict) and all(k in data for k in required) and all(k in required or k in optional for k in data)
+
+    def is_profile(data):
+        return has_keys(data, ("profile",)) and is_str(data["profile"])
+
+    def is_azure_provider(data):
+        return (
+            has_keys(data, ("mode", "subscription_id", "directory_id"), ("credentials",))
+            and all(is_str(data[k]) for k in ("mode", "subscription_id", "directory_id"))
+            and ("credentials" not in data or is_profile(data["credentials"]))
+        )
+
+    def is_azure(data):
+        return (
+            isinstance(data, dict)
+            and "general" in data
+            and all(
+                is_profile(value) if key in ("credential", "credentials") else is_str(key) and is_azure_provider(value)
+                for key, value in data.items()
+            )
+        )
+
+    def is_gke_cluster(data):
+        return (
+            has_keys(data, ("name",), ("zone", "region", "refresh_kubeconfig"))
+            and ("zone" in data or "region" in data)
+            and all(is_str(data[k]) for k in ("name", "zone", "region") if k in data)
+            and data.get("refresh_kubeconfig", "always") in ("always", "never")
+        )
+
+    def is_gcp(data):
+        return (
+            has_keys(data, ("general",), ("gke",))
+            and has_keys(data["general"], ("project", "mode"))
+            and all(is_str(v) for v in data["general"].values())
+            and ("gke" not in data or isinstance(data["gke"], list) and all(is_gke_cluster(c) for c in data["gke"]))
+        )
+
+    def is_custom_provider(value):
+        return is_str(value) or has_keys(value, ("version", "extension")) and all(is_str(v) for v in value.values())
+
+    def is_terraform(data):
+        return (
+            has_keys(data, ("vars",), ("legacy", "version", "custom-providers"))
+            and isinstance(data.get("legacy", False), bool)
+            and is_str(data.get("version", ""))
+            and isinstance(data["vars"], dict)
+            and len(data["vars"]) > 0
+            and all(is_str(k) and is_str(v) for k, v in data["vars"].items())
+            and (
+                "custom-providers" not in data
+                or isinstance(data["custom-providers"], dict)
+                and len(data["custom-providers"]) > 0
+                and all(is_str(k) and is_custom_provider(v) for k, v in data["custom-providers"].items())
+            )
+        )
+
+    return (
+        has_keys(stack_config, ("terraform",), ("state_configuration_name", "depends_on", "foreach", "aws", "azure", "gcp"))
+        and is_str(stack_config.get("state_configuration_name", ""))
+        and isinstance(stack_config.get("depends_on", []), list)
+        and all(is_str(v) for v in stack_config.get("depends_on", []))
+        and has_keys(stack_config.get("foreach", {}), (), FOREACH_LIMITS)
+        and all(type(v) is int and v >= 0 for v in stack_config.get("foreach", {}).values())
+        and (
+            "aws" not in stack_config
+            or has_keys(stack_config["aws"], ("general", "credentials"))
+            and has_keys(stack_config["aws"]["general"], ("account", "region"))
+            and all(is_str(v) for v in stack_config["aws"]["general"].values())
+            and is_profile(stack_config["aws"]["credentials"])
+        )
+        and ("azure" not in stack_config or is_azure(stack_config["azure"]))
+        and ("gcp" not in stack_config or is_gcp(stack_config["gcp"]))
+        and is_terraform(stack_config["terraform"])
+    )
 
 
 class CachedRequestsSession:
@@ -131,15 +270,25 @@ class CachedRequestsSession:
     """
 
     _session = None
-    _file_cache = FileCache(DEFAULT_HTTP_CACHE_DIR)
+    _file_cache = None
+    _cache_dir = DEFAULT_HTTP_CACHE_DIR
 
     def set_cache_dir(cache_dir):
         """Configure requests session's HTTP(S) cache directory."""
-        CachedRequestsSession._file_cache.directory = cache_dir
+        CachedRequestsSession._cache_dir = cache_dir
+        if CachedRequestsSession._file_cache:
+            CachedRequestsSession._file_cache.directory = cache_dir
 
     def get(*args, **kwargs):
         """Wrap requests session's get after having initialized it if needed."""
         if not CachedRequestsSession._session:
+            import requests
+            from cachecontrol import CacheControlAdapter
+            from cachecontrol.caches import FileCache
+            from cachecontrol.heuristics import ExpiresAfter
+            from urllib3.util.retry import Retry
+
+            CachedRequestsSession._file_cache = FileCache(CachedRequestsSession._cache_dir)
             retries = Retry(total=3, backoff_factor=0.3, respect_retry_after_header=True)
             cache_adapter = CacheControlAdapter(
                 heuristic=ExpiresAfter(minutes=15),
@@ -152,7 +301,11 @@ class CachedRequestsSession:
             session.mount("https://", cache_adapter)
 
             CachedRequestsSession._session = session
-        return CachedRequestsSession._session.get(*args, **kwargs)
+        with timings.phase("http request", args[0] if args else kwargs.get("url")) as record:
+            response = CachedRequestsSession._session.get(*args, **kwargs)
+            if record is not None:
+                record["cache"] = "hit" if getattr(response, "from_cache", False) else "miss"
+        return response
 
 
 def error(message):
@@ -160,6 +313,20 @@ def error(message):
     raise ValueError("{}\n\nUse -h to show the help message".format(message))
 
 
+def find_config_dir(confdir, dir="."):
+    """Find the wrapper config directory in the provided directory or up to 4 of its parents, without side effects.
+
+    Returns the path to the config directory relative to the provided directory and the number of directories traversed,
+    or None and 5 if it cannot be found.
+    """
+    parents_count = 0
+    while parents_count < 5:
+        if os.path.isdir("{}/".format(dir) + "../" * parents_count + confdir):
+            return "../" * parents_count + confdir, parents_count
+        parents_count += 1
+    return None, parents_count
+
+
 def detect_config_dir(wrapper_config, dir="."):
     """Detect the path to the wrapper config directory relative to the provided directory.
 
@@ -168,15 +335,11 @@ def detect_config_dir(wrapper_config, dir="."):
     Updates the dict passed as a parameter.
     Returns the number of directories traversed.
     """
-    parents_count = 0
-    while parents_count < 5:
-        if os.path.isdir("{}/".format(dir) + "../" * parents_count + wrapper_config["confdir"]):
-            wrapper_config["confdir"] = "../" * parents_count + wrapper_config["confdir"]
-            logger.debug("Detected confdir at '{}'".format(wrapper_config["confdir"]))
-            break
-        parents_count += 1
-
-    if parents_count == 5:
+    confdir, parents_count = find_config_dir(wrapper_config["confdir"], dir)
+    if confdir:
+        wrapper_config["confdir"] = confdir
+        logger.debug("Detected confdir at '{}'".format(wrapper_config["confdir"]))
+    else:
         logger.debug(
             "Cannot find configuration directory '{}' in this directory or any of its parents up to 4 levels up".format(
                 wrapper_config["confdir"]
@@ -191,6 +354,7 @@ def detect_config_dir(wrapper_config, dir="."):
     if not rundir.exists():
         rundir.mkdir()
         logger.debug("Created .run at '{}'".format(wrapper_config["rootdir"]))
+    set_yaml_cache_dir(str(rundir / YAML_CACHE_DIRNAME))
 
     return parents_count
 
@@ -244,19 +408,17 @@ def load_wrapper_config(wrapper_config):
     wrapper_config_file = os.path.join(wrapper_config["confdir"], "config.yml")
     wrapper_config["config"] = deepcopy(TFWRAPPER_DEFAULT_CONFIG)
     if os.path.exists(wrapper_config_file):
-        with open(wrapper_config_file, "r") as f:
-            logger.debug("Loading wrapper config from '{}'".format(wrapper_config_file))
-            w_config = yaml.safe_load(f)
-            if w_config:
-                wrapper_config["config"].update(w_config)
+        logger.debug("Loading wrapper config from '{}'".format(wrapper_config_file))
+        w_config = load_yaml_file(wrapper_config_file)
+        if w_config:
+            wrapper_config["config"].update(w_config)
 
     # load state configuration
     config_file = os.path.join(wrapper_config["confdir"], "state.yml")
     state_config = None
     if os.path.exists(config_file):
-        with open(config_file, "r") as f:
-            logger.debug("Loading state config from '{}'".format(config_file))
-            state_config = yaml.safe_load(f)
+        logger.debug("Loading state config from '{}'".format(config_file))
+        state_config = load_yaml_file(config_file)
     else:
         logger.debug("No state config file '{}'".format(config_file))
 
@@ -338,42 +500,99 @@ def get_stack_from_config_path(config_path):
     return m.group("account", "environment", "region", "stack")
 
 
-def foreach_select_stacks(wrapper_config):
-    """Select the stacks to process with foreach. Treats unset stack components as wildcard.
+def get_stack_foreach_limits(stack_config):
+    """Get the limits of foreach commands set in the foreach section of a stack configuration, which is not validated."""
+    foreach_config = stack_config.get("foreach") if isinstance(stack_config, dict) else None
+    if not isinstance(foreach_config, dict):
+        return {}
+    return {k: v for k, v in foreach_config.items() if k in FOREACH_LIMITS and type(v) is int and v >= 0}
+
+
+def get_stack_index_entry(confdir, filename, signature):
+    """Index a stack configuration file: stack components, tool version and cloud provider, or None if not a stack."""
+    import yaml
+
+    config_file = os.path.join(confdir, filename)
+    try:
+        stack = get_stack_from_config_path(config_file)
+    except ValueError:
+        return None
+    # only global stacks have no region, other files like my_extra_file.yml are not stacks
+    if stack[2] is None and stack[1] != "global":
+        return None
+    try:
+        stack_config = load_yaml_file(config_file) or {}
+    except (OSError, yaml.YAMLError) as e:
+        logger.debug("Cannot load {} to index it: {}".format(config_file, e))
+        stack_config = {}
+    terraform_config = stack_config.get("terraform") if isinstance(stack_config, dict) else None
+    depends_on = stack_config.get("depends_on") if isinstance(stack_config, dict) else None
+    return {
+        "signature": signature,
+        "stack": stack,
+        "tool_version": terraform_config.get("version") if isinstance(terraform_config, dict) else None,
+        "provider": next((p for p in ("aws", "azure", "gcp") if p in stack_config), None),
+        "depends_on": tuple(v for v in depends_on if isinstance(v, str)) if isinstance(depends_on, list) else (),
+        "credentials": get_stack_credentials(stack_config),
+        "limits": get_stack_foreach_limits(stack_config),
+        "dir_exists": False,
+    }
+
 
-    :param wrapper_config: dict: the wrapper config
-    :return dict: stack_path => stack_config
+def update_stack_index(rootdir, confdir):
+    """Get the index of the stacks of the project, updating the entries of the configuration files which changed.
+
+    The index is stored in the .run directory. Only configuration files whose mtime or size changed are loaded again,
+    and the existence of stack directories is checked again.
+
+    :return dict: configuration filename => dict with signature, stack components, tool_version, provider, depends_on,
+        credentials, limits, dir_exists
     """
-    account = wrapper_config["account"] if wrapper_config["account"] else "*"
-    environment = wrapper_config["environment"] if wrapper_config["environment"] else "*"
-    region = wrapper_config["region"] if wrapper_config["region"] else "*"
-    stack = wrapper_config["stack"] if wrapper_config["stack"] else "*"
-
-    pattern = get_stack_config_filename(account, environment, region, stack)
-    logger.debug("Selecting stacks matching pattern '{}'".format(pattern))
-    stacks = list(pathlib.Path(wrapper_config["confdir"]).glob(pattern))
-
-    if environment == "*" and region == "*":
-        # Also select global stacks
-        environment = "global"
-        pattern = get_stack_config_filename(account, environment, region, stack)
-        logger.debug("Also selecting stacks matching pattern '{}'".format(pattern))
-        stacks.extend(list(pathlib.Path(wrapper_config["confdir"]).glob(pattern)))
-
-    stacks = sorted(list(stacks), key=lambda stack: str(stack))
-
-    filtered_stacks = {}
-    for stack_config in stacks:
-        logger.debug("Processing stack config {}".format(stack_config))
-        stack = get_stack_from_config_path(str(stack_config))
-        stack_dir = get_stack_dir(wrapper_config["rootdir"], *stack)
-        if not pathlib.Path(stack_dir).is_dir():
-            logger.warning("Stack config {} has no matching directory at {}, skipping.".format(stack_config, stack_dir))
-            continue
-        logger.debug("Added stack {} => {}".format(stack_dir, stack_config))
-        filtered_stacks[stack_dir] = load_stack_config_from_file(stack_config)
+    index_file = os.path.join(rootdir, ".run", STACK_INDEX_FILENAME)
+    index = load_pickle_file(index_file)
+    if not isinstance(index, dict) or index.get("version") != STACK_INDEX_VERSION:
+        index = {"version": STACK_INDEX_VERSION, "entries": {}}
+
+    entries = {}
+    with timings.phase("stack index") as record:
+        with os.scandir(confdir) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith(".yml") or dir_entry.name in ("config.yml", "state.yml"):
+                    continue
+                st = dir_entry.stat()
+                signature = (st.st_mtime_ns, st.st_size)
+                entry = index["entries"].get(dir_entry.name)
+                if entry is None or entry["signature"] != signature:
+                    entry = get_stack_index_entry(confdir, dir_entry.name, signature)
+                    if entry is None:
+                        continue
+                entries[dir_entry.name] = dict(entry, dir_exists=os.path.isdir(get_stack_dir(rootdir, *entry["stack"])))
+        changed = entries != index["entries"]
+        if record is not None:
+            record["cache"] = "miss" if changed else "hit"
+
+    if changed and os.path.isdir(os.path.dirname(index_file)):
+        try:
+            save_pickle_file(index_file, {"version": STACK_INDEX_VERSION, "entries": entries})
+        except OSError as e:
+            logger.debug("Failed to write stack index file {}: {}".format(index_file, e))
+    return dict(sorted(entries.items()))
+
+
+def load_stack_index(rootdir):
+    """Load the index of the stacks of the project as stored by the last execution, without updating it."""
+    index = load_pickle_file(os.path.join(rootdir, ".run", STACK_INDEX_FILENAME))
+    if not isinstance(index, dict) or index.get("version") != STACK_INDEX_VERSION:
+        return {}
+    return index["entries"]
+
 
-    return filtered_stacks
+def get_stack_id(rootdir, stack_dir):
+    """Get the identifier of a stack used in stack dependencies: account/environment/region/stack or account/global/stack."""
+    parts = os.path.relpath(stack_dir, rootdir).split(os.sep)
+    if len(parts) == 3 and parts[1] == "_global":
+        parts[1] = "global"
+    return "/".join(parts)
 
 
 def load_stack_config_from_file(stack_config_file):
@@ -383,18 +602,63 @@ def load_stack_config_from_file(stack_config_file):
         return {}
 
     logger.debug("Loading stack config from {}".format(stack_config_file))
-    with open(stack_config_file, "r") as f:
-        stack_config = yaml.safe_load(f)
-
-    try:
-        stack_configuration_schema.validate(stack_config)
-    except SchemaError as e:
-        logger.error("Configuration error in {} : {}".format(stack_config_file, e))
-        sys.exit(RC_KO)
+    stack_config = load_yaml_file(stack_config_file)
+    validate_stack_config(stack_config_file, stack_config)
 
     return stack_config
 
 
+# digests of the stack configuration files validated in this process
+_valid_stack_config_digests = set()
+
+
+@functools.cache
+def get_schema_cache_salt():
+    """Get a value changing with tfwrapper itself, so that upgrading it invalidates validation results."""
+    st = os.stat(__file__)
+    return "{}:{}:{}".format(__file__, st.st_mtime_ns, st.st_size).encode()
+
+
+def validate_stack_config(stack_config_file, stack_config):
+    """Validate a stack configuration loaded from a file, or exit.
+
+    Validation results are cached in the .run directory along with the file content hash, so unchanged files are not
+    validated again by later executions. There is a single cache file per configuration file, replaced when it changes.
+    """
+    with open(stack_config_file, "rb") as f:
+        digest = hashlib.sha256(f.read() + get_schema_cache_salt()).hexdigest()
+    if digest in _valid_stack_config_digests:
+        return
+
+    # the configuration file is located in the confdir, which is at the root of the project
+    rundir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(stack_config_file))), ".run")
+    schema_cache_file = os.path.join(
+        rundir, SCHEMA_CACHE_DIRNAME, hashlib.sha256(os.path.abspath(stack_config_file).encode()).hexdigest()
+    )
+    if load_pickle_file(schema_cache_file) == digest:
+        _valid_stack_config_digests.add(digest)
+        return
+
+    with timings.phase("stack config validation", stack_config_file):
+        if not is_valid_stack_config(stack_config):
+            from schema import SchemaError
+
+            try:
+                get_stack_configuration_schema().validate(stack_config)
+            except SchemaError as e:
+                logger.error("Configuration error in {} : {}".format(stack_config_file, e))
+                sys.exit(RC_KO)
+
+        if os.path.isdir(rundir):
+            try:
+                os.makedirs(os.path.dirname(schema_cache_file), exist_ok=True)
+                save_pickle_file(schema_cache_file, digest)
+            except OSError as e:
+                logger.debug("Failed to write schema cache file {}: {}".format(schema_cache_file, e))
+
+    _valid_stack_config_digests.add(digest)
+
+
 def get_stack_envvars(stack_config, wrapper_stack_config):
     """Generate TFWRAPPER environment variables to export."""
     envvars = {}
@@ -409,8 +673,53 @@ def get_stack_envvars(stack_config, wrapper_stack_config):
     return {**envvars, **os.environ}
 
 
-def _get_aws_session(session_cache_file, region, profile):
-    """Get or create boto cached session."""
+# boto3 sessions created in this process by session cache file, region, profile and AWS_* environment variables
+_aws_sessions = {}
+
+# GCP user Application Default Credentials are not checked again before this delay, in seconds
+GCP_ADC_CHECK_TTL = 300
+_gcp_adc_checked_at = None
+
+
+class InteractionRequired(Exception):
+    """Raised when acquiring credentials would prompt the user while preparing an execution non-interactively."""
+
+
+def _refuse_prompt(prompt):
+    """Prompt replacement raising InteractionRequired, for non-interactive preparations."""
+    raise InteractionRequired(prompt.strip())
+
+
+def clear_caches():
+    """Forget configurations parsed and credentials acquired or checked in this process."""
+    global _gcp_adc_checked_at
+    clear_yaml_cache()
+    _aws_sessions.clear()
+    azure.clear_cli_cache()
+    _gcp_adc_checked_at = None
+
+
+def _get_aws_session(session_cache_file, region, profile, interactive=True):
+    """Get or create boto cached session.
+
+    Sessions are also kept in memory for the lifetime of the process, with the same validity rules as the cache file,
+    and as long as the AWS_* environment variables boto3 reads are the same.
+    Unless interactive, InteractionRequired is raised instead of prompting for an MFA code.
+    """
+    import boto3
+    import botocore.exceptions
+
+    aws_environ = sorted((name, value) for name, value in os.environ.items() if name.startswith("AWS_"))
+    key = (session_cache_file, region, profile, hashlib.sha256(json.dumps(aws_environ).encode()).hexdigest())
+    if key in _aws_sessions:
+        session, expiration_time, created_at = _aws_sessions[key]
+        if (expiration_time and datetime.now(expiration_time.tzinfo) < expiration_time) or (
+            not expiration_time and time.time() - created_at < 900
+        ):
+            logger.debug(f"Reusing session for profile {profile} from memory")
+            return session
+        del _aws_sessions[key]
+
     session = None
     if os.path.isfile(session_cache_file) and time.time() - os.stat(session_cache_file).st_mtime < 900:
         logger.debug(f"Reading session cache file: {session_cache_file}")
@@ -435,6 +744,8 @@ def _get_aws_session(session_cache_file, region, profile):
         except botocore.exceptions.ProfileNotFound:
             logger.error("Profile {} not found. Exiting...".format(profile))
             sys.exit(RC_KO)
+        if not interactive:
+            session._session.get_component("credential_provider").get_provider("assume-role")._prompter = _refuse_prompt
         try:
             credentials = session.get_credentials()
             expiration_time = None
@@ -449,27 +760,35 @@ def _get_aws_session(session_cache_file, region, profile):
         except botocore.exceptions.ParamValidationError:
             logger.error("Error validating authentication. Maybe the wrong MFA code?")
             sys.exit(RC_KO)
+        except InteractionRequired:
+            raise
         except Exception:
             logger.exception("Unknown error")
             sys.exit(RC_UNK)
 
-        with os.fdopen(os.open(session_cache_file, os.O_WRONLY | os.O_CREAT, mode=0o600), "wb") as f:
+        with os.fdopen(os.open(session_cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode=0o600), "wb") as f:
             pickle.dump(session_cache, f, pickle.HIGHEST_PROTOCOL)
             logger.debug(f"Wrote session cache file: {session_cache_file}")
 
+    _aws_sessions[key] = (session, expiration_time, time.time())
     return session
 
 
-def get_session(wrapper_config, account, region, profile, backend_type=None, conf=None):
-    """Get/create session credentials for supported providers."""
+def get_session(wrapper_config, account, region, profile, backend_type=None, conf=None, environ=None, interactive=True):
+    """Get/create session credentials for supported providers.
+
+    Environment variables are read from and set in os.environ, unless another environ dict is given.
+    Unless interactive, InteractionRequired is raised instead of prompting the user.
+    """
     if backend_type == "aws":
         # Get or create boto cached session.
         session_cache_file = "{}/.run/session_cache_{}_{}.pickle".format(wrapper_config["rootdir"], account, profile)
-        session = _get_aws_session(session_cache_file, region, profile)
+        with timings.phase("aws credentials", profile):
+            session = _get_aws_session(session_cache_file, region, profile, interactive)
     elif backend_type == "azure":
         try:
             session = azure.set_context(
-                wrapper_config, conf["state_subscription"], None, "", sp_profile=profile, backend_context=True
+                wrapper_config, conf["state_subscription"], None, "", sp_profile=profile, backend_context=True, environ=environ
             )
         except azure.AzureError as e:
             logger.error(f"Error while configuring Azure context: {e.message}")
@@ -480,11 +799,98 @@ def get_session(wrapper_config, account, region, profile, backend_type=None, con
     return session
 
 
-def set_terraform_vars(vars):
-    """Configure Terraform env."""
+def get_stack_credentials(stack_config):
+    """Get the credentials used by a stack configuration, see acquire_credentials().
+
+    The configuration is not validated, invalid credentials configurations are ignored.
+    :return tuple: ("state", state configuration name or None), ("aws", account, region, profile),
+        ("azure", subscription id, directory id, context name, Service Principal profile or None), ("gcp",)
+    """
+    if not isinstance(stack_config, dict):
+        return ()
+    credentials = [("state", stack_config.get("state_configuration_name"))]
+    try:
+        if "aws" in stack_config:
+            general = stack_config["aws"]["general"]
+            credentials.append(("aws", general["account"], general["region"], stack_config["aws"]["credentials"]["profile"]))
+    except (KeyError, TypeError):
+        pass
+    for provider_alias, provider_config in (stack_config.get("azure") or {}).items():
+        if provider_alias in ["credential", "credentials"]:
+            continue
+        try:
+            mode = provider_config.get("mode", "user").lower()
+            sp_profile = None
+            if mode in ["sp", "serviceprincipal", "service_principal"]:
+                sp_profile = next(
+                    c["profile"]
+                    for c in (
+                        provider_config.get("credentials"),
+                        stack_config["azure"].get("credentials"),
+                        stack_config["azure"].get("credential"),
+                    )
+                    if isinstance(c, dict) and "profile" in c
+                )
+            elif mode != "user":
+                continue
+            credentials.append(
+                (
+                    "azure",
+                    provider_config["subscription_id"],
+                    provider_config.get("tenant_id", provider_config.get("directory_id")),
+                    "" if provider_alias == "general" else provider_alias,
+                    sp_profile,
+                )
+            )
+        except (AttributeError, KeyError, StopIteration, TypeError):
+            continue
+    try:
+        if stack_config["gcp"]["general"]["mode"].lower() == "adc-user":
+            credentials.append(("gcp",))
+    except (AttributeError, KeyError, TypeError):
+        pass
+    return tuple(credentials)
+
+
+def acquire_credentials(wrapper_config, credentials, environ=None):
+    """Acquire or check credentials, as returned by get_stack_credentials(), like prepare() does for a stack.
+
+    Credentials are kept in memory and in the .run directory, so that preparing stacks using them is faster.
+    Exits or raises azure.AzureError if they cannot be acquired. Environment variables may be set in environ,
+    os.environ by default.
+    """
+    if credentials[0] == "state":
+        if not wrapper_config["state"]:
+            return
+        state_config = (
+            wrapper_config["state"].get(credentials[1]) if credentials[1] else next(iter(wrapper_config["state"].values()))
+        )
+        if state_config is not None:
+            get_session(
+                wrapper_config,
+                state_config.get("state_account"),
+                state_config.get("state_region"),
+                state_config.get("state_profile"),
+                state_config["state_backend_type"],
+                state_config,
+                environ,
+            )
+    elif credentials[0] == "aws":
+        get_session(wrapper_config, *credentials[1:], "aws", environ=environ)
+    elif credentials[0] == "azure":
+        subscription_id, directory_id, context_name, sp_profile = credentials[1:]
+        if directory_id:
+            azure.set_context(wrapper_config, subscription_id, directory_id, context_name, sp_profile, environ=environ)
+    elif credentials[0] == "gcp":
+        adc_check_user_credentials()
+
+
+def set_terraform_vars(vars, environ=None):
+    """Configure Terraform env, in os.environ unless another environ dict is given."""
+    environ = os.environ if environ is None else environ
     for var, value in vars.items():
         if value is not None:
-            os.environ["TF_VAR_{}".format(var)] = str(value)
+            environ["TF_VAR_{}".format(var)] = str(value)
 
 
 def bootstrap(wrapper_config):
@@ -551,6 +957,8 @@ def bootstrap(wrapper_config):
             template_path = "{}/templates/{}/common".format(rootdir, state_backend_type)
             logger.debug("Using template path {}".format(template_path))
 
+            import jinja2
+
             jinja2_env = jinja2.Environment(
                 loader=jinja2.FileSystemLoader(template_path),
                 lstrip_blocks=True,
@@ -616,6 +1024,8 @@ def search_on_github(repo, minor_version, patch_regex, patch):
 
 def get_terraform_last_patch(minor_version):
     """Get last terraform patch of a given minor version."""
+    from natsort import natsorted
+
     releases = CachedRequestsSession.get(TERRAFORM_RELEASES_URL).json()
     if isinstance(releases, dict) and isinstance(releases["versions"], dict):
         # Use recommended sorting method to place releases before all pre-versions from
@@ -634,9 +1044,10 @@ def get_terraform_last_patch(minor_version):
 
 
 def select_terraform_version(version):
-    """Select the desired terraform version.
+    """Select the desired terraform version, downloading it if needed.
 
     :param version: string: desired terraform version
+    :return string: the path to the terraform binary
     """
     m = re.match(
         r"^(?P<minor>{})(\.(?P<patch>{}))?$".format(TERRAFORM_MINOR_VERSION_REGEX, TERRAFORM_PATCH_REGEX),
@@ -653,11 +1064,10 @@ def select_terraform_version(version):
 
     # FIXME: maybe move this to $XDG_CACHE_DIR/claranet-tfwrapper/terraform/versions
     version_path = os.path.expanduser(os.path.join("~/.terraform.d/versions", minor_version, full_version))
-    global TOOL_BIN_PATH
-    TOOL_BIN_PATH = os.path.join(version_path, "terraform")
+    tool_bin_path = os.path.join(version_path, "terraform")
     os.makedirs(version_path, exist_ok=True)
 
-    if not os.path.isfile(TOOL_BIN_PATH):
+    if not os.path.isfile(tool_bin_path):
         if patch.endswith("-dev"):
             error(f"The development version {version} for terraform does not exist locally")
 
@@ -673,27 +1083,29 @@ def select_terraform_version(version):
 
         # Download and extract in user's home if needed
         logger.warning(f"Terraform version {full_version} does not exist locally, downloading it")
-        handle, tmp_file = tempfile.mkstemp(prefix="terraform-", suffix=".zip")
-        r = CachedRequestsSession.get(
-            f"https://releases.hashicorp.com/terraform/{full_version}/terraform_{full_version}_{PLATFORM_SYSTEM}_{arch}.zip",
-            stream=True,
-        )
-        if r.status_code != 200:
-            error(f"Failed to download terraform version {full_version}, it probably does not exist: {r.status_code}")
-
-        with open(tmp_file, "wb") as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
-        with zipfile.ZipFile(tmp_file, "r") as zip:
-            zip.extractall(path=version_path)
-        # Permissions not preserved on extract https://github.com/python/cpython/issues/59999
-        os.chmod(
-            TOOL_BIN_PATH,
-            os.stat(TOOL_BIN_PATH).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
-        )
-        os.remove(tmp_file)
+        with timings.phase("binary download", f"terraform {full_version}"):
+            handle, tmp_file = tempfile.mkstemp(prefix="terraform-", suffix=".zip")
+            r = CachedRequestsSession.get(
+                f"https://releases.hashicorp.com/terraform/{full_version}/terraform_{full_version}_{PLATFORM_SYSTEM}_{arch}.zip",
+                stream=True,
+            )
+            if r.status_code != 200:
+                error(f"Failed to download terraform version {full_version}, it probably does not exist: {r.status_code}")
+
+            with open(tmp_file, "wb") as fd:
+                for chunk in r.iter_content(chunk_size=128):
+                    fd.write(chunk)
+            with zipfile.ZipFile(tmp_file, "r") as zip:
+                zip.extractall(path=version_path)
+            # Permissions not preserved on extract https://github.com/python/cpython/issues/59999
+            os.chmod(
+                tool_bin_path,
+                os.stat(tool_bin_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
+            )
+            os.remove(tmp_file)
 
-    logger.info(f"Using terraform version {full_version} at {TOOL_BIN_PATH}")
+    logger.info(f"Using terraform version {full_version} at {tool_bin_path}")
+    return tool_bin_path
 
 
 def download_tool_from_github(repo, tool_version, tool_type, extension="zip"):
@@ -703,6 +1115,7 @@ def download_tool_from_github(repo, tool_version, tool_type, extension="zip"):
     :param tool_version: string: desired tool version
     :param tool_type: string: the type of the tool to use, one of "tofu" or "provider"
     :param extension: string: the extension of the tool release artifact to download
+    :return string: the path to the tool binary
     """
     logger.debug(f"Searching version '{tool_version}' for tool {tool_type} from '{repo}' GitHub repository.")
     github_base = "https://github.com/"
@@ -755,33 +1168,75 @@ def download_tool_from_github(repo, tool_version, tool_type, extension="zip"):
 
     os.makedirs(tool_path, exist_ok=True)
 
-    if tool_type == TOOL_OPENTOFU:
-        global TOOL_BIN_PATH
-        TOOL_BIN_PATH = tool_bin_path
-
     if not os.path.isfile(tool_bin_path):
         # Download and extract in user's home if needed
         logger.warning(f"Tool {tool_type} version {full_version} does not exist locally, downloading it")
-        handle, tmp_file = tempfile.mkstemp(prefix=f"{tool_type}-", suffix="." + extension)
-        r = CachedRequestsSession.get(
-            f"https://github.com/{repo}/releases/download/v{full_version}/{bin_name}_{PLATFORM_SYSTEM}_{ARCH_NAME}.{extension}",
-            stream=True,
-        )
-        with open(tmp_file, "wb") as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
-        shutil.unpack_archive(tmp_file, tool_path)
-        os.remove(tmp_file)
-        # Permissions not preserved on extract https://github.com/python/cpython/issues/59999
-        os.chmod(
-            tool_bin_path,
-            os.stat(tool_bin_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
-        )
+        with timings.phase("binary download", f"{tool_short_name} {full_version}"):
+            handle, tmp_file = tempfile.mkstemp(prefix=f"{tool_type}-", suffix="." + extension)
+            r = CachedRequestsSession.get(
+                f"https://github.com/{repo}/releases/download/v{full_version}/{bin_name}_{PLATFORM_SYSTEM}_{ARCH_NAME}.{extension}",
+                stream=True,
+            )
+            with open(tmp_file, "wb") as fd:
+                for chunk in r.iter_content(chunk_size=128):
+                    fd.write(chunk)
+            shutil.unpack_archive(tmp_file, tool_path)
+            os.remove(tmp_file)
+            # Permissions not preserved on extract https://github.com/python/cpython/issues/59999
+            os.chmod(
+                tool_bin_path,
+                os.stat(tool_bin_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH,
+            )
         logger.debug(f"Tool {tool_type} version {full_version} was downloaded")
     else:
         logger.debug(f"Tool {tool_type} version {full_version} is already available")
 
-    logger.info(f"Using {tool_type} version {full_version} at {TOOL_BIN_PATH}")
+    logger.info(f"Using {tool_type} version {full_version} at {tool_bin_path}")
+    return tool_bin_path
+
+
+def adc_check_user_credentials():
+    """Check that GCP user Application Default Credentials are available.
+
+    The check is skipped if it already succeeded in this process less than GCP_ADC_CHECK_TTL seconds ago.
+    """
+    global _gcp_adc_checked_at
+    if _gcp_adc_checked_at and time.time() - _gcp_adc_checked_at < GCP_ADC_CHECK_TTL:
+        logger.debug("GCP user Application Default Credentials already checked recently, skipping")
+        return
+
+    logger.info("Looking for GCP user Application Default Credentials.")
+    try:
+        command = [
+            "gcloud",
+            "auth",
+            "application-default",
+            "print-access-token",
+        ]
+        logger.debug("Executing `{}`".format(" ".join(command)))
+        with timings.phase("gcloud credentials"):
+            subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                check=True,
+            )
+    except FileNotFoundError:
+        logger.error("Please make sure that gcloud is available on this system.")
+        sys.exit(RC_KO)
+    except subprocess.CalledProcessError as e:
+        logger.error(
+            "Could not find valid user Application Default Credentials, the following command failed:\n\n"
+            "    {}\n\n"
+            "with the following error:\n\n"
+            "{}\n"
+            "You may need to run:\n\n"
+            "    gcloud auth application-default login".format(" ".join(command), textwrap.indent(e.output.decode(), "    "))
+        )
+        sys.exit(RC_KO)
+    logger.info("Found GCP user Application Default Credentials.")
+    _gcp_adc_checked_at = time.time()
 
 
 def adc_check_gke_credentials(
@@ -841,13 +1296,14 @@ def adc_check_gke_credentials(
         logger.info("Refreshing {} GKE credentials.".format(gke_name))
         try:
             logger.debug("Executing `{} {}`".format(format_env(gke_env), " ".join(command)))
-            subprocess.run(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                check=True,
-                env=cmd_env,
-            )
+            with timings.phase("gke credentials", gke_name):
+                subprocess.run(
+                    command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    check=True,
+                    env=cmd_env,
+                )
         except subprocess.CalledProcessError as e:
             logger.error(
                 "Could not configure {} GKE credentials, the following command failed:\n\n"
@@ -862,18 +1318,12 @@ def adc_check_gke_credentials(
         logger.info("Using existing {} kubeconfig file.".format(gke_name))
 
 
-def run_terraform(action, wrapper_config):
-    """Run Terraform command."""
-    rootdir = wrapper_config["rootdir"]
-
+def get_terraform_command(action, wrapper_config):
+    """Get the Terraform command line of an action, with the selected tool and the custom parameters."""
     tf_params = wrapper_config.get("tf_params")
-    account = wrapper_config["account"]
-    environment = wrapper_config["environment"]
-    region = wrapper_config["region"]
-    stack = wrapper_config["stack"]
 
     # support for custom parameters
-    command = [TOOL_BIN_PATH, action]
+    command = [wrapper_config["tool_bin_path"], action]
 
     if action == "init" and not wrapper_config["backend"]:
         command.append("-backend=false")
@@ -882,13 +1332,27 @@ def run_terraform(action, wrapper_config):
         if tf_params and tf_params[0] == "--":
             tf_params = tf_params[1:]
         command += tf_params
+    return command
 
-    working_dir = get_stack_dir(rootdir, account, environment, region, stack)
+
+def run_terraform(action, wrapper_config):
+    """Run Terraform command."""
+    command = get_terraform_command(action, wrapper_config)
+    working_dir = get_stack_dir(
+        wrapper_config["rootdir"],
+        wrapper_config["account"],
+        wrapper_config["environment"],
+        wrapper_config["region"],
+        wrapper_config["stack"],
+    )
 
     pipe_plan_command = wrapper_config.get("pipe_plan_command") or wrapper_config["config"].get("pipe_plan_command")
     pipe_plan = action == "plan" and wrapper_config.get("pipe_plan") and pipe_plan_command
     stdout = pipe_plan and subprocess.PIPE or None
-    with subprocess.Popen(command, cwd=working_dir, env=os.environ, shell=False, stdout=stdout) as process:
+    with (
+        timings.phase("terraform", action),
+        subprocess.Popen(command, cwd=working_dir, env=os.environ, shell=False, stdout=stdout) as process,
+    ):
         logger.debug('Execute command "{}"'.format(command))
         if pipe_plan:
             logger.debug('Piping command "{}"'.format(pipe_plan_command))
@@ -1091,35 +1555,113 @@ def terraform_workspace(wrapper_config):
     return run_terraform("workspace", wrapper_config)
 
 
-def foreach(wrapper_config):
-    """Execute command foreach stack."""
-    stacks = foreach_select_stacks(wrapper_config)
-    for stack, stack_config in stacks.items():
-        command = wrapper_config["command"]
-        shell = wrapper_config["shell"]
-        executable = wrapper_config["executable"]
+def show_stack_index(wrapper_config):
+    """Update the stack index and print it."""
+    if wrapper_config["rebuild"]:
+        try:
+            os.remove(os.path.join(wrapper_config["rootdir"], ".run", STACK_INDEX_FILENAME))
+        except FileNotFoundError:
+            pass
+    index = update_stack_index(wrapper_config["rootdir"], wrapper_config["confdir"])
+    rows = [
+        (
+            get_stack_id(wrapper_config["rootdir"], get_stack_dir(wrapper_config["rootdir"], *entry["stack"])),
+            filename,
+            "yes" if entry["dir_exists"] else "no",
+            entry["tool_version"] or "-",
+            entry["provider"] or "-",
+        )
+        for filename, entry in index.items()
+    ]
+    headers = ("Stack", "Config", "Directory", "Version", "Provider")
+    widths = [max(len(row[i]) for row in [headers, *rows]) for i in range(len(headers))]
+    for row in [headers, *rows]:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    return RC_OK
+
+
+def show_history(wrapper_config):
+    """Print the latest executions of foreach commands recorded in the history."""
+    from . import history
+
+    executions = history.query(
+        wrapper_config["rootdir"],
+        stack=wrapper_config["stack_pattern"],
+        command=wrapper_config["command_pattern"],
+        limit=wrapper_config["limit"],
+    )
+    rows = [
+        (
+            datetime.fromtimestamp(execution["started_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+            execution["stack"],
+            str(execution["returncode"]),
+            history.format_duration(execution["duration"]),
+            execution["command"],
+        )
+        for execution in executions
+    ]
+    headers = ("Started", "Stack", "Return code", "Duration", "Command")
+    widths = [max(len(row[i]) for row in [headers, *rows]) for i in range(len(headers))]
+    for row in [headers, *rows]:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    return RC_OK
 
-        wrapper_stack_config = deepcopy(wrapper_config)
-        wrapper_stack_config["confdir"] = "conf/"
-        parents_count = detect_config_dir(wrapper_stack_config, dir=stack)
-        detect_stack(wrapper_stack_config, parents_count, raise_on_missing=True, dir=stack)
-        stack_env = get_stack_envvars(stack_config, wrapper_stack_config)
 
-        with subprocess.Popen(command, cwd=stack, shell=shell, executable=executable, env=stack_env) as process:
-            logger.debug('Execute command "{}" in "{}"'.format(command, stack))
-            try:
-                process.communicate()
-            except KeyboardInterrupt:
-                logger.warning("Received Ctrl+C")
-            except:  # noqa
-                process.kill()
-                process.wait()
-                raise
-            returncode = process.poll()
-            if returncode != 0:
-                # TODO: add option to collect errors and report at end?
-                return returncode
-    return 0
+def run_foreach(wrapper_config):
+    """Execute a command for each selected stack, see the foreach module."""
+    from . import foreach
+
+    return foreach.run(wrapper_config)
+
+
+def run_daemon(wrapper_config):
+    """Serve tfwrapper executions of the project from this process, see the daemon module."""
+    from . import daemon
+
+    return daemon.serve(wrapper_config["rootdir"], os.path.abspath(wrapper_config["confdir"]), wrapper_config["idle_timeout"])
+
+
+def save_completion_data(rootdir, tool_bin_path):
+    """Store the data needed by command line completion in the .run directory, so that it does not resolve anything."""
+    data = {"tool_bin_path": tool_bin_path}
+    if load_completion_data(rootdir) != data:
+        completion_data_file = os.path.join(rootdir, ".run", COMPLETION_DATA_FILENAME)
+        with open(completion_data_file, "w") as f:
+            json.dump(data, f)
+        logger.debug("Wrote completion data file: {}".format(completion_data_file))
+
+
+def load_completion_data(rootdir):
+    """Load the data stored for command line completion, if any."""
+    try:
+        with open(os.path.join(rootdir, ".run", COMPLETION_DATA_FILENAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_completion_tool_bin_path(confdir):
+    """Get the tool binary to use for command line completion.
+
+    Use the last tool used in the project, and otherwise any tool available in the PATH. Never download anything.
+    """
+    confdir, _ = find_config_dir(confdir)
+    if confdir:
+        tool_bin_path = load_completion_data(os.path.dirname(os.path.abspath(confdir))).get("tool_bin_path")
+        if tool_bin_path and os.path.isfile(tool_bin_path):
+            return tool_bin_path
+
+    return shutil.which(TOOL_OPENTOFU) or shutil.which(TOOL_TERRAFORM)
+
+
+def stack_completer(prefix, action, parser, parsed_args):
+    """Get completions for the stack components arguments, from the stack index stored by the last execution."""
+    confdir, _ = find_config_dir(getattr(parsed_args, "confdir", None) or DEFAULT_CONF_DIRNAME)
+    if not confdir:
+        return []
+    position = ("account", "environment", "region", "stack").index(action.dest)
+    entries = load_stack_index(os.path.dirname(os.path.abspath(confdir))).values()
+    return sorted({entry["stack"][position] for entry in entries if entry["stack"][position]})
 
 
 def terraform_completer(prefix, action, parser, parsed_args):
@@ -1128,8 +1670,12 @@ def terraform_completer(prefix, action, parser, parsed_args):
         "terraform_completer(prefix={}, action={}, parser={}, parsed_args={})".format(prefix, action, parser, parsed_args)
     )
 
+    tool_bin_path = get_completion_tool_bin_path(getattr(parsed_args, "confdir", None) or DEFAULT_CONF_DIRNAME)
+    if not tool_bin_path:
+        return []
+
     working_dir = "."
-    command = [TOOL_BIN_PATH]
+    command = [tool_bin_path]
     # Pass environment variables unchanged, including COMP_LINE which is defined by the shell
     # when invoked during auto-completion
     logger.debug('Execute command "{}" with environment {}'.format(command, os.environ))
@@ -1139,214 +1685,339 @@ def terraform_completer(prefix, action, parser, parsed_args):
     return sorted(process.stdout.strip().split("\n"))
 
 
-def parse_base_args(args):
-    """Parse -d/--debug command line argument and setup HTTP cache dir."""
-    # Get command line arguments from COMP_LINE environment variable which is defined by the shell
-    # when invoked during auto-completion
-    if not args and "COMP_LINE" in os.environ:
-        args = shlex.split(os.environ["COMP_LINE"])
+def complete():
+    """Answer command line completion from the parser and precomputed data only, then exit.
 
-    parser = argparse.ArgumentParser(
-        prog="tfwrapper",
-        add_help=False,
-    )
-    parser.add_argument("-d", "--debug", action="store_true", default=False)
-    parser.add_argument("-c", "--confdir", nargs="?", const=DEFAULT_CONF_DIRNAME, default=DEFAULT_CONF_DIRNAME)
-    parser.add_argument("-a", "--account", nargs="?")
-    parser.add_argument("-e", "--environment", nargs="?")
-    parser.add_argument("-r", "--region", nargs="?")
-    parser.add_argument("-s", "--stack", nargs="?")
-    parser.add_argument("--http-cache-dir", nargs="?", const=DEFAULT_HTTP_CACHE_DIR, default=DEFAULT_HTTP_CACHE_DIR)
-    parsed_args, _ = parser.parse_known_args(args)
+    Configurations are not loaded, tools are not resolved nor downloaded and credentials are not acquired.
+    """
+    import argcomplete
+
+    argcomplete.autocomplete(get_parser(), exit_method=sys.exit)
+    sys.exit(RC_OK)
+
+
+TERRAFORM_SUBCOMMANDS = {
+    "apply": terraform_apply,
+    "console": terraform_console,
+    "destroy": terraform_destroy,
+    "fmt": terraform_fmt,
+    "force-unlock": terraform_force_unlock,
+    "get": terraform_get,
+    "graph": terraform_graph,
+    "import": terraform_import,
+    "init": terraform_init,
+    "output": terraform_output,
+    "plan": terraform_plan,
+    "providers": terraform_providers,
+    "refresh": terraform_refresh,
+    "show": terraform_show,
+    "state": terraform_state,
+    "taint": terraform_taint,
+    "untaint": terraform_untaint,
+    "validate": terraform_validate,
+    "version": terraform_version,
+    "workspace": terraform_workspace,
+}
+WRAPPER_SUBCOMMANDS = ("bootstrap", "foreach", "history", "index", "daemon")
+SUBCOMMANDS = (*TERRAFORM_SUBCOMMANDS, *WRAPPER_SUBCOMMANDS)
+
+# global options which consume the next argument as their value
+GLOBAL_OPTIONS_WITH_VALUE = (
+    "-c",
+    "--confdir",
+    "-a",
+    "--account",
+    "-e",
+    "--environment",
+    "-r",
+    "--region",
+    "-s",
+    "--stack",
+    "--http-cache-dir",
+    "-p",
+    "--plugin-cache-dir",
+    "--timings-file",
+)
 
-    logger.setLevel(logging.DEBUG if parsed_args.debug else logging.INFO)
 
-    # configure requests session's cache directory
-    CachedRequestsSession.set_cache_dir(parsed_args.http_cache_dir)
+def find_subcommand(args):
+    """Find the subcommand in command line arguments, if any.
 
-    return parsed_args
+    Values of global options are skipped, like argparse does.
+    """
+    args = iter(args)
+    for arg in args:
+        if arg in GLOBAL_OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif arg in SUBCOMMANDS:
+            return arg
+        elif not arg.startswith("-"):
+            break
+    return None
 
 
-def parse_args(args):
-    """Parse command line arguments."""
-    # terraform params doc
+def add_subcommand_parser(subparsers, subcommand):
+    """Add the parser of a single subcommand."""
+    tf_params_help = 'Any Terraform parameters after a "--" delimiter'
+
+    if subcommand == "bootstrap":
+        parser_bootstrap = subparsers.add_parser("bootstrap", help="bootstrap configuration")
+        parser_bootstrap.set_defaults(func=bootstrap)
+        parser_bootstrap.add_argument("template", nargs="?", help="template to use during bootstrap", default=None)
+        return
+
+    if subcommand == "foreach":
+        parser_foreach = subparsers.add_parser("foreach", help="execute command for each stack")
+        parser_foreach.set_defaults(func=run_foreach)
+        parser_foreach.add_argument("-S", "--shell", dest="shell", action="store_true", help="execute command in a shell")
+        parser_foreach.add_argument(
+            "-j",
+            "--jobs",
+            default=1,
+            help=(
+                "execute command for this number of stacks at a time, without stdin, or auto to adapt it to the available "
+                "resources, in which case the output of commands is read by tfwrapper and is not a terminal. Defaults to 1."
+            ),
+        )
+        parser_foreach.add_argument(
+            "-o",
+            "--output",
+            choices=output.OUTPUT_MODES,
+            default=output.OUTPUT_MODE_STREAM,
+            help=(
+                "how to write the output of commands: as is (stream), with each line prefixed by its stack (prefix), "
+                "or per stack once its command is done (group). Defaults to stream."
+            ),
+        )
+        parser_foreach.add_argument(
+            "-k",
+            "--keep-going",
+            action="store_true",
+            help="execute command for all stacks even if it fails for some of them",
+        )
+        parser_foreach.add_argument(
+            "--changed-since",
+            metavar="REF",
+            help="only execute command for the stacks affected by the files changed since this git ref, e.g. origin/main",
+        )
+        parser_foreach.add_argument(
+            "--shard",
+            metavar="I/N",
+            help="only execute command for the I-th of N disjoint sets of stacks of about the same duration, from 1",
+        )
+        parser_foreach.add_argument(
+            "--shard-durations",
+            metavar="FILE",
+            help="JSON summary of a previous execution, written with --summary-json, to balance shards by duration",
+        )
+        parser_foreach.add_argument(
+            "--summary-json",
+            metavar="FILE",
+            help="write the return code, duration and last lines of output of the command for each stack as JSON",
+        )
+        parser_foreach.add_argument(
+            "--summary-junit",
+            metavar="FILE",
+            help="write the result of the command for each stack as a JUnit XML report, for CI systems",
+        )
+        parser_foreach.add_argument(
+            "--no-native",
+            action="store_true",
+            help="execute wrapper subcommands like tfwrapper plan in a new tfwrapper process for each stack",
+        )
+        parser_foreach.add_argument(
+            "--resume",
+            action="store_true",
+            help="skip the stacks for which the command succeeded in its previous execution for the same stacks, if interrupted",
+        )
+        parser_foreach.add_argument(
+            "--timeout",
+            metavar="SECONDS",
+            type=int,
+            default=0,
+            help="kill the command of a stack running for longer than this, unless set in its configuration. 0 for no limit.",
+        )
+        parser_foreach.add_argument(
+            "--inactivity-timeout",
+            metavar="SECONDS",
+            type=int,
+            default=0,
+            help="kill the command of a stack writing no output for longer than this, unless set in its configuration",
+        )
+        parser_foreach.add_argument(
+            "--memory-limit",
+            metavar="MIB",
+            type=int,
+            default=0,
+            help="limit the memory of the command of each stack, in a systemd scope if available or of each of its "
+            "processes otherwise, unless set in its configuration",
+        )
+        parser_foreach.add_argument(
+            "command",
+            nargs=argparse.REMAINDER,
+            help='command to execute after a "--" delimiter',
+        )
+        return
+
+    if subcommand == "history":
+        parser_history = subparsers.add_parser("history", help="show the latest executions of foreach commands")
+        parser_history.set_defaults(func=show_history)
+        parser_history.add_argument(
+            "--stack",
+            dest="stack_pattern",
+            metavar="PATTERN",
+            help="only show the executions for stacks matching this glob pattern, e.g. 'account0/prod/*'",
+        )
+        parser_history.add_argument(
+            "--command",
+            dest="command_pattern",
+            metavar="PATTERN",
+            help="only show the executions of commands matching this glob pattern, e.g. '*plan*'",
+        )
+        parser_history.add_argument(
+            "-n", "--limit", type=int, default=20, help="show this number of executions at most. Defaults to 20."
+        )
+        return
+
+    if subcommand == "index":
+        parser_index = subparsers.add_parser("index", help="update and show the index of the stacks of the project")
+        parser_index.set_defaults(func=show_stack_index)
+        parser_index.add_argument(
+            "--rebuild", action="store_true", help="index all stack configurations again instead of only the changed ones"
+        )
+        return
+
+    if subcommand == "daemon":
+        parser_daemon = subparsers.add_parser("daemon", help="keep tfwrapper warm to speed up its next executions")
+        parser_daemon.set_defaults(func=run_daemon)
+        parser_daemon.add_argument(
+            "--idle-timeout",
+            type=int,
+            default=3600,
+            help="Stop after this number of seconds without any execution, 0 to never stop. Defaults to 3600.",
+        )
+        return
+
+    parser_terraform = subparsers.add_parser(subcommand, help="terraform {}".format(subcommand))
+    parser_terraform.set_defaults(func=TERRAFORM_SUBCOMMANDS[subcommand])
+    if subcommand == "apply":
+        parser_terraform.add_argument(
+            "-u",
+            "--unsafe",
+            help="Do not force plan and human interaction before apply.",
+            action="store_true",
+            default=False,
+        )
+    if subcommand in ("apply", "plan"):
+        parser_terraform.add_argument(
+            "-l",
+            "--pipe-plan",
+            action="store_true",
+            default=False,
+            help=("Pipe plan output to the command set in config or passed in --pipe-plan-command argument (cat by default)."),
+        )
+        parser_terraform.add_argument(
+            "--pipe-plan-command",
+            action="store",
+            nargs="?",
+            help="Pipe plan output to the command of your choice set as argument inline value.",
+        )
+    tf_params = parser_terraform.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help)
+    if subcommand != "force-unlock":
+        tf_params.completer = terraform_completer
+    if subcommand == "init":
+        parser_terraform.add_argument(
+            "--backend",
+            choices=["true", "false"],
+            default="true",
+            help="configure the backend for this configuration.",
+        )
+
+
+@functools.cache
+def get_parser(subcommand=None):
+    """Build the command line arguments parser, once per process.
+
+    Only the given subcommand parser is added if any, otherwise all of them are.
+    """
     confdir_help = "Configuration directory. Used to detect the project root. Defaults to conf."
     target_help = "Target {}. Autodetected if none is provided."
-    tf_params_help = 'Any Terraform parameters after a "--" delimiter'
 
     # argparse
     parser = argparse.ArgumentParser(
         prog="tfwrapper",
         description="Terraform wrapper.",
-        argument_default=argparse.SUPPRESS,
     )
-    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output.")
+    parser.add_argument("-d", "--debug", action="store_true", default=False, help="Enable debug output.")
     parser.add_argument("-V", "--version", action="store_true", default=False, help="Show tfwrapper version.")
-    parser.add_argument("-c", "--confdir", help=confdir_help)
-    parser.add_argument("-a", "--account", help=target_help.format("account"), nargs="?")
-    parser.add_argument("-e", "--environment", help=target_help.format("environment"), nargs="?")
-    parser.add_argument("-r", "--region", help=target_help.format("region"), nargs="?")
-    parser.add_argument("-s", "--stack", help=target_help.format("stack"), nargs="?")
+    parser.add_argument("-c", "--confdir", help=confdir_help, default=DEFAULT_CONF_DIRNAME)
+    parser.add_argument("-a", "--account", help=target_help.format("account"), nargs="?").completer = stack_completer
+    parser.add_argument("-e", "--environment", help=target_help.format("environment"), nargs="?").completer = stack_completer
+    parser.add_argument("-r", "--region", help=target_help.format("region"), nargs="?").completer = stack_completer
+    parser.add_argument("-s", "--stack", help=target_help.format("stack"), nargs="?").completer = stack_completer
+    # defaults depending on the environment are resolved at parse time as the parser is reused
     parser.add_argument("--http-cache-dir", help="HTTP(S) requests cache directory.")
+    parser.add_argument("-p", "--plugin-cache-dir", help="Plugins cache directory.")
+    parser.add_argument(
+        "--timings", action="store_true", default=False, help="Print the time spent in each phase of the execution at exit."
+    )
     parser.add_argument(
-        "-p",
-        "--plugin-cache-dir",
-        help="Plugins cache directory.",
-        default=os.environ.get("TF_PLUGIN_CACHE_DIR", "{}/.terraform.d/plugin-cache".format(HOME_DIR)),
+        "--timings-file",
+        metavar="FILE",
+        help="Write the time spent in each phase of the execution to FILE as a JSON trace, see chrome://tracing.",
     )
 
     subparsers = parser.add_subparsers(dest="subcommand", help="subcommands")
+    for name in [subcommand] if subcommand else SUBCOMMANDS:
+        add_subcommand_parser(subparsers, name)
 
-    parser_apply = subparsers.add_parser("apply", help="terraform apply")
-    parser_apply.set_defaults(func=terraform_apply)
-    parser_apply.add_argument(
-        "-u",
-        "--unsafe",
-        help="Do not force plan and human interaction before apply.",
-        action="store_true",
-        default=False,
-    )
-    parser_apply.add_argument(
-        "-l",
-        "--pipe-plan",
-        action="store_true",
-        default=False,
-        help=("Pipe plan output to the command set in config or passed in --pipe-plan-command argument (cat by default)."),
-    )
-    parser_apply.add_argument(
-        "--pipe-plan-command",
-        action="store",
-        nargs="?",
-        help="Pipe plan output to the command of your choice set as argument inline value.",
-    )
-    parser_apply.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_console = subparsers.add_parser("console", help="terraform console")
-    parser_console.set_defaults(func=terraform_console)
-    parser_console.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_destroy = subparsers.add_parser("destroy", help="terraform destroy")
-    parser_destroy.set_defaults(func=terraform_destroy)
-    parser_destroy.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_fmt = subparsers.add_parser("fmt", help="terraform fmt")
-    parser_fmt.set_defaults(func=terraform_fmt)
-    parser_fmt.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_force_unlock = subparsers.add_parser("force-unlock", help="terraform force-unlock")
-    parser_force_unlock.set_defaults(func=terraform_force_unlock)
-    parser_force_unlock.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help)
-
-    parser_get = subparsers.add_parser("get", help="terraform get")
-    parser_get.set_defaults(func=terraform_get)
-    parser_get.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_graph = subparsers.add_parser("graph", help="terraform graph")
-    parser_graph.set_defaults(func=terraform_graph)
-    parser_graph.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_import = subparsers.add_parser("import", help="terraform import")
-    parser_import.set_defaults(func=terraform_import)
-    parser_import.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_init = subparsers.add_parser("init", help="terraform init")
-    parser_init.set_defaults(func=terraform_init)
-    parser_init.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-    parser_init.add_argument(
-        "--backend",
-        choices=["true", "false"],
-        default="true",
-        help="configure the backend for this configuration.",
-    )
+    return parser
 
-    parser_output = subparsers.add_parser("output", help="terraform output")
-    parser_output.set_defaults(func=terraform_output)
-    parser_output.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_plan = subparsers.add_parser("plan", help="terraform plan")
-    parser_plan.set_defaults(func=terraform_plan)
-    parser_plan.add_argument(
-        "-l",
-        "--pipe-plan",
-        action="store_true",
-        default=False,
-        help=("Pipe plan output to the command set in config or passed in --pipe-plan-command argument (cat by default)."),
-    )
-    parser_plan.add_argument(
-        "--pipe-plan-command",
-        action="store",
-        nargs="?",
-        help="Pipe plan output to the command of your choice set as argument inline value.",
-    )
-    parser_plan.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_providers = subparsers.add_parser("providers", help="terraform providers")
-    parser_providers.set_defaults(func=terraform_providers)
-    parser_providers.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_refresh = subparsers.add_parser("refresh", help="terraform refresh")
-    parser_refresh.set_defaults(func=terraform_refresh)
-    parser_refresh.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_show = subparsers.add_parser("show", help="terraform show")
-    parser_show.set_defaults(func=terraform_show)
-    parser_show.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_state = subparsers.add_parser("state", help="terraform state")
-    parser_state.set_defaults(func=terraform_state)
-    parser_state.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_taint = subparsers.add_parser("taint", help="terraform taint")
-    parser_taint.set_defaults(func=terraform_taint)
-    parser_taint.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_untaint = subparsers.add_parser("untaint", help="terraform untaint")
-    parser_untaint.set_defaults(func=terraform_untaint)
-    parser_untaint.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_validate = subparsers.add_parser("validate", help="terraform validate")
-    parser_validate.set_defaults(func=terraform_validate)
-    parser_validate.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_version = subparsers.add_parser("version", help="terraform version")
-    parser_version.set_defaults(func=terraform_version)
-    parser_version.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_workspace = subparsers.add_parser("workspace", help="terraform workspace")
-    parser_workspace.set_defaults(func=terraform_workspace)
-    parser_workspace.add_argument("tf_params", nargs=argparse.REMAINDER, help=tf_params_help).completer = terraform_completer
-
-    parser_bootstrap = subparsers.add_parser("bootstrap", help="bootstrap configuration")
-    parser_bootstrap.set_defaults(func=bootstrap)
-    parser_bootstrap.add_argument("template", nargs="?", help="template to use during bootstrap", default=None)
-
-    parser_foreach = subparsers.add_parser("foreach", help="execute command for each stack")
-    parser_foreach.set_defaults(func=foreach)
-    parser_foreach.add_argument("-S", "--shell", dest="shell", action="store_true", help="execute command in a shell")
-    parser_foreach.add_argument(
-        "command",
-        nargs=argparse.REMAINDER,
-        help='command to execute after a "--" delimiter',
-    )
 
-    argcomplete.autocomplete(parser, exit_method=sys.exit)
-    parsed_args = parser.parse_args(args)
+def parse_args(args):
+    """Parse command line arguments.
+
+    Also setup the log level and the HTTP cache dir from them.
+    """
+    parsed_args = get_parser(find_subcommand(args)).parse_args(args)
+
+    logger.setLevel(logging.DEBUG if parsed_args.debug else logging.INFO)
 
-    if hasattr(parsed_args, "version") and parsed_args.version:
-        print("tfwrapper v{}".format(__version__), file=sys.stderr)
+    if parsed_args.version:
+        print("tfwrapper v{}".format(get_version()), file=sys.stderr)
         raise SystemExit(0)
 
     if not hasattr(parsed_args, "func"):
-        parser.print_help(file=sys.stderr)
+        get_parser().print_help(file=sys.stderr)
         raise SystemExit(0)
 
-    if parsed_args.func == foreach:
+    if parsed_args.http_cache_dir is None:
+        parsed_args.http_cache_dir = DEFAULT_HTTP_CACHE_DIR
+    if parsed_args.plugin_cache_dir is None:
+        parsed_args.plugin_cache_dir = os.environ.get("TF_PLUGIN_CACHE_DIR", "{}/.terraform.d/plugin-cache".format(HOME_DIR))
+
+    # configure requests session's cache directory
+    CachedRequestsSession.set_cache_dir(parsed_args.http_cache_dir)
+
+    if parsed_args.func == run_foreach:
         if len(parsed_args.command) > 0 and parsed_args.command[0] == "--":
             parsed_args.command = parsed_args.command[1:]
         if len(parsed_args.command) < 1:
             error("foreach: error: a command is required")
         if parsed_args.shell and len(parsed_args.command) > 1:
             error("foreach: error: -S/--shell must be followed by a single argument (hint: use quotes)")
+        if parsed_args.jobs != "auto":
+            if not str(parsed_args.jobs).isdigit() or int(parsed_args.jobs) < 1:
+                error("foreach: error: -j/--jobs must be a positive number or auto")
+            parsed_args.jobs = int(parsed_args.jobs)
+        if parsed_args.shard is not None:
+            m = re.match(r"^(\d+)/(\d+)$", parsed_args.shard)
+            if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+                error("foreach: error: --shard must be I/N with 1 <= I <= N")
+            parsed_args.shard = (int(m.group(1)), int(m.group(2)))
+        for limit in FOREACH_LIMITS:
+            if getattr(parsed_args, limit) < 0:
+                error("foreach: error: --{} must be a positive number or 0".format(limit.replace("_", "-")))
         parsed_args.executable = os.environ.get("SHELL", None) if parsed_args.shell else None
 
     return parsed_args
@@ -1358,24 +2029,114 @@ def main(argv=None):
     Note: there are two execution paths:
     - the nominal one is standard execution where arguments are normally passed in sys.argv.
     - the alternative one is auto-completion execution where _ARGCOMPLETE, COMP_LINE and COMP_POINT
-      environment variables are defined, and arguments are passed in COMP_LINE.
+      environment variables are defined, and arguments are passed in COMP_LINE. It only relies on the
+      parser and on data precomputed by previous executions, see complete().
     """
-    # parse base flags on their own to:
-    # - activate debug log level early
-    # - setup HTTP cache before downloading terraform index and binaries needed for completion
-    args = parse_base_args(argv or sys.argv[1:])
-    wrapper_config = deepcopy(vars(args))
+    if "_ARGCOMPLETE" in os.environ:
+        complete()
+
+    setup_logging()
+
+    # parse all args, once, to activate debug log level early and setup HTTP cache before
+    # downloading terraform index and binaries
+    args = parse_args(argv or sys.argv[1:])
+
+    if args.timings or args.timings_file:
+        timings.enable()
+    try:
+        # let a running daemon prepare the execution if any, otherwise do it ourselves
+        wrapper_config = None
+        if args.subcommand != "daemon" and "TFWRAPPER_NO_DAEMON" not in os.environ:
+            from . import daemon
+
+            wrapper_config = daemon.prepare_remotely(args.confdir, argv or sys.argv[1:])
+        if wrapper_config is None:
+            wrapper_config = prepare(args)
+
+        # call subcommand
+        returncode = args.func(wrapper_config)
+    finally:
+        if timings.is_enabled():
+            if args.timings:
+                timings.print_report()
+            if args.timings_file:
+                timings.write_trace(args.timings_file)
+                logger.info("Wrote timings trace to {}".format(args.timings_file))
+            timings.disable()
+
+    if returncode is not None:
+        sys.exit(returncode)
+    else:
+        sys.exit(RC_OK)
+
+
+def load_context_cache(rootdir):
+    """Load the contexts resolved by previous executions in the project, if any."""
+    context_cache = load_pickle_file(os.path.join(rootdir, ".run", CONTEXT_CACHE_FILENAME))
+    return context_cache if isinstance(context_cache, dict) else {}
+
+
+def save_context_cache(rootdir, context_cache):
+    """Store the resolved contexts in the .run directory, atomically as it is shared by concurrent executions."""
+    context_cache_file = os.path.join(rootdir, ".run", CONTEXT_CACHE_FILENAME)
+    try:
+        save_pickle_file(context_cache_file, context_cache)
+    except OSError as e:
+        logger.debug("Failed to write context cache file {}: {}".format(context_cache_file, e))
+        return
+    logger.debug("Wrote context cache file: {}".format(context_cache_file))
 
-    # locate config and root dirs
-    parents_count = detect_config_dir(wrapper_config)
+
+def get_context_environ_digest():
+    """Get a digest of the environment variables the resolved context depends on."""
+    environ = sorted(
+        (name, value)
+        for name, value in os.environ.items()
+        if name in CONTEXT_CACHE_ENV_VARS or name.startswith(CONTEXT_CACHE_ENV_PREFIXES)
+    )
+    return hashlib.sha256(json.dumps(environ).encode()).hexdigest()
+
+
+def resolve_context(wrapper_config, parents_count, resolve_tool, use_cache=True):
+    """Detect the stack, load the wrapper, state and stack configurations and select the tool if resolve_tool.
+
+    The resolved context is cached in the .run directory, per working directory, stack arguments and
+    CONTEXT_CACHE_ENV_* environment variables, and reused as long as the configuration files and the tool binary it
+    was resolved from are unchanged, and for at most CONTEXT_CACHE_TOOL_TTL seconds if the tool was selected from a
+    partial version constraint.
+    Without use_cache, the context is neither reused nor cached, nor is the completion data saved.
+    Updates the dict passed as a parameter, including the path to the selected tool binary as "tool_bin_path".
+    Returns the stack config and the path to its file.
+    """
+    key = (
+        os.getcwd(),
+        get_context_environ_digest(),
+        *(wrapper_config[k] for k in ("confdir", "account", "environment", "region", "stack")),
+        resolve_tool,
+    )
+    hit = False
+    if use_cache:
+        with timings.phase("context cache") as record:
+            context_cache = load_context_cache(wrapper_config["rootdir"])
+            context = context_cache.get(key)
+            hit = (
+                context is not None
+                and get_files_signature(context["inputs"]) == context["inputs"]
+                and (context.get("tool_expires_at") is None or time.time() < context["tool_expires_at"])
+            )
+            if record is not None:
+                record["cache"] = "hit" if hit else "miss"
+    if hit:
+        logger.debug("Reusing context resolved by a previous execution")
+        wrapper_config.update(context["wrapper_config"])
+        wrapper_config["tool_bin_path"] = context["tool_bin_path"]
+        return context["stack_config"], context["stack_config_file"]
 
     # detect if we are in a stack
     detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    # load wrapper config
-    load_wrapper_config(wrapper_config)
-
-    # load stack config
+    # stat input files before reading them, so that a change while reading them invalidates the context, and
+    # include tfwrapper itself so that upgrading it invalidates contexts too
     stack_config_file = get_stack_config_path(
         wrapper_config["confdir"],
         wrapper_config["account"],
@@ -1383,32 +2144,118 @@ def main(argv=None):
         wrapper_config["region"],
         wrapper_config["stack"],
     )
+    inputs = get_files_signature(
+        [
+            os.path.abspath(os.path.join(wrapper_config["confdir"], "config.yml")),
+            os.path.abspath(os.path.join(wrapper_config["confdir"], "state.yml")),
+            os.path.abspath(stack_config_file),
+            __file__,
+        ]
+    )
+
+    # load wrapper config
+    load_wrapper_config(wrapper_config)
+
+    # load stack config
     stack_config = load_stack_config_from_file(stack_config_file)
 
-    # parse all args
-    args = parse_args(argv or sys.argv[1:])
+    tool_bin_path = None
+    tool_expires_at = None
+    if resolve_tool:
+        from semver import Version
 
-    if args.func != foreach:
         # select tool version for the stack if selected, with a fallback on v1.0
         tool_version = (tf_config := stack_config.get(TOOL_TERRAFORM, {})).get(
             "version", tf_config.get("vars", {}).get("version", "1.0")
         )
-        if (v := Version.parse(tool_version, optional_minor_and_patch=True)).major < 1 or (v.major == 1 and v.minor < 6):
-            legacy_tool = True
-        else:
-            legacy_tool = stack_config.get("terraform", {}).get("legacy", False)
+        with timings.phase("version resolution", tool_version):
+            if (v := Version.parse(tool_version, optional_minor_and_patch=True)).major < 1 or (v.major == 1 and v.minor < 6):
+                legacy_tool = True
+            else:
+                legacy_tool = stack_config.get("terraform", {}).get("legacy", False)
 
-        if not legacy_tool:
-            download_tool_from_github(
-                "opentofu/opentofu",
-                tool_version,
-                TOOL_OPENTOFU,
-            )
-        else:
-            select_terraform_version(tool_version)
+            if not legacy_tool:
+                tool_bin_path = download_tool_from_github(
+                    "opentofu/opentofu",
+                    tool_version,
+                    TOOL_OPENTOFU,
+                )
+            else:
+                tool_bin_path = select_terraform_version(tool_version)
+
+        # a newer patch or minor release may match a partial version constraint later on
+        if tool_version.count(".") < 2:
+            tool_expires_at = time.time() + CONTEXT_CACHE_TOOL_TTL
+        if use_cache:
+            save_completion_data(wrapper_config["rootdir"], tool_bin_path)
+        if tool_bin_path:
+            inputs.update(get_files_signature([tool_bin_path]))
+    wrapper_config["tool_bin_path"] = tool_bin_path
+
+    if not use_cache:
+        return stack_config, stack_config_file
+    context_cache.pop(key, None)
+    context_cache[key] = {
+        "inputs": inputs,
+        "wrapper_config": {k: wrapper_config[k] for k in CONTEXT_KEYS if k in wrapper_config},
+        "stack_config": stack_config,
+        "stack_config_file": stack_config_file,
+        "tool_bin_path": tool_bin_path,
+        "tool_expires_at": tool_expires_at,
+    }
+    # keep the most recently resolved contexts only
+    for stale_key in list(context_cache)[:-CONTEXT_CACHE_MAX_ENTRIES]:
+        del context_cache[stale_key]
+    save_context_cache(wrapper_config["rootdir"], context_cache)
+
+    return stack_config, stack_config_file
+
+
+def is_backend_required(args):
+    """Tell whether a subcommand requires the state backend and the stack credentials, from its parsed arguments."""
+    if (args.subcommand == "init" and args.backend == "false") or args.subcommand in (
+        "fmt",
+        "get",
+        "test",
+        "validate",
+        "version",
+    ):
+        return False
 
-    # convert args to dict
-    wrapper_config.update(vars(args))
+    # Only "lock" and "mirror" sub-commands of "providers" sub-command do not require state access
+    if (
+        args.subcommand == "providers"
+        and (tf_params := getattr(args, "tf_params", None))
+        and (
+            (len(tf_params) > 0 and tf_params[0] in ("lock", "mirror"))
+            or (len(tf_params) > 1 and tf_params[0] == "--" and tf_params[1] in ("lock", "mirror"))
+        )
+    ):
+        return False
+    return True
+
+
+def prepare(args, environ=None, interactive=True):
+    """Prepare the execution of a subcommand from its parsed arguments.
+
+    Detect and load configurations, select the tool and acquire credentials. The environment of the tool is set in
+    os.environ, unless another environ dict is given.
+    Unless interactive, InteractionRequired is raised instead of prompting the user, e.g. for an MFA code.
+    Returns the wrapper config to pass to the subcommand function.
+    """
+    environ = os.environ if environ is None else environ
+    wrapper_config = deepcopy(vars(args))
+
+    # locate config and root dirs
+    with timings.phase("config detection"):
+        parents_count = detect_config_dir(wrapper_config)
+    if args.subcommand in ("daemon", "history", "index"):
+        return wrapper_config
+
+    # detect stack, load configurations and select tool, or reuse them from a previous execution
+    stack_config, stack_config_file = resolve_context(
+        wrapper_config, parents_count, resolve_tool=args.func != run_foreach, use_cache=not getattr(args, "foreach_native", False)
+    )
 
     # error if stack folder or config are missing for commands requiring them
     wrapper_commands_not_requiring_stack_config = (
@@ -1477,28 +2324,7 @@ def main(argv=None):
         # get sessions
         state_backend_name = stack_config.get("state_configuration_name", None)
 
-        load_backend = wrapper_config["backend"] = not (
-            (args.subcommand == "init" and args.backend == "false")
-            or args.subcommand
-            in (
-                "fmt",
-                "get",
-                "test",
-                "validate",
-                "version",
-            )
-        )
-
-        # Only "lock" and "mirror" sub-commands of "providers" sub-command do not require state access
-        if (
-            args.subcommand == "providers"
-            and (tf_params := wrapper_config.get("tf_params"))
-            and (
-                (len(tf_params) > 0 and tf_params[0] in ("lock", "mirror"))
-                or (len(tf_params) > 1 and tf_params[0] == "--" and tf_params[1] in ("lock", "mirror"))
-            )
-        ):
-            load_backend = False
+        load_backend = wrapper_config["backend"] = is_backend_required(args)
 
         if load_backend and wrapper_config["state"]:
             try:
@@ -1520,18 +2346,20 @@ def main(argv=None):
                 state_config.get("state_profile"),
                 state_backend_type,
                 state_config,
+                environ,
+                interactive,
             )
 
             if state_backend_type == "aws":
                 # set AWS state centralization environment variables
                 state_credentials = state_session.get_credentials().get_frozen_credentials()
-                os.environ["AWS_ACCESS_KEY_ID"] = state_credentials.access_key
-                os.environ["AWS_SECRET_ACCESS_KEY"] = state_credentials.secret_key
+                environ["AWS_ACCESS_KEY_ID"] = state_credentials.access_key
+                environ["AWS_SECRET_ACCESS_KEY"] = state_credentials.secret_key
                 if state_credentials.token:
-                    os.environ["AWS_SESSION_TOKEN"] = state_credentials.token
+                    environ["AWS_SESSION_TOKEN"] = state_credentials.token
                 logger.info("AWS state backend initialized.")
             elif state_backend_type == "azure":
-                set_terraform_vars(state_session)
+                set_terraform_vars(state_session, environ)
                 logger.info("Azure state backend initialized.")
             else:
                 logger.info(
@@ -1554,6 +2382,8 @@ def main(argv=None):
                 stack_config["aws"]["general"]["region"],
                 stack_config["aws"]["credentials"]["profile"],
                 "aws",
+                environ=environ,
+                interactive=interactive,
             )
 
             # set terraform environment variables for AWS Stack
@@ -1571,37 +2401,7 @@ def main(argv=None):
                 # We assume that the user is using the same identity for all projects.
                 # GKE access, if required, is configured using the same credentials with per-stack kuebconfig files.
 
-                logger.info("Looking for GCP user Application Default Credentials.")
-                try:
-                    command = [
-                        "gcloud",
-                        "auth",
-                        "application-default",
-                        "print-access-token",
-                    ]
-                    logger.debug("Executing `{}`".format(" ".join(command)))
-                    subprocess.run(
-                        command,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        check=True,
-                    )
-                except FileNotFoundError:
-                    logger.error("Please make sure that gcloud is available on this system.")
-                    sys.exit(RC_KO)
-                except subprocess.CalledProcessError as e:
-                    logger.error(
-                        "Could not find valid user Application Default Credentials, the following command failed:\n\n"
-                        "    {}\n\n"
-                        "with the following error:\n\n"
-                        "{}\n"
-                        "You may need to run:\n\n"
-                        "    gcloud auth application-default login".format(
-                            " ".join(command), textwrap.indent(e.output.decode(), "    ")
-                        )
-                    )
-                    sys.exit(RC_KO)
-                logger.info("Found GCP user Application Default Credentials.")
+                adc_check_user_credentials()
 
                 if "gke" in stack_config["gcp"]:
                     project = stack_config["gcp"]["general"]["project"]
@@ -1674,7 +2474,9 @@ def main(argv=None):
                     logger.info("Using Azure user mode")
 
                     try:
-                        azure_tf_vars = azure.set_context(wrapper_config, subscription_id, directory_id, context_name)
+                        azure_tf_vars = azure.set_context(
+                            wrapper_config, subscription_id, directory_id, context_name, environ=environ
+                        )
                         terraform_vars.update(azure_tf_vars)
                     except azure.AzureError as e:
                         logger.error(f"Error while configuring Azure context: {e.message}")
@@ -1696,7 +2498,9 @@ def main(argv=None):
                             # Backwards compatibility
                             profile = stack_config["azure"]["credential"]["profile"]
                     try:
-                        azure_tf_vars = azure.set_context(wrapper_config, subscription_id, directory_id, context_name, profile)
+                        azure_tf_vars = azure.set_context(
+                            wrapper_config, subscription_id, directory_id, context_name, profile, environ=environ
+                        )
                         terraform_vars.update(azure_tf_vars)
                     except azure.AzureError as e:
                         logger.error(f"Error while configuring Azure context: {e.message}")
@@ -1708,8 +2512,8 @@ def main(argv=None):
                     )
                     sys.exit(RC_KO)
 
-        set_terraform_vars(terraform_vars)
-        os.environ["TF_PLUGIN_CACHE_DIR"] = wrapper_config["plugin_cache_dir"]
+        set_terraform_vars(terraform_vars, environ)
+        environ["TF_PLUGIN_CACHE_DIR"] = wrapper_config["plugin_cache_dir"]
 
     # do we need a custom provider ?
     if args.subcommand in ["init", "bootstrap"]:
@@ -1721,13 +2525,7 @@ def main(argv=None):
                 # config should be a hash of version / extension
                 download_tool_from_github(provider, config["version"], TOOL_PROVIDER, extension=config["extension"])
 
-    # call subcommand
-    returncode = args.func(wrapper_config)
-
-    if returncode is not None:
-        sys.exit(returncode)
-    else:
-        sys.exit(RC_OK)
+    return wrapper_config
 
 
 if __name__ == "__main__":
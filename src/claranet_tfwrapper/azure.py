@@ -3,13 +3,19 @@
 import logging
 import os
 import subprocess
+import time
 
-import yaml
+from . import timings
+from .utils import load_yaml_file
 
 SP_CREDENTIALS_FILE = os.path.expanduser("~/.azurerm/config.yml")
 
 logger = logging.getLogger()
 
+# Azure CLI commands which succeeded in this process are not launched again before this delay, in seconds
+CLI_COMMAND_CACHE_TTL = 300
+_cli_commands_succeeded = {}
+
 
 class AzureError(Exception):
     """Azure specific error class."""
@@ -24,20 +30,19 @@ def get_sp_profile(profile_name):
     """Retrieve Service Principal credentials from name."""
     logger.debug(f"Reading {SP_CREDENTIALS_FILE} to fetch {profile_name} credentials.")
 
-    with open(SP_CREDENTIALS_FILE, "r") as f:
-        load_azure_config = yaml.safe_load(f)
-        if load_azure_config is None:
-            raise AzureError(f"Please configure your {SP_CREDENTIALS_FILE} configuration file")
-        if profile_name not in load_azure_config.keys():
-            raise AzureError(f'Cannot find "{profile_name}" profile in your {SP_CREDENTIALS_FILE} configuration file')
-        return (
-            load_azure_config[profile_name]["tenant_id"],
-            load_azure_config[profile_name]["client_id"],
-            load_azure_config[profile_name]["client_secret"],
-        )
+    load_azure_config = load_yaml_file(SP_CREDENTIALS_FILE, persistent=False)
+    if load_azure_config is None:
+        raise AzureError(f"Please configure your {SP_CREDENTIALS_FILE} configuration file")
+    if profile_name not in load_azure_config.keys():
+        raise AzureError(f'Cannot find "{profile_name}" profile in your {SP_CREDENTIALS_FILE} configuration file')
+    return (
+        load_azure_config[profile_name]["tenant_id"],
+        load_azure_config[profile_name]["client_id"],
+        load_azure_config[profile_name]["client_secret"],
+    )
 
 
-def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_profile=None, backend_context=False):
+def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_profile=None, backend_context=False, environ=None):
     """Configure context and check credentials.
 
     This function configures environment variables needed for the Azure context.
@@ -58,6 +63,8 @@ def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_pro
         Azure Service Principal profile name to use to configure credentials
     backend_context : bool
         True if context has to be set/check for a backend configuration
+    environ : dict
+        Environment variables to read and set, os.environ by default
 
     Returns
     -------
@@ -67,10 +74,11 @@ def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_pro
     """
     logger.debug(f"Configuring azurerm {'backend' if backend_context else 'stack'} context.")
 
+    environ = os.environ if environ is None else environ
     tf_vars = {}
     backend_session = None
     if backend_context:
-        backend_session = os.environ.get("ARM_ACCESS_KEY", None) or os.environ.get("ARM_SAS_TOKEN", None)
+        backend_session = environ.get("ARM_ACCESS_KEY", None) or environ.get("ARM_SAS_TOKEN", None)
         if backend_session:
             logger.info("'ARM_SAS_TOKEN' or 'ARM_ACCESS_KEY' already set, don't try to get a new session.")
             logger.debug("Session token found for backend: {}".format(backend_session))
@@ -92,9 +100,9 @@ def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_pro
         suffix = f"_{context_name}" if context_name else ""
         env_var_name = f"AZURE_CONFIG_DIR{suffix.upper()}"
         az_config_dir = os.path.join(wrapper_config["rootdir"], ".run", f"azure{suffix}")
-        if env_var_name not in os.environ:
+        if env_var_name not in environ:
             logger.debug(f"Exporting `{env_var_name}` to `{az_config_dir}` directory")
-            os.environ[env_var_name] = az_config_dir
+            environ[env_var_name] = az_config_dir
 
     vars_prefix = f"{context_name}_" if context_name else ""
 
@@ -152,17 +160,30 @@ def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_pro
             raise AzureError(f"Cannot log in with service principal {sp_profile}: {e.output}")
 
         if not backend_context and not context_name:
-            os.environ["ARM_CLIENT_ID"] = client_id
-            os.environ["ARM_CLIENT_SECRET"] = client_secret
-            os.environ["ARM_TENANT_ID"] = sp_tenant_id
+            environ["ARM_CLIENT_ID"] = client_id
+            environ["ARM_CLIENT_SECRET"] = client_secret
+            environ["ARM_TENANT_ID"] = sp_tenant_id
 
         tf_vars.update({f"{vars_prefix}azure_client_id": client_id, f"{vars_prefix}azure_client_secret": client_secret})
 
     return tf_vars
 
 
+def clear_cli_cache():
+    """Forget the Azure CLI commands which succeeded in this process."""
+    _cli_commands_succeeded.clear()
+
+
 def _launch_cli_command(command, az_config_dir=None):
-    """Launch an Azure CLI command with a given AZURE_CONFIG_DIR context."""
+    """Launch an Azure CLI command with a given AZURE_CONFIG_DIR context.
+
+    The command is skipped if it already succeeded with the same context in this process less than
+    CLI_COMMAND_CACHE_TTL seconds ago.
+    """
+    key = (tuple(command), az_config_dir)
+    if time.time() - _cli_commands_succeeded.get(key, 0) < CLI_COMMAND_CACHE_TTL:
+        logger.debug(f'Command "{command[0]} {command[1]}" already succeeded recently with this context, skipping')
+        return
     if az_config_dir:
         logger.debug(f'Launching command "{" ".join(command)}" with AZURE_CONFIG_DIR="{az_config_dir}" context')
     else:
@@ -170,4 +191,8 @@ def _launch_cli_command(command, az_config_dir=None):
     env = os.environ.copy()
     if az_config_dir:
         env["AZURE_CONFIG_DIR"] = az_config_dir
-    subprocess.run(command, check=True, env=env, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    # only the subcommand is recorded in timings, as arguments may contain secrets, and the command cannot prompt as
+    # its output is not displayed
+    with timings.phase("azure cli", " ".join(command[:3])):
+        subprocess.run(command, check=True, env=env, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    _cli_commands_succeeded[key] = time.time()
@@ -0,0 +1,178 @@
+"""Number of foreach commands to run at a time, chosen from the available resources and adapted while they run.
+
+The initial number of jobs is bounded by the CPUs and the memory available to tfwrapper, taking cgroup limits into
+account. It is then adjusted with additive increase and multiplicative decrease: one more job after each round of
+commands, half as many when memory runs low, when commands hit API rate limits or when the throughput drops.
+The throughput is measured in expected seconds of work done per second, from the durations estimated for the commands,
+so that rounds of short and long commands can be compared.
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger()
+
+CGROUP_DIR = "/sys/fs/cgroup"
+MEMINFO_FILE = "/proc/meminfo"
+# memory used by a command when no memory limit is set, in MiB: Terraform with large providers uses 1 to 2 GiB
+DEFAULT_MEMORY_PER_JOB = 1536
+# commands run at most this number of times the CPUs at a time, as they mostly wait for APIs
+MAX_JOBS_PER_CPU = 2
+# ratio of the previous throughput below which the throughput is considered to drop, both in expected seconds of work
+# done per second
+THROUGHPUT_DROP_RATIO = 0.8
+# minimum delay between two decreases, in seconds, as commands started before a decrease keep reporting the same issue
+DECREASE_INTERVAL = 10.0
+# output of commands hitting API rate limits, from AWS, Azure, GCP and HTTP
+RATE_LIMIT_REGEX = re.compile(
+    rb"Throttling|RequestLimitExceeded|Rate exceeded|TooManyRequests|Too Many Requests|rateLimitExceeded|"
+    rb"RESOURCE_EXHAUSTED|StatusCode=429|status code: 429"
+)
+
+
+def read_file(path):
+    """Read the stripped content of a small file, or None if it cannot be read."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_cpu_count():
+    """Get the number of CPUs this process can use, limited by its affinity and its cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 "quota period", or cgroup v1 quota and period in separate files
+    quota = read_file(os.path.join(CGROUP_DIR, "cpu.max"))
+    if quota is not None:
+        quota, _, period = quota.partition(" ")
+    else:
+        quota = read_file(os.path.join(CGROUP_DIR, "cpu", "cpu.cfs_quota_us"))
+        period = read_file(os.path.join(CGROUP_DIR, "cpu", "cpu.cfs_period_us"))
+    try:
+        if int(quota) > 0 and int(period) > 0:
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (TypeError, ValueError):
+        pass
+    return max(cpus, 1)
+
+
+def get_available_memory():
+    """Get the memory available to this process in MiB, limited by its cgroup memory limit, or None if unknown."""
+    available = []
+    for line in (read_file(MEMINFO_FILE) or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            available.append(int(line.split()[1]) // 1024)
+    # cgroup v2, or cgroup v1, limit and usage in bytes
+    for limit_file, usage_file in (
+        ("memory.max", "memory.current"),
+        (os.path.join("memory", "memory.limit_in_bytes"), os.path.join("memory", "memory.usage_in_bytes")),
+    ):
+        limit = read_file(os.path.join(CGROUP_DIR, limit_file))
+        usage = read_file(os.path.join(CGROUP_DIR, usage_file))
+        if limit is not None and limit.isdigit() and usage is not None and usage.isdigit():
+            # cgroup v1 reports no limit as a huge number
+            if int(limit) < 1 << 60:
+                available.append(max(int(limit) - int(usage), 0) // (1024 * 1024))
+            break
+    return min(available) if available else None
+
+
+class AdaptiveConcurrency:
+    """Number of commands to run at a time, adjusted from the commands which are done and their output."""
+
+    def __init__(self, limit, maximum, memory_per_job):
+        """Start running limit commands at a time, up to maximum, each using about memory_per_job MiB."""
+        self.limit = limit
+        self.maximum = maximum
+        self.memory_per_job = memory_per_job
+        self._lock = threading.Lock()
+        self._last_decrease = None
+        # throughput of the previous round, None if unknown
+        self._throughput = None
+        self._start_window()
+
+    @classmethod
+    def from_resources(cls, memory_per_job=None):
+        """Choose the number of commands to run at a time from the CPUs and the memory available.
+
+        Starts with as many commands as CPUs, and allows up to MAX_JOBS_PER_CPU times more, as long as they fit in memory.
+        """
+        memory_per_job = memory_per_job or DEFAULT_MEMORY_PER_JOB
+        cpus = get_cpu_count()
+        maximum = cpus * MAX_JOBS_PER_CPU
+        memory = get_available_memory()
+        if memory is not None:
+            maximum = min(maximum, memory // memory_per_job)
+        maximum = max(maximum, 1)
+        limit = min(cpus, maximum)
+        logger.info(
+            "Running {} commands at a time, up to {}, from {} CPUs and {} of available memory".format(
+                limit, maximum, cpus, "unknown" if memory is None else "{} MiB".format(memory)
+            )
+        )
+        return cls(limit, maximum, memory_per_job)
+
+    def on_output_line(self, line):
+        """Decrease the number of commands if a line of output of a command reports an API rate limit."""
+        if RATE_LIMIT_REGEX.search(line):
+            self.decrease("API rate limit errors")
+
+    def on_command_done(self, expected_duration=None):
+        """Adjust the number of commands after a command is done, from the available memory and the throughput.
+
+        One more command is run after each round of as many commands as run at a time, unless the throughput of the
+        round dropped compared to the previous one. The throughput is the sum of the expected durations of the
+        commands of the round, in seconds, per second: it is unknown for rounds with commands without expected duration.
+        """
+        memory = get_available_memory()
+        if memory is not None and memory < self.memory_per_job:
+            self.decrease("low memory, {} MiB available".format(memory))
+            return
+        with self._lock:
+            self._done += 1
+            if self._work is not None:
+                self._work = None if expected_duration is None else self._work + expected_duration
+            if self._done < self.limit:
+                return
+            throughput = None
+            if self._work is not None:
+                throughput = self._work / max(time.monotonic() - self._window_start, 1e-3)
+            dropped = (
+                throughput is not None and self._throughput is not None and throughput < self._throughput * THROUGHPUT_DROP_RATIO
+            )
+            self._throughput = throughput
+            self._start_window()
+            if not dropped:
+                if self.limit < self.maximum:
+                    self.limit += 1
+                    logger.debug("Running {} commands at a time".format(self.limit))
+                return
+        self.decrease("throughput drop")
+
+    def decrease(self, reason):
+        """Halve the number of commands run at a time, unless it was just decreased."""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < DECREASE_INTERVAL:
+                return
+            self._last_decrease = now
+            limit = max(self.limit // 2, 1)
+            if limit != self.limit:
+                logger.warning("Running {} commands at a time instead of {} after {}".format(limit, self.limit, reason))
+            self.limit = limit
+            # the throughput of fewer commands is not comparable to the previous one
+            self._throughput = None
+            self._start_window()
+
+    def _start_window(self):
+        self._window_start = time.monotonic()
+        self._done = 0
+        self._work = 0.0
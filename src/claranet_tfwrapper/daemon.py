@@ -0,0 +1,270 @@
+"""tfwrapper daemon and its client.
+
+The daemon keeps an interpreter warm for a project: libraries are imported once, parsed configurations,
+the HTTP(S) requests session and acquired credentials are kept in memory between executions.
+
+Clients send their command line arguments, working directory and environment over a Unix socket. The
+daemon prepares the execution (configurations loading, tool selection and credentials acquisition) and
+sends back the resulting wrapper config and environment. The client then runs the subcommand itself so
+that terraform keeps its terminal. When the preparation would prompt the user, e.g. for an MFA code, the daemon
+declines it and the client prepares the execution itself.
+
+Executions are prepared one at a time, and cached state is cleared whenever a configuration file changes.
+As clients send their environment, including credentials, they only talk to a socket owned by their user and not
+accessible to others, served by a process of their user.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+
+import claranet_tfwrapper as tfwrapper
+
+from . import azure, timings
+from .utils import get_files_signature
+
+SOCKET_FILENAME = "tfwrapper.sock"
+# Unix socket paths are limited to about 100 bytes
+SOCKET_PATH_MAX_LENGTH = 100
+# wrapper config keys set by tfwrapper.prepare() on top of the parsed arguments, the only ones sent back to clients
+WRAPPER_CONFIG_KEYS = ("confdir", "rootdir", *tfwrapper.CONTEXT_KEYS, "backend", "stack_config", "tool_bin_path")
+
+logger = logging.getLogger()
+
+
+class RecordsCollector(logging.Handler):
+    """Logging handler collecting log records to send them back to a client."""
+
+    def __init__(self):
+        """Initialize the handler with no records."""
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        """Collect a log record as a level and a formatted message."""
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def get_socket_path(rootdir):
+    """Get the path to the Unix socket of the daemon of a project.
+
+    Too long paths fall back to a private directory of the user in the temporary directory.
+    """
+    socket_path = os.path.join(rootdir, ".run", SOCKET_FILENAME)
+    if len(socket_path.encode()) > SOCKET_PATH_MAX_LENGTH:
+        digest = hashlib.sha256(rootdir.encode()).hexdigest()[:16]
+        socket_path = os.path.join(tempfile.gettempdir(), "tfwrapper-{}".format(os.getuid()), digest + ".sock")
+    return socket_path
+
+
+def is_private(path, file_type):
+    """Tell whether a file of this type, as a stat.S_IS* function, is owned by the current user and only accessible by them."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return file_type(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def get_peer_uid(connection):
+    """Get the user id of the process at the other end of a Unix socket, or None if the platform does not tell."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    _, uid, _ = struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+
+def get_config_signature(confdir):
+    """Get the mtime and size of every configuration file the daemon state depends on."""
+    paths = [os.path.join(confdir, name) for name in sorted(os.listdir(confdir))] + [azure.SP_CREDENTIALS_FILE]
+    return get_files_signature(paths)
+
+
+def warm_up():
+    """Import the libraries which are imported lazily by tfwrapper."""
+    import boto3  # noqa: F401
+    import cachecontrol  # noqa: F401
+    import jinja2  # noqa: F401
+    import natsort  # noqa: F401
+    import requests  # noqa: F401
+    import semver  # noqa: F401
+
+    tfwrapper.get_stack_configuration_schema()
+
+
+def serve(rootdir, confdir, idle_timeout):
+    """Serve executions of the project until no client connects for idle_timeout seconds, if not 0."""
+    socket_path = get_socket_path(rootdir)
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir != os.path.join(rootdir, ".run"):
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if not is_private(socket_dir, stat.S_ISDIR):
+            logger.error("{} must be a directory owned by the current user and only accessible by them".format(socket_dir))
+            return tfwrapper.RC_KO
+    if os.path.exists(socket_path):
+        if _send(socket_path, {"ping": True}) is not None:
+            logger.error("A daemon is already running for {} on {}".format(rootdir, socket_path))
+            return tfwrapper.RC_KO
+        os.remove(socket_path)
+
+    warm_up()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        server.settimeout(idle_timeout or None)
+        logger.info("Daemon listening on {}".format(socket_path))
+
+        config_signature = None
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                logger.info("No execution for {} seconds, stopping daemon.".format(idle_timeout))
+                break
+            except KeyboardInterrupt:
+                logger.info("Stopping daemon.")
+                break
+
+            with connection, connection.makefile("rwb") as stream:
+                try:
+                    request = json.loads(stream.readline())
+                    if request.get("ping"):
+                        response = {"pong": True}
+                    else:
+                        signature = get_config_signature(confdir)
+                        if config_signature is not None and signature != config_signature:
+                            logger.info("Configuration changed, clearing cached state.")
+                            tfwrapper.clear_caches()
+                        config_signature = signature
+                        response = handle(request)
+                    stream.write(json.dumps(response).encode() + b"\n")
+                except (OSError, ValueError) as e:
+                    logger.warning("Failed to serve a client: {}".format(e))
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    return tfwrapper.RC_OK
+
+
+def handle(request):
+    """Prepare an execution requested by a client, in the client working directory and environment.
+
+    The preparation is declined when it would prompt the user, or when the wrapper config cannot be sent as JSON.
+    The daemon working directory and environment are restored afterwards.
+    """
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    collector = RecordsCollector()
+    logger.addHandler(collector)
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["environ"])
+
+        args = tfwrapper.parse_args(request["argv"])
+        if args.timings or args.timings_file:
+            timings.enable()
+        wrapper_config = tfwrapper.prepare(args, interactive=False)
+        del wrapper_config["func"]
+        unexpected_keys = set(wrapper_config) - set(vars(args)) - set(WRAPPER_CONFIG_KEYS)
+        if unexpected_keys:
+            raise ValueError("Unexpected wrapper config keys: {}".format(", ".join(sorted(unexpected_keys))))
+        json.dumps(wrapper_config)
+        response = {
+            "wrapper_config": wrapper_config,
+            "environ": dict(os.environ),
+            "timings": timings.get_phases(),
+        }
+    except tfwrapper.InteractionRequired as e:
+        logger.info("Declining an execution which requires interaction: {}".format(e))
+        response = {"local": True}
+    except TypeError as e:
+        logger.info("Declining an execution whose wrapper config cannot be sent: {}".format(e))
+        response = {"local": True}
+    except SystemExit as e:
+        response = {"returncode": e.code}
+    except Exception as e:
+        logger.exception("Failed to prepare execution")
+        response = {"error": str(e)}
+    finally:
+        logger.removeHandler(collector)
+        timings.disable()
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    response["logs"] = collector.records
+    return response
+
+
+def _send(socket_path, request):
+    """Send a request to a daemon and return its response, or None if it is not reachable or not trusted.
+
+    The socket must be private to the current user, and served by a process of the current user when the platform
+    tells the user of the peer, before anything is sent.
+    """
+    if os.path.lexists(socket_path) and not is_private(socket_path, stat.S_ISSOCK):
+        logger.warning("Ignoring daemon socket {} not owned by the current user or accessible by others".format(socket_path))
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            peer_uid = get_peer_uid(client)
+            if peer_uid is not None and peer_uid != os.getuid():
+                logger.warning("Ignoring daemon socket {} served by user id {}".format(socket_path, peer_uid))
+                return None
+            with client.makefile("rwb") as stream:
+                stream.write(json.dumps(request).encode() + b"\n")
+                stream.flush()
+                return json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def prepare_remotely(confdir, argv):
+    """Prepare the execution in the daemon of the project, if one is running.
+
+    Applies the environment prepared by the daemon to this process.
+    Returns the wrapper config, or None if no daemon is reachable or if it declined the preparation.
+    """
+    confdir, _ = tfwrapper.find_config_dir(confdir)
+    if not confdir:
+        return None
+    socket_path = get_socket_path(os.path.dirname(os.path.abspath(confdir)))
+    if not os.path.exists(socket_path):
+        return None
+
+    with timings.phase("daemon", socket_path) as record:
+        response = _send(socket_path, {"argv": argv, "cwd": os.getcwd(), "environ": dict(os.environ)})
+    if response is None:
+        logger.debug("Daemon is not reachable on {}, preparing execution locally".format(socket_path))
+        return None
+    if response.get("local"):
+        logger.debug("Daemon on {} declined the preparation, preparing execution locally".format(socket_path))
+        return None
+    logger.debug("Execution prepared by daemon on {}".format(socket_path))
+    timings.add_phases(response.get("timings", []), record)
+
+    for levelno, message in response["logs"]:
+        logger.log(levelno, message)
+    if "error" in response:
+        raise ValueError(response["error"])
+    if "returncode" in response:
+        raise SystemExit(response["returncode"])
+
+    os.environ.clear()
+    os.environ.update(response["environ"])
+    return response["wrapper_config"]
@@ -0,0 +1,1096 @@
+"""Execution of a command for each stack of a project, selected from the stack index.
+
+Stacks are selected by their components, by the files changed since a git ref and by shard, and run in the order of
+their dependencies, one at a time or concurrently. Each command is run with limits, its result is recorded in a
+checkpoint to resume the execution, in the history and in a summary. Wrapper subcommands like "tfwrapper plan" are
+prepared in this process rather than in a new tfwrapper process for each stack.
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import fnmatch
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+import claranet_tfwrapper as tfwrapper
+
+from . import azure, concurrency, modules, output, timings
+from .utils import get_hcl_blocks
+
+logger = logging.getLogger()
+
+LOGS_DIRNAME = "foreach_logs"
+# checkpoints of the executions which did not complete, to resume them with --resume
+CHECKPOINTS_DIRNAME = "foreach_checkpoints"
+# wrapper subcommands executed by foreach in its own process, as a single terraform command per stack
+NATIVE_SUBCOMMANDS = ("fmt", "graph", "init", "output", "plan", "providers", "show", "validate", "version")
+# delay between the checks of the timeouts of a foreach command, in seconds
+WATCHDOG_INTERVAL = 1.0
+# delay given to a timed out foreach command to exit after SIGTERM before killing it, in seconds
+KILL_GRACE_PERIOD = 10
+# terraform_remote_state data sources, and the literal state keys in them, to infer the dependencies between stacks
+REMOTE_STATE_BLOCK_REGEX = re.compile(r'data\s+"terraform_remote_state"\s+"[^"]*"\s*\{')
+REMOTE_STATE_KEY_REGEX = re.compile(r'\bkey\s*=\s*"([^"$]*)"')
+
+
+def match_stack(stack, account, environment, region, stack_name):
+    """Tell whether stack components match the account, environment, region and stack glob patterns.
+
+    Global stacks match if the environment is global, or if both the environment and region are wildcards.
+    """
+    if not fnmatch.fnmatchcase(stack[0], account) or not fnmatch.fnmatchcase(stack[3], stack_name):
+        return False
+    if stack[1] == "global":
+        return environment == "global" or environment == "*" and region == "*"
+    return (
+        environment != "global"
+        and stack[2] is not None
+        and fnmatch.fnmatchcase(stack[1], environment)
+        and fnmatch.fnmatchcase(stack[2], region)
+    )
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class StackHandle:
+    """A stack selected by foreach, identified from its configuration file in the stack index.
+
+    Its configuration is only loaded when its command is about to run.
+    """
+
+    path: str
+    config_file: str
+    account: str
+    environment: str
+    region: str | None
+    stack: str
+    depends_on: tuple = ()
+    credentials: tuple = ()
+    limits: dict = dataclasses.field(default_factory=dict)
+
+    def load_config(self):
+        """Load and validate the configuration of the stack, which is not kept by the handle."""
+        return tfwrapper.load_stack_config_from_file(self.config_file)
+
+    def get_envvars(self, stack_config):
+        """Get the environment of a command for the stack, see get_stack_envvars()."""
+        components = {"account": self.account, "environment": self.environment, "region": self.region, "stack": self.stack}
+        return tfwrapper.get_stack_envvars(stack_config, components)
+
+
+def select_stacks(wrapper_config):
+    """Select the stacks to process with foreach, from the stack index. Treats unset stack components as wildcard.
+
+    Stack configurations are not loaded, see StackHandle.load_config().
+
+    :param wrapper_config: dict: the wrapper config
+    :return generator: StackHandle, in the order of the configuration files
+    """
+    account = wrapper_config["account"] if wrapper_config["account"] else "*"
+    environment = wrapper_config["environment"] if wrapper_config["environment"] else "*"
+    region = wrapper_config["region"] if wrapper_config["region"] else "*"
+    stack = wrapper_config["stack"] if wrapper_config["stack"] else "*"
+
+    logger.debug("Selecting stacks matching {}".format(tfwrapper.get_stack_config_filename(account, environment, region, stack)))
+    index = tfwrapper.update_stack_index(wrapper_config["rootdir"], wrapper_config["confdir"])
+
+    for filename, entry in index.items():
+        if not match_stack(entry["stack"], account, environment, region, stack):
+            continue
+        stack_config = os.path.join(wrapper_config["confdir"], filename)
+        logger.debug("Processing stack config {}".format(stack_config))
+        stack_dir = tfwrapper.get_stack_dir(wrapper_config["rootdir"], *entry["stack"])
+        if not entry["dir_exists"]:
+            logger.warning("Stack config {} has no matching directory at {}, skipping.".format(stack_config, stack_dir))
+            continue
+        logger.debug("Added stack {} => {}".format(stack_dir, stack_config))
+        yield StackHandle(stack_dir, stack_config, *entry["stack"], entry["depends_on"], entry["credentials"], entry["limits"])
+
+
+def get_remote_state_keys(stack_dir):
+    """Get the literal state keys of the terraform_remote_state data sources of a stack."""
+    keys = []
+    for tf_file in sorted(pathlib.Path(stack_dir).glob("*.tf")):
+        for block in get_hcl_blocks(tf_file.read_text(errors="replace"), REMOTE_STATE_BLOCK_REGEX):
+            keys.extend(REMOTE_STATE_KEY_REGEX.findall(block))
+    return keys
+
+
+def get_stack_dependencies(wrapper_config, stacks):
+    """Get the dependencies of each stack between the given ones.
+
+    Dependencies are declared by stack id in the depends_on list of the stack configuration, or inferred from
+    terraform_remote_state data sources with a state key ending with the stack id and a file name, like the state
+    keys of the backend configuration templates. Dependencies on stacks which are not given are ignored.
+
+    :param wrapper_config: dict: the wrapper config
+    :param stacks: dict: stack_path => StackHandle
+    :return dict: stack_path => set of stack_path, in the order of stacks
+    """
+    stack_ids = {tfwrapper.get_stack_id(wrapper_config["rootdir"], stack): stack for stack in stacks}
+    dependencies = {}
+    for stack, stack_handle in stacks.items():
+        dependencies[stack] = set()
+        for stack_id in stack_handle.depends_on:
+            if stack_id in stack_ids:
+                dependencies[stack].add(stack_ids[stack_id])
+            else:
+                logger.debug('Ignoring dependency of "{}" on "{}" which is not selected'.format(stack, stack_id))
+        for key in get_remote_state_keys(stack):
+            key_dir = os.path.dirname(key)
+            for stack_id, dependency in stack_ids.items():
+                if key_dir == stack_id or key_dir.endswith("/" + stack_id):
+                    logger.debug('Inferred dependency of "{}" on "{}" from remote state "{}"'.format(stack, dependency, key))
+                    dependencies[stack].add(dependency)
+        dependencies[stack].discard(stack)
+    return dependencies
+
+
+def sort_stacks(dependencies):
+    """Sort stacks so that each stack comes after its dependencies, keeping the given order otherwise.
+
+    :param dependencies: dict: stack_path => set of stack_path, as returned by get_stack_dependencies()
+    :return list: stack_path
+    """
+    positions = {stack: position for position, stack in enumerate(dependencies)}
+    sorted_stacks = {}
+    visiting = []
+
+    def visit(stack):
+        if stack in sorted_stacks:
+            return
+        if stack in visiting:
+            cycle = visiting[visiting.index(stack) :] + [stack]
+            tfwrapper.error("foreach: error: dependency cycle between stacks: {}".format(" -> ".join(cycle)))
+        visiting.append(stack)
+        for dependency in sorted(dependencies[stack], key=positions.get):
+            visit(dependency)
+        visiting.pop()
+        sorted_stacks[stack] = None
+
+    for stack in dependencies:
+        visit(stack)
+    return list(sorted_stacks)
+
+
+def get_stack_groups(dependencies):
+    """Group the stacks which depend on each other, directly or not.
+
+    :param dependencies: dict: stack_path => set of stack_path, as returned by get_stack_dependencies()
+    :return list: lists of stack_path, in the order of dependencies
+    """
+    parents = {stack: stack for stack in dependencies}
+
+    def find(stack):
+        while parents[stack] != stack:
+            parents[stack] = parents[parents[stack]]
+            stack = parents[stack]
+        return stack
+
+    for stack, stack_dependencies in dependencies.items():
+        for dependency in stack_dependencies:
+            parents[find(dependency)] = find(stack)
+
+    groups = {}
+    for stack in dependencies:
+        groups.setdefault(find(stack), []).append(stack)
+    return list(groups.values())
+
+
+def load_durations(summary_file):
+    """Load the duration of the command for each stack from a summary written with --summary-json.
+
+    :return dict: stack path relative to the root dir => duration in seconds
+    """
+    try:
+        with open(summary_file) as f:
+            summary = json.load(f)
+        return {result["stack"]: result["duration"] for result in summary["stacks"] if result["duration"] is not None}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning("Cannot load stack durations from {}, stacks are considered equally long: {}".format(summary_file, e))
+        return {}
+
+
+def select_shard(wrapper_config, dependencies, shard, durations):
+    """Select the stacks of a shard, so that shards have about the same total duration.
+
+    Stacks depending on each other are kept in the same shard. Groups of stacks are assigned to the shard with the
+    lowest total duration so far, from the longest group to the shortest, and ties are broken by order so that all
+    shards compute the same partition. Stacks without known duration are considered as long as the median one.
+
+    :param dependencies: dict: stack_path => set of stack_path, as returned by get_stack_dependencies()
+    :param shard: tuple: the index of the shard to select, from 1, and the number of shards
+    :param durations: dict: stack path relative to the root dir => duration in seconds
+    :return set: stack_path
+    """
+    index, count = shard
+    known_durations = sorted(durations.values())
+    default_duration = known_durations[len(known_durations) // 2] if known_durations else 1.0
+
+    def get_duration(stack):
+        return durations.get(os.path.relpath(stack, wrapper_config["rootdir"]), default_duration)
+
+    groups = [
+        (sum(get_duration(stack) for stack in group), position, group)
+        for position, group in enumerate(get_stack_groups(dependencies))
+    ]
+    totals = [0.0] * count
+    selected = set()
+    for duration, _, group in sorted(groups, key=lambda g: (-g[0], g[1])):
+        target = totals.index(min(totals))
+        totals[target] += duration
+        if target == index - 1:
+            selected.update(group)
+    logger.info(
+        "Selected shard {}/{} with {} of {} stacks, estimated to take {:.0f}s of {:.0f}s".format(
+            index, count, len(selected), len(dependencies), totals[index - 1], sum(totals)
+        )
+    )
+    return selected
+
+
+def get_changed_files(rootdir, ref):
+    """Get the files of the project changed since a git ref, committed or not, including untracked files.
+
+    Returns the paths of the files relative to the root dir.
+    """
+    commands = (
+        ["git", "diff", "--name-only", "--relative", ref, "--", "."],
+        ["git", "ls-files", "--others", "--exclude-standard", "--", "."],
+    )
+    changed_files = set()
+    with timings.phase("git changes", ref):
+        for command in commands:
+            try:
+                result = subprocess.run(command, cwd=rootdir, check=True, capture_output=True, text=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                tfwrapper.error(
+                    "foreach: error: cannot list the files changed since {}: {}".format(ref, getattr(e, "stderr", None) or e)
+                )
+            changed_files.update(line for line in result.stdout.splitlines() if line)
+    return sorted(changed_files)
+
+
+def select_changed_stacks(wrapper_config, stacks, changed_files):
+    """Select the stacks affected by changed files.
+
+    A stack is affected by the changes of the files in its directory, in the directories of the local modules it uses,
+    directly or not, and of its configuration file. All stacks are affected by the changes of the tfwrapper and state
+    configuration files. Templates are only used to bootstrap stacks, their changes do not affect existing stacks.
+
+    :param wrapper_config: dict: the wrapper config
+    :param stacks: dict: stack_path => StackHandle
+    :param changed_files: list: paths of the changed files relative to the root dir
+    :return set: stack_path
+    """
+    rootdir = wrapper_config["rootdir"]
+    confdir = os.path.relpath(os.path.abspath(wrapper_config["confdir"]), rootdir)
+    module_stacks = {}
+    if changed_files:
+        stacks_modules = modules.get_stacks_modules(os.path.join(rootdir, ".run", tfwrapper.MODULE_INDEX_FILENAME), stacks)
+        module_stacks = modules.get_module_stacks(stacks_modules)
+    selected = set()
+    for changed_file in changed_files:
+        # the file can be in a local module directory, or in a sub directory of it, used by stacks
+        directory = os.path.dirname(os.path.join(os.path.abspath(rootdir), changed_file))
+        while directory.startswith(os.path.abspath(rootdir) + os.sep):
+            for stack in module_stacks.get(directory, ()):
+                if stack not in selected:
+                    logger.debug("{} changed, selecting stack {} using module {}".format(changed_file, stack, directory))
+                    selected.add(stack)
+            directory = os.path.dirname(directory)
+
+        if os.path.dirname(changed_file) == confdir:
+            if os.path.basename(changed_file) in ("config.yml", "state.yml"):
+                logger.debug("{} changed, selecting all stacks".format(changed_file))
+                return set(stacks)
+            try:
+                stack_dir = tfwrapper.get_stack_dir(
+                    rootdir, *tfwrapper.get_stack_from_config_path(os.path.join(rootdir, changed_file))
+                )
+            except ValueError:
+                continue
+        else:
+            parts = changed_file.split("/")[:-1]
+            if len(parts) >= 3 and parts[1] == "_global":
+                stack_dir = tfwrapper.get_stack_dir(rootdir, parts[0], "global", None, parts[2])
+            elif len(parts) >= 4:
+                stack_dir = tfwrapper.get_stack_dir(rootdir, *parts[:4])
+            else:
+                continue
+        if stack_dir in stacks and stack_dir not in selected:
+            logger.debug("{} changed, selecting stack {}".format(changed_file, stack_dir))
+            selected.add(stack_dir)
+    return selected
+
+
+def get_output(wrapper_config, stack, watch=False, on_line=None):
+    """Get the output of the foreach command for a stack, labelled with the stack path relative to the root dir.
+
+    With watch, the time of its last output is kept, to detect inactive commands. on_line is called with each line.
+    """
+    label = os.path.relpath(stack, wrapper_config["rootdir"])
+    log_file = os.path.join(wrapper_config["rootdir"], ".run", LOGS_DIRNAME, label.replace("/", "_") + ".log")
+    keep_tail = bool(wrapper_config.get("summary_json") or wrapper_config.get("summary_junit"))
+    return output.CommandOutput(
+        wrapper_config.get("output", output.OUTPUT_MODE_STREAM), label, log_file, keep_tail, watch, on_line
+    )
+
+
+def get_limits(wrapper_config, stack_handle):
+    """Get the limits of the foreach command for a stack: its foreach configuration overrides the arguments."""
+    return {limit: stack_handle.limits.get(limit, wrapper_config.get(limit) or 0) for limit in tfwrapper.FOREACH_LIMITS}
+
+
+@functools.cache
+def get_memory_scope_command():
+    """Get the command running another one in a transient systemd scope of the user, or None if it is not available.
+
+    systemd-run needs a user service manager, usually missing in containers, so it is tried once per process.
+    """
+    systemd_run = shutil.which("systemd-run")
+    if not systemd_run:
+        return None
+    command = [systemd_run, "--user", "--scope", "--quiet", "--collect"]
+    try:
+        subprocess.run(
+            [*command, "true"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=10,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError):
+        logger.debug("Cannot run commands in a systemd scope, memory limits only apply to each process")
+        return None
+    return command
+
+
+def limit_command_memory(stack_command, memory_limit):
+    """Limit the memory of a foreach command, in MiB, given its subprocess.Popen arguments.
+
+    The command runs in a systemd scope limiting the memory of all its processes if possible, see
+    get_memory_scope_command(). Otherwise, the data segment of each of its processes is limited with RLIMIT_DATA,
+    which counts the memory they allocate, but not the address space reserved by Go programs like Terraform.
+    """
+    if not memory_limit:
+        return stack_command
+    scope_command = get_memory_scope_command()
+    if scope_command:
+        args = stack_command["args"]
+        if stack_command.get("shell"):
+            args = [stack_command.get("executable") or "/bin/sh", "-c", args[0]]
+        return {
+            **stack_command,
+            "args": [*scope_command, "--property=MemoryMax={}M".format(memory_limit), "--", *args],
+            "shell": False,
+            "executable": None,
+        }
+
+    import resource
+
+    limit = memory_limit * 1024 * 1024
+
+    def set_memory_limit():
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    return {**stack_command, "preexec_fn": set_memory_limit}
+
+
+def kill_command(process):
+    """Terminate the process group of a foreach command, and kill what remains of it after a grace period."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=KILL_GRACE_PERIOD)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        logger.warning("Command did not exit {}s after SIGTERM, killing it".format(KILL_GRACE_PERIOD))
+    # children may survive their parent and keep its output open
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return process.wait()
+
+
+def wait_command(process, stack_output, limits):
+    """Wait for a foreach command, killing its process group if it exceeds the timeout or the inactivity timeout.
+
+    The command must run in its own process group, with stack_output watching its output for the inactivity timeout.
+    Returns the return code of the command and, if it was killed, the reason: "timeout" or "inactivity timeout".
+    """
+    timeout, inactivity_timeout = limits["timeout"], limits["inactivity_timeout"]
+    if not timeout and not inactivity_timeout:
+        return process.wait(), None
+    start = time.monotonic()
+    while True:
+        try:
+            return process.wait(timeout=WATCHDOG_INTERVAL), None
+        except subprocess.TimeoutExpired:
+            pass
+        now = time.monotonic()
+        if timeout and now - start > timeout:
+            reason, limit = "timeout", timeout
+        elif inactivity_timeout and now - stack_output.last_output > inactivity_timeout:
+            reason, limit = "inactivity timeout", inactivity_timeout
+        else:
+            continue
+        logger.error('Killing the command in "{}" after a {} of {}s'.format(stack_output.label, reason, limit))
+        return kill_command(process), reason
+
+
+def get_native_args(wrapper_config):
+    """Get the parsed arguments of the foreach command if it is a wrapper subcommand which can run in this process.
+
+    This is the case of the tfwrapper subcommands executing a single terraform command, without stack, configuration
+    directory or timings arguments. Returns None otherwise, or with --no-native.
+    """
+    command = wrapper_config["command"]
+    if wrapper_config.get("no_native") or wrapper_config["shell"] or os.path.basename(command[0]) != "tfwrapper":
+        return None
+    log_level = logger.level
+    try:
+        args = tfwrapper.parse_args(command[1:])
+    except (SystemExit, ValueError):
+        return None
+    finally:
+        logger.setLevel(log_level)
+    if (
+        args.subcommand not in NATIVE_SUBCOMMANDS
+        or args.confdir != tfwrapper.DEFAULT_CONF_DIRNAME
+        or any((args.account, args.environment, args.region, args.stack, args.timings, args.timings_file))
+    ):
+        return None
+    if args.subcommand == "plan" and (args.pipe_plan or wrapper_config["config"].get("always_trigger_init")):
+        return None
+    return args
+
+
+# serializes the preparation of wrapper subcommands executed by foreach in its own process, as it may prompt
+_prepare_lock = threading.Lock()
+
+
+def prepare_native_command(wrapper_config, args, stack_handle):
+    """Prepare the wrapper subcommand of foreach for a stack in this process, like tfwrapper in the stack directory.
+
+    The environment of the stack is prepared in a dict of its own, the environment of this process is left unchanged.
+    Imported libraries, parsed configurations, the HTTP(S) session and acquired credentials are shared by all stacks.
+    Returns the subprocess.Popen arguments of the terraform command, or the return code of the failed preparation.
+    """
+    stack_args = argparse.Namespace(**vars(args))
+    stack_args.confdir = wrapper_config["confdir"]
+    stack_args.account = stack_handle.account
+    stack_args.environment = stack_handle.environment
+    stack_args.region = stack_handle.region
+    stack_args.stack = stack_handle.stack
+    # each stack is only prepared once, the persistent context cache would only be rewritten and evicted by each stack
+    stack_args.foreach_native = True
+
+    with _prepare_lock, timings.phase("foreach prepare", os.path.relpath(stack_handle.path, wrapper_config["rootdir"])):
+        try:
+            stack_env = stack_handle.get_envvars(stack_handle.load_config())
+            stack_wrapper_config = tfwrapper.prepare(stack_args, stack_env)
+            return {"args": tfwrapper.get_terraform_command(args.subcommand, stack_wrapper_config), "env": stack_env}
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) and e.code else tfwrapper.RC_KO
+        except ValueError as e:
+            logger.error('Failed to prepare "{}": {}'.format(stack_handle.path, e))
+            return tfwrapper.RC_KO
+
+
+def get_credentials_profile(wrapper_config, credentials):
+    """Get the profile of credentials, as returned by get_stack_credentials(), which shares prompts and cache files."""
+    if credentials[0] == "state":
+        return (wrapper_config["state"].get(credentials[1]) or {}).get("state_profile") or ""
+    if credentials[0] == "aws":
+        return credentials[3] or ""
+    if credentials[0] == "azure":
+        return credentials[4] or credentials[3] or ""
+    return ""
+
+
+def prewarm_credentials(wrapper_config, stacks):
+    """Acquire the distinct credentials used by stacks before preparing them.
+
+    Stacks mostly share a few AWS profiles, Azure subscriptions and Service Principals, and GCP credentials, which are
+    then reused from memory by the preparation of each stack. Failures are only logged, as they are reported again
+    by the preparation of the stacks using them. The environment variables they set are discarded.
+    AWS and Azure credentials are acquired one after another, grouped by profile, as they may prompt for MFA codes,
+    share session cache files and change the environment. Only the GCP check, a mere subprocess, runs meanwhile.
+    """
+    # stacks without state configuration name use the first one
+    default_state = next(iter(wrapper_config["state"] or {}), None)
+    credentials = [
+        c
+        for c in dict.fromkeys(
+            ("state", c[1] or default_state) if c[0] == "state" else c
+            for stack_handle in stacks.values()
+            for c in stack_handle.credentials
+        )
+        if c[0] != "state" or c[1] is not None
+    ]
+    if not credentials:
+        return
+    logger.info("Acquiring {} credentials used by {} stacks".format(len(credentials), len(stacks)))
+
+    # the environment of this process is left unchanged
+    environ = dict(os.environ)
+
+    def acquire(c):
+        try:
+            tfwrapper.acquire_credentials(wrapper_config, c, environ)
+        except SystemExit:
+            logger.warning("Failed to acquire {} credentials {}".format(c[0], ", ".join(str(v) for v in c[1:] if v)))
+        except azure.AzureError as e:
+            logger.warning("Failed to acquire azure credentials: {}".format(e.message))
+
+    independent = [c for c in credentials if c[0] == "gcp"]
+    sequential = sorted(
+        (c for c in credentials if c[0] != "gcp"),
+        key=lambda c: (get_credentials_profile(wrapper_config, c), c[0] == "azure"),
+    )
+    with (
+        timings.phase("credentials prewarm"),
+        concurrent.futures.ThreadPoolExecutor(max_workers=max(len(independent), 1)) as executor,
+    ):
+        futures = [executor.submit(acquire, c) for c in independent]
+        for c in sequential:
+            acquire(c)
+        for future in futures:
+            future.result()
+
+
+def get_stack_command(wrapper_config, stack_handle):
+    """Get the subprocess.Popen arguments of the foreach command for a stack, or the return code of its failed preparation.
+
+    Wrapper subcommands are prepared in this process if possible, see get_native_args(). The memory of the
+    command is limited by the memory limit of the stack, see get_limits() and limit_command_memory().
+    """
+    if wrapper_config.get("native_args") is not None:
+        stack_command = prepare_native_command(wrapper_config, wrapper_config["native_args"], stack_handle)
+        if isinstance(stack_command, int):
+            return stack_command
+    else:
+        stack_command = {
+            "args": wrapper_config["command"],
+            "env": stack_handle.get_envvars(stack_handle.load_config()),
+            "shell": wrapper_config["shell"],
+            "executable": wrapper_config["executable"],
+        }
+    return limit_command_memory(stack_command, get_limits(wrapper_config, stack_handle)["memory_limit"])
+
+
+def run(wrapper_config):
+    """Execute command foreach selected stack, after the stacks it depends on.
+
+    Returns the return code of the first stack which failed, if any.
+    """
+    wrapper_config["native_args"] = get_native_args(wrapper_config)
+    if wrapper_config["native_args"] is not None:
+        logger.debug("Preparing {} in this process for each stack".format(wrapper_config["native_args"].subcommand))
+    stacks = {stack_handle.path: stack_handle for stack_handle in select_stacks(wrapper_config)}
+    if wrapper_config.get("changed_since"):
+        changed_files = get_changed_files(wrapper_config["rootdir"], wrapper_config["changed_since"])
+        selected = select_changed_stacks(wrapper_config, stacks, changed_files)
+        logger.info(
+            "Selected {} of {} stacks changed since {}".format(len(selected), len(stacks), wrapper_config["changed_since"])
+        )
+        stacks = {stack: stack_handle for stack, stack_handle in stacks.items() if stack in selected}
+    with timings.phase("stack dependencies"):
+        dependencies = get_stack_dependencies(wrapper_config, stacks)
+        dependencies = {stack: dependencies[stack] for stack in sort_stacks(dependencies)}
+    if wrapper_config.get("shard"):
+        # all the jobs must compute the same shards, so the local history of each job is not used
+        shard_durations = load_durations(wrapper_config["shard_durations"]) if wrapper_config.get("shard_durations") else {}
+        selected = select_shard(wrapper_config, dependencies, wrapper_config["shard"], shard_durations)
+        stacks = {stack: stack_handle for stack, stack_handle in stacks.items() if stack in selected}
+        dependencies = {stack: stack_dependencies for stack, stack_dependencies in dependencies.items() if stack in selected}
+    wrapper_config["checkpoint_file"] = get_checkpoint_file(wrapper_config, stacks)
+    stacks, dependencies = resume(wrapper_config, stacks, dependencies)
+    # the history is only used to order the stacks and to estimate the remaining time
+    with timings.phase("history"):
+        durations = get_history_durations(wrapper_config, stacks)
+    estimates = get_estimates(wrapper_config, stacks, durations)
+    if wrapper_config.get("jobs") == "auto":
+        wrapper_config["concurrency"] = concurrency.AdaptiveConcurrency.from_resources(wrapper_config.get("memory_limit"))
+        wrapper_config["jobs"] = wrapper_config["concurrency"].maximum
+    if wrapper_config["native_args"] is not None and tfwrapper.is_backend_required(wrapper_config["native_args"]):
+        prewarm_credentials(wrapper_config, stacks)
+    results = {}
+    start = time.monotonic()
+    try:
+        if wrapper_config.get("jobs", 1) > 1:
+            returncode = run_parallel(wrapper_config, stacks, dependencies, results, estimates)
+        else:
+            returncode = run_serial(wrapper_config, stacks, dependencies, results, estimates)
+    finally:
+        record_history(wrapper_config, results)
+        summary = get_summary(wrapper_config, stacks, results, time.monotonic() - start)
+        if wrapper_config.get("summary_json"):
+            write_summary_json(summary, wrapper_config["summary_json"])
+        if wrapper_config.get("summary_junit"):
+            write_summary_junit(summary, wrapper_config["summary_junit"])
+
+    failed = [result["stack"] for result in summary["stacks"] if result["status"] == "failure"]
+    if wrapper_config.get("keep_going") and failed:
+        logger.error("Command failed for {} of {} stacks: {}".format(len(failed), len(stacks), ", ".join(failed)))
+    if returncode == tfwrapper.RC_OK and len(results) == len(stacks):
+        try:
+            os.remove(wrapper_config["checkpoint_file"])
+        except FileNotFoundError:
+            pass
+    elif results:
+        logger.info("Use --resume to only execute the command for the stacks for which it did not succeed yet")
+    return returncode
+
+
+def run_serial(wrapper_config, stacks, dependencies, results, estimates):
+    """Execute command foreach stack, one at a time in the order of dependencies, storing the result of each stack in results.
+
+    Stops at the first failure unless wrapper_config["keep_going"] is set, and at the first Ctrl+C. Stacks depending
+    on a stack which failed or was skipped are skipped. The remaining time is logged from the estimated durations.
+    Returns the return code of the first stack which failed, if any.
+    """
+    first_returncode = tfwrapper.RC_OK
+    started = {}
+    for stack in dependencies:
+        failed_dependencies = [d for d in dependencies[stack] if results.get(d, {}).get("returncode") != 0]
+        if failed_dependencies:
+            logger.warning('Skipping "{}" as its dependency "{}" did not succeed'.format(stack, failed_dependencies[0]))
+            continue
+        limits = get_limits(wrapper_config, stacks[stack])
+        # commands with a timeout run in their own process group, to kill their children along with them
+        new_session = bool(limits["timeout"] or limits["inactivity_timeout"])
+        stack_output = get_output(wrapper_config, stack, watch=bool(limits["inactivity_timeout"]))
+        interrupted = False
+        reason = None
+
+        started_at = time.time()
+        start = started[stack] = time.monotonic()
+        stack_command = get_stack_command(wrapper_config, stacks[stack])
+        if isinstance(stack_command, int):
+            returncode = stack_command
+        else:
+            with (
+                timings.phase("foreach command", stack),
+                subprocess.Popen(
+                    cwd=stack, start_new_session=new_session, **stack_command, **stack_output.popen_kwargs()
+                ) as process,
+            ):
+                logger.debug('Execute command "{}" in "{}"'.format(stack_command["args"], stack))
+                stack_output.start(process)
+                try:
+                    returncode, reason = wait_command(process, stack_output, limits)
+                except KeyboardInterrupt:
+                    logger.warning("Received Ctrl+C")
+                    interrupted = True
+                    if new_session:
+                        # the command does not receive Ctrl+C from the terminal outside of its foreground process group
+                        try:
+                            os.killpg(process.pid, signal.SIGINT)
+                        except ProcessLookupError:
+                            pass
+                except:  # noqa
+                    process.kill()
+                    process.wait()
+                    raise
+                finally:
+                    stack_output.finish()
+                returncode = process.wait()
+        results[stack] = {
+            "returncode": returncode,
+            "started_at": started_at,
+            "duration": time.monotonic() - start,
+            "tail": stack_output.get_tail(),
+            "timeout": reason,
+        }
+        record_checkpoint(wrapper_config, stack, results[stack])
+        log_progress(stacks, results, estimates, started, 1)
+
+        if returncode != 0:
+            if not wrapper_config.get("keep_going"):
+                return returncode
+            logger.error('Command failed with return code {} in "{}"'.format(returncode, stack))
+            first_returncode = first_returncode or returncode
+        if interrupted:
+            return first_returncode or tfwrapper.RC_KO
+    return first_returncode
+
+
+def run_parallel(wrapper_config, stacks, dependencies, results, estimates):
+    """Execute command foreach stack, running up to wrapper_config["jobs"] commands at a time.
+
+    Each command is started as soon as the commands of the stacks it depends on succeeded, stacks depending on a
+    stack which failed or was skipped are skipped. Between the stacks which can be started, the ones with the
+    longest estimated duration, including the stacks depending on them, are started first. The remaining time is
+    logged from the estimated durations.
+    Commands run in their own process group, without stdin, so that only tfwrapper receives Ctrl+C from the terminal,
+    and forwards each one once to all running commands. No command is started after a Ctrl+C, nor after a failure
+    unless wrapper_config["keep_going"] is set. The result of each stack is stored in results.
+    With wrapper_config["concurrency"], up to its limit of commands run at a time, adjusted from the output of the
+    commands and after each command is done.
+    Returns the return code of the first stack which failed, if any.
+    """
+    keep_going = wrapper_config.get("keep_going", False)
+
+    jobs = wrapper_config["jobs"]
+    adaptive = wrapper_config.get("concurrency")
+    priorities = get_stack_priorities(dependencies, estimates)
+
+    lock = threading.Lock()
+    running = {}
+    started = {}
+    stopping = threading.Event()
+
+    def run(stack, stack_handle):
+        # do not prepare stacks, nor acquire their credentials, once stopping
+        if stopping.is_set():
+            return None
+        started_at = time.time()
+        start = time.monotonic()
+        reason = None
+        limits = get_limits(wrapper_config, stack_handle)
+        stack_command = get_stack_command(wrapper_config, stack_handle)
+        stack_output = get_output(
+            wrapper_config,
+            stack,
+            watch=bool(limits["inactivity_timeout"]),
+            on_line=adaptive and adaptive.on_output_line,
+        )
+        with lock:
+            if stopping.is_set():
+                return None
+            started[stack] = start
+            if not isinstance(stack_command, int):
+                process = running[stack] = subprocess.Popen(
+                    cwd=stack,
+                    stdin=subprocess.DEVNULL,
+                    start_new_session=True,
+                    **stack_command,
+                    **stack_output.popen_kwargs(),
+                )
+        if isinstance(stack_command, int):
+            returncode = stack_command
+        else:
+            logger.debug('Execute command "{}" in "{}"'.format(stack_command["args"], stack))
+            with timings.phase("foreach command", stack):
+                stack_output.start(process)
+                returncode, reason = wait_command(process, stack_output, limits)
+                stack_output.finish()
+            if stack_output.spilled:
+                logger.info('Output of the command in "{}" was also written to {}'.format(stack, stack_output.log_file))
+            if adaptive:
+                adaptive.on_command_done(estimates.get(stack))
+        with lock:
+            running.pop(stack, None)
+            results[stack] = {
+                "returncode": returncode,
+                "started_at": started_at,
+                "duration": time.monotonic() - start,
+                "tail": stack_output.get_tail(),
+                "timeout": reason,
+            }
+            if returncode != 0:
+                logger.error('Command failed with return code {} in "{}"'.format(returncode, stack))
+                if not keep_going:
+                    stopping.set()
+            record_checkpoint(wrapper_config, stack, results[stack])
+            log_progress(stacks, results, estimates, started, adaptive.limit if adaptive else jobs)
+        return returncode
+
+    interrupted = False
+    # dependencies of the stacks not submitted yet which did not succeed yet, in the order of dependencies
+    waiting = {stack: set(stack_dependencies) for stack, stack_dependencies in dependencies.items()}
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        while True:
+            # submit no more commands than jobs, so that the stacks with the highest priority are started first
+            ready = sorted(
+                (stack for stack, stack_dependencies in waiting.items() if not stack_dependencies),
+                key=priorities.get,
+                reverse=True,
+            )
+            for stack in ready[: max((adaptive.limit if adaptive else jobs) - len(pending), 0)]:
+                if stopping.is_set():
+                    break
+                del waiting[stack]
+                future = executor.submit(run, stack, stacks[stack])
+                futures[future] = stack
+                pending.add(future)
+            if not pending:
+                break
+            try:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.result() == 0:
+                        for stack_dependencies in waiting.values():
+                            stack_dependencies.discard(futures[future])
+            except KeyboardInterrupt:
+                logger.warning("Received Ctrl+C, forwarding it to {} running commands".format(len(running)))
+                interrupted = True
+                with lock:
+                    stopping.set()
+                    for process in running.values():
+                        try:
+                            os.killpg(process.pid, signal.SIGINT)
+                        except ProcessLookupError:
+                            pass
+
+    returncodes = {futures[future]: future.result() for future in futures}
+    skipped = len(stacks) - len([returncode for returncode in returncodes.values() if returncode is not None])
+    if skipped:
+        logger.warning("{} stacks were skipped".format(skipped))
+    return next(
+        (returncodes[stack] for stack in dependencies if returncodes.get(stack)),
+        tfwrapper.RC_KO if interrupted else tfwrapper.RC_OK,
+    )
+
+
+def get_command_label(wrapper_config):
+    """Get the foreach command as a string, to record it in the history."""
+    command = wrapper_config["command"]
+    return command[0] if wrapper_config["shell"] else shlex.join(command)
+
+
+def get_history_durations(wrapper_config, stacks):
+    """Get the duration of the foreach command for stacks in the history, by stack path relative to the root dir."""
+    from . import history
+
+    labels = [os.path.relpath(stack, wrapper_config["rootdir"]) for stack in stacks]
+    try:
+        return history.get_durations(wrapper_config["rootdir"], get_command_label(wrapper_config), labels)
+    except (OSError, history.sqlite3.Error) as e:
+        logger.warning("Cannot read the history of executions: {}".format(e))
+        return {}
+
+
+def get_estimates(wrapper_config, stacks, durations):
+    """Estimate the duration of the foreach command for each stack, from durations by stack path relative to the root dir.
+
+    Stacks without known duration are estimated as long as the median one. Returns an empty dict if no duration is known.
+    """
+    known_durations = sorted(durations.values())
+    if not known_durations:
+        return {}
+    default_duration = known_durations[len(known_durations) // 2]
+    return {stack: durations.get(os.path.relpath(stack, wrapper_config["rootdir"]), default_duration) for stack in stacks}
+
+
+def get_stack_priorities(dependencies, estimates):
+    """Get the priority of stacks to start them: the estimated duration of the longest chain of stacks they start.
+
+    Without estimates, all stacks are considered equally long.
+    :param dependencies: dict: stack_path => set of stack_path, sorted by sort_stacks()
+    """
+    dependents = {stack: [] for stack in dependencies}
+    for stack, stack_dependencies in dependencies.items():
+        for dependency in stack_dependencies:
+            dependents[dependency].append(stack)
+    priorities = {}
+    for stack in reversed(list(dependencies)):
+        priorities[stack] = estimates.get(stack, 1.0) + max((priorities[d] for d in dependents[stack]), default=0.0)
+    return priorities
+
+
+def log_progress(stacks, results, estimates, started, jobs):
+    """Log the number of stacks done and, if durations are estimated, the remaining time with this number of jobs."""
+    from . import history
+
+    if not estimates:
+        return
+    now = time.monotonic()
+    left = [max(estimates[stack] - (now - started[stack]), 0.0) for stack in started if stack not in results]
+    left += [estimates[stack] for stack in stacks if stack not in started]
+    remaining = max(sum(left) / jobs, max(left)) if left else 0.0
+    logger.info("{} of {} stacks done, about {} left".format(len(results), len(stacks), history.format_duration(remaining)))
+
+
+def get_checkpoint_file(wrapper_config, stacks):
+    """Get the checkpoint file of the foreach command for the selected stacks, named after a hash of both."""
+    labels = sorted(os.path.relpath(stack, wrapper_config["rootdir"]) for stack in stacks)
+    key = hashlib.sha256(json.dumps([get_command_label(wrapper_config), labels]).encode()).hexdigest()[:16]
+    return os.path.join(wrapper_config["rootdir"], ".run", CHECKPOINTS_DIRNAME, key + ".jsonl")
+
+
+def load_checkpoint(checkpoint_file):
+    """Load the stacks for which the command succeeded from a checkpoint file, by stack path relative to the root dir.
+
+    The last line is ignored if it was not fully written.
+    """
+    succeeded = set()
+    try:
+        with open(checkpoint_file) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result["returncode"] == 0:
+                    succeeded.add(result["stack"])
+                else:
+                    succeeded.discard(result["stack"])
+    except FileNotFoundError:
+        pass
+    return succeeded
+
+
+def record_checkpoint(wrapper_config, stack, result):
+    """Append the result of the command for a stack to the checkpoint file, as a line of JSON."""
+    checkpoint_file = wrapper_config.get("checkpoint_file")
+    if checkpoint_file is None:
+        return
+    line = json.dumps(
+        {
+            "stack": os.path.relpath(stack, wrapper_config["rootdir"]),
+            "returncode": result["returncode"],
+            "started_at": result["started_at"],
+            "duration": result["duration"],
+        }
+    )
+    try:
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+        with open(checkpoint_file, "a") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.warning("Cannot write the foreach checkpoint: {}".format(e))
+
+
+def resume(wrapper_config, stacks, dependencies):
+    """Select the stacks for which the command did not succeed yet in the checkpoint of the interrupted execution.
+
+    Without --resume, the checkpoint is started over. Stacks which succeeded are removed from the dependencies of the
+    others, which can then start right away.
+    :return tuple: the selected stacks and their dependencies
+    """
+    checkpoint_file = wrapper_config["checkpoint_file"]
+    if not wrapper_config.get("resume"):
+        try:
+            os.remove(checkpoint_file)
+        except FileNotFoundError:
+            pass
+        return stacks, dependencies
+    labels = load_checkpoint(checkpoint_file)
+    succeeded = {stack for stack in stacks if os.path.relpath(stack, wrapper_config["rootdir"]) in labels}
+    if not os.path.exists(checkpoint_file):
+        logger.warning("No interrupted execution of this command for these stacks to resume, starting from scratch")
+    else:
+        logger.info("Resuming: skipping {} of {} stacks which already succeeded".format(len(succeeded), len(stacks)))
+    stacks = {stack: stack_handle for stack, stack_handle in stacks.items() if stack not in succeeded}
+    dependencies = {
+        stack: set(stack_dependencies) - succeeded for stack, stack_dependencies in dependencies.items() if stack not in succeeded
+    }
+    return stacks, dependencies
+
+
+def record_history(wrapper_config, results):
+    """Record the execution of the foreach command for stacks in the history."""
+    from . import history
+
+    if not results:
+        return
+    command = get_command_label(wrapper_config)
+    executions = [
+        {
+            "started_at": result["started_at"],
+            "stack": os.path.relpath(stack, wrapper_config["rootdir"]),
+            "command": command,
+            "returncode": result["returncode"],
+            "duration": result["duration"],
+        }
+        for stack, result in results.items()
+    ]
+    try:
+        history.record(wrapper_config["rootdir"], executions)
+    except (OSError, history.sqlite3.Error) as e:
+        logger.warning("Cannot record the executions in the history: {}".format(e))
+
+
+def get_summary(wrapper_config, stacks, results, duration):
+    """Get the summary of a foreach execution, with the status of each selected stack.
+
+    Stacks have a "success", "failure" or "skipped" status, the latter when their command was not executed.
+    Stacks whose command was killed have the reason in "timeout": "timeout" or "inactivity timeout".
+    """
+    summary = {"command": wrapper_config["command"], "duration": duration, "stacks": []}
+    for stack in stacks:
+        result = results.get(stack)
+        if result is None:
+            status = "skipped"
+        elif result["returncode"] == 0:
+            status = "success"
+        else:
+            status = "failure"
+        summary["stacks"].append(
+            {
+                "stack": os.path.relpath(stack, wrapper_config["rootdir"]),
+                "path": stack,
+                "status": status,
+                "returncode": result and result["returncode"],
+                "duration": result and result["duration"],
+                "output_tail": result and result["tail"],
+                "timeout": result and result.get("timeout"),
+            }
+        )
+    return summary
+
+
+def write_summary_json(summary, path):
+    """Write the summary of a foreach execution as JSON."""
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2)
+    logger.info("Wrote foreach summary to {}".format(path))
+
+
+def write_summary_junit(summary, path):
+    """Write the summary of a foreach execution as a JUnit XML report, with a test case per stack."""
+    from xml.etree import ElementTree
+
+    statuses = [result["status"] for result in summary["stacks"]]
+    testsuites = ElementTree.Element("testsuites")
+    testsuite = ElementTree.SubElement(
+        testsuites,
+        "testsuite",
+        name="tfwrapper foreach",
+        tests=str(len(statuses)),
+        failures=str(statuses.count("failure")),
+        errors="0",
+        skipped=str(statuses.count("skipped")),
+        time="{:.3f}".format(summary["duration"]),
+    )
+    ElementTree.SubElement(
+        ElementTree.SubElement(testsuite, "properties"), "property", name="command", value=" ".join(summary["command"])
+    )
+    for result in summary["stacks"]:
+        testcase = ElementTree.SubElement(
+            testsuite,
+            "testcase",
+            classname="tfwrapper.foreach",
+            name=result["stack"],
+            time="{:.3f}".format(result["duration"] or 0),
+        )
+        if result["status"] == "skipped":
+            ElementTree.SubElement(testcase, "skipped")
+        elif result["status"] == "failure":
+            if result.get("timeout"):
+                message = "Command killed after a {}".format(result["timeout"])
+            else:
+                message = "Command failed with return code {}".format(result["returncode"])
+            failure = ElementTree.SubElement(testcase, "failure", message=message)
+            failure.text = result["output_tail"]
+    ElementTree.indent(testsuites)
+    ElementTree.ElementTree(testsuites).write(path, encoding="utf-8", xml_declaration=True)
+    logger.info("Wrote foreach JUnit report to {}".format(path))
@@ -0,0 +1,104 @@
+"""History of the commands executed by foreach, stored in a SQLite database in the .run directory.
+
+The duration of the previous executions of a command for a stack is used to schedule the longest stacks first,
+to estimate the remaining time of foreach and to adapt the number of commands run at a time. It is local to each
+machine, so it is never used to select shards.
+"""
+
+import os
+import sqlite3
+import statistics
+
+HISTORY_FILENAME = "history.sqlite"
+# oldest executions are removed from the history beyond this number of executions
+HISTORY_MAX_ROWS = 100000
+# number of the latest successful executions of a command for a stack used to estimate its duration
+ESTIMATE_SAMPLES = 5
+
+
+def connect(rootdir):
+    """Open the history database of the project, creating it if needed."""
+    os.makedirs(os.path.join(rootdir, ".run"), exist_ok=True)
+    connection = sqlite3.connect(os.path.join(rootdir, ".run", HISTORY_FILENAME), timeout=30)
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS executions ("
+            "id INTEGER PRIMARY KEY, started_at REAL NOT NULL, stack TEXT NOT NULL, command TEXT NOT NULL, "
+            "returncode INTEGER NOT NULL, duration REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS executions_stack_command ON executions (stack, command, started_at)")
+    return connection
+
+
+def record(rootdir, executions):
+    """Record executions, as dicts with started_at timestamp, stack, command, returncode and duration in seconds."""
+    connection = connect(rootdir)
+    try:
+        with connection:
+            connection.executemany(
+                "INSERT INTO executions (started_at, stack, command, returncode, duration) "
+                "VALUES (:started_at, :stack, :command, :returncode, :duration)",
+                executions,
+            )
+            connection.execute(
+                "DELETE FROM executions WHERE id <= (SELECT MAX(id) FROM executions) - ?",
+                (HISTORY_MAX_ROWS,),
+            )
+    finally:
+        connection.close()
+
+
+def get_durations(rootdir, command, stacks):
+    """Estimate the duration of a command for stacks, from their latest successful executions.
+
+    The executions of other commands for a stack are used if the command was never executed successfully for it.
+    Returns a dict of stack => duration in seconds, without the stacks which were never executed successfully.
+    """
+    if not os.path.exists(os.path.join(rootdir, ".run", HISTORY_FILENAME)):
+        return {}
+    connection = connect(rootdir)
+    try:
+        durations = {}
+        for stack in stacks:
+            for condition, parameters in (("command = ?", (command,)), ("1", ())):
+                rows = connection.execute(
+                    "SELECT duration FROM executions WHERE stack = ? AND {} AND returncode = 0 "
+                    "ORDER BY started_at DESC LIMIT ?".format(condition),
+                    (stack, *parameters, ESTIMATE_SAMPLES),
+                ).fetchall()
+                if rows:
+                    durations[stack] = statistics.median(row[0] for row in rows)
+                    break
+        return durations
+    finally:
+        connection.close()
+
+
+def query(rootdir, stack=None, command=None, limit=None):
+    """Get the latest executions, from the newest, filtered by stack and command glob patterns.
+
+    Returns a list of dicts with started_at timestamp, stack, command, returncode and duration in seconds.
+    """
+    if not os.path.exists(os.path.join(rootdir, ".run", HISTORY_FILENAME)):
+        return []
+    connection = connect(rootdir)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(
+            "SELECT started_at, stack, command, returncode, duration FROM executions "
+            "WHERE stack GLOB ? AND command GLOB ? ORDER BY started_at DESC, id DESC LIMIT ?",
+            (stack or "*", command or "*", -1 if limit is None else limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        connection.close()
+
+
+def format_duration(seconds):
+    """Format a duration in seconds for humans, like 1h02m, 3m05s or 12.3s."""
+    if seconds < 60:
+        return "{:.1f}s".format(seconds)
+    minutes, seconds = divmod(round(seconds), 60)
+    if minutes < 60:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}h{:02d}m".format(*divmod(minutes, 60))
@@ -0,0 +1,109 @@
+"""Index of the local modules used by stacks, to find the stacks affected by the changes of a module.
+
+The module sources of each directory are stored in an index file along with the signature of its Terraform files,
+so that only the directories which changed since the previous execution are parsed again.
+"""
+
+import os
+import re
+
+from . import timings
+from .utils import get_hcl_blocks, load_pickle_file, save_pickle_file
+
+# module blocks and their local source, which starts with ./ or ../ as opposed to registry and remote sources
+MODULE_BLOCK_REGEX = re.compile(r'module\s+"[^"]*"\s*\{')
+MODULE_LOCAL_SOURCE_REGEX = re.compile(r'\bsource\s*=\s*"(\.\.?/[^"$]*)"')
+# bumped when the format of the index changes
+INDEX_VERSION = 1
+
+
+def get_directory_signature(directory):
+    """Get the mtime of a directory and the mtime and size of its Terraform files, or None if it does not exist."""
+    try:
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".tf") and entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_mtime_ns, st.st_size))
+        return os.stat(directory).st_mtime_ns, tuple(sorted(files))
+    except OSError:
+        return None
+
+
+def get_module_sources(directory):
+    """Get the absolute directories of the local modules used by the Terraform files of a directory."""
+    sources = set()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".tf"):
+            continue
+        with open(os.path.join(directory, name), errors="replace") as f:
+            content = f.read()
+        for block in get_hcl_blocks(content, MODULE_BLOCK_REGEX):
+            for source in MODULE_LOCAL_SOURCE_REGEX.findall(block):
+                sources.add(os.path.normpath(os.path.join(directory, source)))
+    return sorted(sources)
+
+
+def get_stacks_modules(index_file, stacks):
+    """Get the local modules used by stacks, directly or through other modules.
+
+    The module sources of directories are reused from index_file if their Terraform files did not change, and the
+    index file is updated otherwise.
+
+    :param index_file: str: path to the index file
+    :param stacks: iterable: stack directories
+    :return dict: stack directory => set of module directories
+    """
+    index = load_pickle_file(index_file)
+    if not isinstance(index, dict) or index.get("version") != INDEX_VERSION:
+        index = {"version": INDEX_VERSION, "directories": {}}
+    directories = index["directories"]
+    changed = False
+
+    def get_sources(directory):
+        nonlocal changed
+        signature = get_directory_signature(directory)
+        entry = directories.get(directory)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        sources = get_module_sources(directory) if signature is not None else []
+        directories[directory] = (signature, sources)
+        changed = True
+        return sources
+
+    stacks_modules = {}
+    with timings.phase("module index") as record:
+        for stack in stacks:
+            stack_dir = os.path.abspath(stack)
+            modules = set()
+            pending = list(get_sources(stack_dir))
+            while pending:
+                module = pending.pop()
+                if module not in modules and module != stack_dir:
+                    modules.add(module)
+                    pending.extend(get_sources(module))
+            stacks_modules[stack] = modules
+        if record is not None:
+            record["cache"] = "miss" if changed else "hit"
+
+    if changed:
+        # forget the directories which do not exist anymore
+        index["directories"] = {d: entry for d, entry in directories.items() if entry[0] is not None}
+        try:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            save_pickle_file(index_file, index)
+        except OSError:
+            pass
+    return stacks_modules
+
+
+def get_module_stacks(stacks_modules):
+    """Reverse the modules used by stacks, as returned by get_stacks_modules(), into the stacks using each module.
+
+    :return dict: module directory => set of stack directories
+    """
+    module_stacks = {}
+    for stack, modules in stacks_modules.items():
+        for module in modules:
+            module_stacks.setdefault(module, set()).add(stack)
+    return module_stacks
@@ -0,0 +1,151 @@
+"""Output of the commands executed by foreach.
+
+In the stream mode, commands write directly to the terminal. In the prefix mode, each line of output is prefixed
+by the stack it comes from. In the group mode, the output of each command is written at once when it is done.
+The last lines of output of each command can also be kept, for the foreach summary, and its output can be watched,
+to detect hung commands or to adapt the number of commands run at a time.
+"""
+
+import collections
+import os
+import subprocess
+import sys
+import threading
+import time
+
+OUTPUT_MODE_STREAM = "stream"
+OUTPUT_MODE_PREFIX = "prefix"
+OUTPUT_MODE_GROUP = "group"
+OUTPUT_MODES = (OUTPUT_MODE_STREAM, OUTPUT_MODE_PREFIX, OUTPUT_MODE_GROUP)
+
+# output of a command kept in memory in the group mode before spilling to its log file, in bytes
+GROUP_BUFFER_SIZE = 1024 * 1024
+# number of lines of output kept by commands keeping their tail
+TAIL_LINES = 20
+
+# serializes writes of all commands to stdout
+_stdout_lock = threading.Lock()
+
+
+def write_stdout(data):
+    """Write bytes to stdout, at once."""
+    with _stdout_lock:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+
+def write_stderr(data):
+    """Write bytes to stderr."""
+    sys.stderr.flush()
+    sys.stderr.buffer.write(data)
+    sys.stderr.buffer.flush()
+
+
+class CommandOutput:
+    """Copy the output of a command to stdout according to the output mode, from a thread reading its pipe."""
+
+    def __init__(self, mode, label, log_file, keep_tail=False, watch=False, on_line=None):
+        """Initialize the output of the command executed for the stack named label.
+
+        The group mode spills the output to log_file if it does not fit in memory.
+        If keep_tail is True, the last lines of stderr are kept, or of stdout and stderr in the prefix and group modes.
+        If watch is True, the time of the last line of output is kept in last_output, in all modes.
+        If on_line is set, it is called with each line of output, as bytes, in all modes.
+        """
+        self.mode = mode
+        self.label = label
+        self.log_file = log_file
+        self.spilled = False
+        self.watch = watch or on_line is not None
+        self.on_line = on_line
+        self.last_output = None
+        self._tail = collections.deque(maxlen=TAIL_LINES) if keep_tail else None
+        self._buffer = []
+        self._buffer_size = 0
+        self._log = None
+        self._threads = []
+
+    def popen_kwargs(self):
+        """Get the subprocess.Popen arguments redirecting the output of the command for this mode."""
+        if self.mode == OUTPUT_MODE_STREAM:
+            if self.watch:
+                return {"stdout": subprocess.PIPE, "stderr": subprocess.PIPE}
+            return {} if self._tail is None else {"stderr": subprocess.PIPE}
+        return {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+
+    def start(self, process):
+        """Start copying the output of the started process."""
+        self.last_output = time.monotonic()
+        streams = []
+        if self.mode != OUTPUT_MODE_STREAM or self.watch:
+            streams.append((process.stdout, False))
+        if self.mode == OUTPUT_MODE_STREAM and (self._tail is not None or self.watch):
+            streams.append((process.stderr, True))
+        for stream, is_stderr in streams:
+            thread = threading.Thread(target=self._copy, args=(stream, is_stderr), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def finish(self):
+        """Wait for the whole output of the command to be copied, and write it in the group mode."""
+        if not self._threads:
+            return
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.mode == OUTPUT_MODE_GROUP:
+            self._flush_group()
+
+    def get_tail(self):
+        """Get the last lines of output kept, as text."""
+        if self._tail is None:
+            return None
+        return b"".join(self._tail).decode(errors="replace")
+
+    def _copy(self, stream, is_stderr):
+        prefix = "[{}] ".format(self.label).encode()
+        for line in stream:
+            self.last_output = time.monotonic()
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            if self.on_line is not None:
+                self.on_line(line)
+            if self._tail is not None and (is_stderr or self.mode != OUTPUT_MODE_STREAM):
+                self._tail.append(line)
+            if self.mode == OUTPUT_MODE_STREAM:
+                (write_stderr if is_stderr else write_stdout)(line)
+            elif self.mode == OUTPUT_MODE_PREFIX:
+                write_stdout(prefix + line)
+            else:
+                self._append(line)
+
+    def _append(self, data):
+        if self._log is None and self._buffer_size + len(data) > GROUP_BUFFER_SIZE:
+            os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+            self._log = open(self.log_file, "wb")
+            self._log.writelines(self._buffer)
+            self._buffer = []
+            self.spilled = True
+        if self._log is not None:
+            self._log.write(data)
+        else:
+            self._buffer.append(data)
+            self._buffer_size += len(data)
+
+    def _flush_group(self):
+        header = "==> {} <==\n".format(self.label).encode()
+        with _stdout_lock:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(header)
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+                with open(self.log_file, "rb") as f:
+                    while chunk := f.read(GROUP_BUFFER_SIZE):
+                        sys.stdout.buffer.write(chunk)
+            else:
+                sys.stdout.buffer.writelines(self._buffer)
+            sys.stdout.buffer.flush()
+        self._buffer = []
+        self._buffer_size = 0
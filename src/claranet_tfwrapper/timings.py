@@ -0,0 +1,136 @@
+"""Record the wall time of tfwrapper phases, for the --timings and --timings-file arguments.
+
+Phases are recorded with the phase() context manager, which does nothing unless recording was enabled.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_origin = None
+_phases = []
+# nesting depth of phases, per thread as foreach may run commands from several threads
+_local = threading.local()
+
+
+def enable():
+    """Start recording phases, from now on."""
+    global _origin
+    _origin = time.perf_counter()
+    _local.depth = 0
+    _phases.clear()
+
+
+def disable():
+    """Stop recording phases and forget the recorded ones."""
+    global _origin
+    _origin = None
+    _phases.clear()
+
+
+def is_enabled():
+    """Tell whether phases are being recorded."""
+    return _origin is not None
+
+
+def get_phases():
+    """Get the recorded phases, as dicts with name, detail, start and duration in seconds, depth and thread id."""
+    return list(_phases)
+
+
+@contextlib.contextmanager
+def phase(name, detail=None):
+    """Record the wall time of the enclosed block as a phase.
+
+    Yields the phase dict if recording, so that the caller can add information to it, otherwise None.
+    """
+    origin = _origin
+    if origin is None:
+        yield None
+        return
+
+    depth = getattr(_local, "depth", 0)
+    record = {
+        "name": name,
+        "detail": detail,
+        "start": time.perf_counter() - origin,
+        "duration": None,
+        "depth": depth,
+        "thread": threading.get_ident(),
+    }
+    _phases.append(record)
+    _local.depth = depth + 1
+    try:
+        yield record
+    finally:
+        _local.depth = depth
+        record["duration"] = time.perf_counter() - origin - record["start"]
+
+
+def add_phases(phases, parent):
+    """Record phases measured in another process, like the daemon, as children of a phase of this process."""
+    if _origin is None or parent is None:
+        return
+    for record in phases:
+        _phases.append(
+            dict(
+                record,
+                start=parent["start"] + record["start"],
+                depth=parent["depth"] + 1 + record["depth"],
+                thread=parent["thread"],
+            ),
+        )
+
+
+def format_report():
+    """Format the recorded phases as a table, in order of start with children indented below their parent."""
+    total = time.perf_counter() - _origin
+    rows = [
+        (
+            "  " * record["depth"] + record["name"],
+            " ".join(str(v) for v in (record["detail"], record.get("cache") and "cache {}".format(record["cache"])) if v),
+            "{:.1f} ms".format(record["duration"] * 1000) if record["duration"] is not None else "-",
+        )
+        for record in _phases
+    ]
+    rows.append(("total", "", "{:.1f} ms".format(total * 1000)))
+
+    headers = ("Phase", "Detail", "Duration")
+    widths = [max(len(row[i]) for row in [headers, *rows]) for i in range(3)]
+    lines = []
+    for row in [headers, *rows]:
+        lines.append("{:<{}}  {:<{}}  {:>{}}".format(row[0], widths[0], row[1], widths[1], row[2], widths[2]).rstrip())
+    return "\n".join(lines)
+
+
+def print_report(file=None):
+    """Print the recorded phases as a table, on stderr by default."""
+    print(format_report(), file=file or sys.stderr)
+
+
+def write_trace(path):
+    """Write the recorded phases as a JSON trace, in the Trace Event Format read by chrome://tracing and Perfetto.
+
+    Phases are nested per thread, e.g. the threads of foreach --jobs, which are numbered from 0 in order of appearance.
+    """
+    events = []
+    tids = {}
+    for record in _phases:
+        args = {k: v for k, v in record.items() if k not in ("name", "start", "duration", "depth", "thread") and v is not None}
+        events.append(
+            {
+                "name": record["name"],
+                "cat": "tfwrapper",
+                "ph": "X",
+                "ts": round(record["start"] * 1000000),
+                "dur": round((record["duration"] or 0) * 1000000),
+                "pid": os.getpid(),
+                "tid": tids.setdefault(record.get("thread"), len(tids)),
+                "args": args,
+            }
+        )
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=2)
@@ -1,5 +1,23 @@
 """Utility functions for tfwrapper."""
 
+import hashlib
+import os
+import pickle
+import tempfile
+from copy import deepcopy
+
+import yaml
+
+from . import timings
+
+# use the LibYAML based loader when PyYAML was built with it, it is an order of magnitude faster
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# parsed YAML documents by absolute path, along with the mtime and size of the file they were parsed from
+_yaml_cache = {}
+# directory storing parsed YAML documents by path with their content hash, shared between processes, see set_yaml_cache_dir()
+_yaml_cache_dir = None
+
 
 def format_env(env):
     """Format a dict containing environment variables for usage on a shell prompt."""
@@ -15,3 +33,113 @@ def get_dict_value(dic, *keys, default=None):
         return d
     except KeyError:
         return default
+
+
+def get_files_signature(paths):
+    """Get the mtime and size of files, or None for the ones which do not exist."""
+    signature = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature[path] = None
+            continue
+        signature[path] = (st.st_mtime_ns, st.st_size)
+    return signature
+
+
+def get_hcl_blocks(content, block_regex):
+    """Get the bodies of the HCL blocks of content whose header, up to the opening brace, matches block_regex."""
+    blocks = []
+    for match in block_regex.finditer(content):
+        # the block ends at its matching closing brace
+        depth, end = 1, match.end()
+        while depth and end < len(content):
+            depth += {"{": 1, "}": -1}.get(content[end], 0)
+            end += 1
+        blocks.append(content[match.end() : end - 1])
+    return blocks
+
+
+def load_pickle_file(path):
+    """Load data stored with save_pickle_file(), or None if the file does not exist or cannot be loaded."""
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+        return None
+
+
+def save_pickle_file(path, data):
+    """Store data in a pickle file, atomically as files of the .run directory are shared by concurrent executions.
+
+    Raises OSError if the file cannot be written.
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, path)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def set_yaml_cache_dir(cache_dir):
+    """Store parsed YAML documents in cache_dir to share them between processes, or only in this process if None."""
+    global _yaml_cache_dir
+    _yaml_cache_dir = cache_dir
+
+
+def load_yaml_file(path, persistent=True):
+    """Load a YAML file, reusing the document parsed earlier in this process if the file did not change.
+
+    Unless persistent is False, documents are also reused from the YAML cache dir if the content did not change.
+    Returns a copy of the document which can be modified by the caller.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    cached = _yaml_cache.get(path)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return deepcopy(cached[1])
+
+    with timings.phase("yaml load", path) as record:
+        with open(path, "rb") as f:
+            content = f.read()
+        if persistent and _yaml_cache_dir:
+            document = _load_yaml_content_cached(path, content, record)
+        else:
+            document = yaml.load(content, Loader=YamlLoader)
+    _yaml_cache[path] = ((st.st_mtime_ns, st.st_size), document)
+    return deepcopy(document)
+
+
+def _load_yaml_content_cached(path, content, record=None):
+    """Parse the YAML content of a file, reusing the document stored in the YAML cache dir if the content is the same.
+
+    There is a single cache file per source file, replaced whenever its content changes, so that the cache dir does
+    not grow with every edit.
+    """
+    cache_file = os.path.join(_yaml_cache_dir, hashlib.sha256(path.encode()).hexdigest() + ".pickle")
+    digest = hashlib.sha256(content).hexdigest()
+    cached = load_pickle_file(cache_file)
+    if isinstance(cached, tuple) and len(cached) == 2 and cached[0] == digest:
+        if record is not None:
+            record["cache"] = "hit"
+        return cached[1]
+    if record is not None:
+        record["cache"] = "miss"
+
+    document = yaml.load(content, Loader=YamlLoader)
+    try:
+        os.makedirs(_yaml_cache_dir, exist_ok=True)
+        save_pickle_file(cache_file, (digest, document))
+    except OSError:
+        pass
+    return document
+
+
+def clear_yaml_cache():
+    """Forget all YAML documents parsed in this process."""
+    _yaml_cache.clear()
@@ -33,6 +33,19 @@ def default_args():
     return args
 
 
+@pytest.fixture
+def fake_terraform(tmp_path, monkeypatch):
+    # install terraform 1.1.4 in a fake home directory, so that it is not downloaded
+    home = tmp_path / "home"
+    tool_dir = home / ".terraform.d" / "versions" / "1.1" / "1.1.4"
+    tool_dir.mkdir(parents=True)
+    tool = tool_dir / "terraform"
+    tool.write_text("#!/bin/sh\nexit 0\n")
+    tool.chmod(0o755)
+    monkeypatch.setenv("HOME", str(home))
+    return tool
+
+
 @pytest.fixture
 def tmp_working_dir(tmp_path):
     # alter default HTTP cache dir to ensure all tests have their own empty cache
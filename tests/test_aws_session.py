@@ -0,0 +1,42 @@
+"""Test AWS sessions are cached per environment and do not prompt when not interactive."""
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+
+
+@pytest.fixture
+def aws_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(tfwrapper, "_aws_sessions", {})
+    config_file = tmp_path / "config"
+    config_file.write_text(
+        "[profile mfa]\n"
+        "role_arn = arn:aws:iam::123456789012:role/test\n"
+        "source_profile = test\n"
+        "mfa_serial = arn:aws:iam::123456789012:mfa/test\n"
+    )
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config_file))
+    for name in ("a", "b"):
+        (tmp_path / "credentials_{}".format(name)).write_text(
+            "[test]\naws_access_key_id = AKIA{}\naws_secret_access_key = secret\n".format(name.upper())
+        )
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "credentials_a"))
+    return tmp_path
+
+
+def test_aws_session_per_environment(aws_files, monkeypatch):
+    session_cache_file = aws_files / "session_cache.pickle"
+
+    session = tfwrapper._get_aws_session(str(session_cache_file), "eu-west-1", "test")
+    assert session.get_credentials().access_key == "AKIAA"
+    assert tfwrapper._get_aws_session(str(session_cache_file), "eu-west-1", "test") is session
+
+    # e.g. another client of the daemon
+    session_cache_file.unlink()
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(aws_files / "credentials_b"))
+    assert tfwrapper._get_aws_session(str(session_cache_file), "eu-west-1", "test").get_credentials().access_key == "AKIAB"
+
+
+def test_aws_session_not_interactive(aws_files):
+    with pytest.raises(tfwrapper.InteractionRequired, match="MFA"):
+        tfwrapper._get_aws_session(str(aws_files / "session_cache.pickle"), "eu-west-1", "mfa", interactive=False)
@@ -2,13 +2,21 @@
 
 from copy import deepcopy
 
+import json
 import os
 import pathlib
+import re
+import signal
+import subprocess
+import sys
 import textwrap
+import time
 
 import pytest
+from xml.etree import ElementTree
 
 import claranet_tfwrapper as tfwrapper
+from claranet_tfwrapper import concurrency, foreach, history, output
 
 
 @pytest.fixture
@@ -117,8 +125,9 @@ def test_foreach_select_all_stacks(tmp_working_dir_multiple_stacks, multiple_sta
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks_with_configs = tfwrapper.foreach_select_stacks(wrapper_config)
-    for stack_path, stack_config in stacks_with_configs.items():
+    stack_handles = list(foreach.select_stacks(wrapper_config))
+    for stack_handle in stack_handles:
+        stack_path, stack_config = stack_handle.path, stack_handle.load_config()
         wrapper_stack_config = deepcopy(wrapper_config)
         parents_count = tfwrapper.detect_config_dir(wrapper_stack_config, dir=stack_path)
         tfwrapper.detect_stack(wrapper_stack_config, parents_count, raise_on_missing=False, dir=stack_path)
@@ -130,13 +139,32 @@ def test_foreach_select_all_stacks(tmp_working_dir_multiple_stacks, multiple_sta
         assert stack_env["TFWRAPPER_stack"] == wrapper_stack_config["stack"]
         assert stack_env["TFWRAPPER_region"] == (wrapper_stack_config["region"] or "")
 
-    stacks = [*stacks_with_configs]
+    stacks = [stack_handle.path for stack_handle in stack_handles]
     for i in range(len(stacks)):
         assert str(stacks[i]) == tfwrapper.get_stack_dir(wrapper_config["rootdir"], *multiple_stacks[i])
     assert len(stacks) == len(multiple_stacks)
     assert "Stack config conf/account2_global_default.yml has no matching directory at" in caplog.text
 
 
+def test_foreach_stack_handle(tmp_working_dir_multiple_stacks, default_args, monkeypatch):
+    wrapper_config = deepcopy(vars(default_args))
+    tfwrapper.detect_config_dir(wrapper_config)
+    stack_handles = {stack_handle.path: stack_handle for stack_handle in foreach.select_stacks(wrapper_config)}
+    stack_handle = stack_handles[tfwrapper.get_stack_dir(wrapper_config["rootdir"], "account0", "global", None, "default")]
+
+    # the environment of a stack is built from its handle, without detecting the stack from its directory again
+    for function in ("detect_config_dir", "detect_stack", "find_config_dir"):
+        monkeypatch.setattr(tfwrapper, function, lambda *args, **kwargs: pytest.fail("Unexpected stack detection"))
+    stack_env = stack_handle.get_envvars(stack_handle.load_config())
+
+    assert stack_handle.config_file == "conf/account0_global_default.yml"
+    assert (stack_env["TFWRAPPER_account"], stack_env["TFWRAPPER_environment"]) == ("account0", "global")
+    assert (stack_env["TFWRAPPER_region"], stack_env["TFWRAPPER_stack"]) == ("", "default")
+    assert stack_env["TFWRAPPER_TF_myvar"] == "myvalue"
+    with pytest.raises(AttributeError):
+        stack_handle.stack = "other"
+
+
 def test_foreach_select_from_dir_account0(tmp_working_dir_multiple_stacks, multiple_stacks, default_args):
     paths = tmp_working_dir_multiple_stacks
 
@@ -146,7 +174,7 @@ def test_foreach_select_from_dir_account0(tmp_working_dir_multiple_stacks, multi
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "global", None, "default"),
@@ -178,7 +206,7 @@ def test_foreach_select_from_dir_account0_prod(tmp_working_dir_multiple_stacks,
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "prod", "eu-west-1", "default"),
@@ -200,7 +228,7 @@ def test_foreach_select_from_dir_account0_prod_euw1(tmp_working_dir_multiple_sta
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "prod", "eu-west-1", "default"),
@@ -218,7 +246,7 @@ def test_foreach_select_from_args_account0(tmp_working_dir_multiple_stacks, mult
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "global", None, "default"),
@@ -248,7 +276,7 @@ def test_foreach_select_from_args_env_preprod(tmp_working_dir_multiple_stacks, m
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "preprod", "eu-west-1", "default"),
@@ -272,7 +300,7 @@ def test_foreach_select_from_args_region_euw1(tmp_working_dir_multiple_stacks, m
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "preprod", "eu-west-1", "default"),
@@ -302,7 +330,7 @@ def test_foreach_select_from_args_stack_default(
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "global", None, "default"),
@@ -332,7 +360,7 @@ def test_foreach_select_from_args_env_preprod_stack_default(tmp_working_dir_mult
     parents_count = tfwrapper.detect_config_dir(wrapper_config)
     tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
 
-    stacks = [*tfwrapper.foreach_select_stacks(wrapper_config)]
+    stacks = [stack_handle.path for stack_handle in foreach.select_stacks(wrapper_config)]
 
     expected_stacks = [
         ("account0", "preprod", "eu-west-1", "default"),
@@ -569,3 +597,1043 @@ def test_foreach_from_account0_preprod_euw1_default_dir(tmp_working_dir_multiple
         )
         == captured.out
     )
+
+
+def test_foreach_jobs(tmp_working_dir_multiple_stacks, capfd, tmp_path):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    started_dir = tmp_path / "started"
+    started_dir.mkdir()
+
+    # each command waits for all the others to be started, which only happens if they run concurrently
+    command = textwrap.dedent(
+        """
+        touch "{started}/$TFWRAPPER_region-$TFWRAPPER_stack"
+        for i in $(seq 100); do [ "$(ls {started} | wc -l)" -ge 4 ] && break; sleep 0.05; done
+        [ "$(ls {started} | wc -l)" -ge 4 ] && pwd
+        """
+    ).format(started=started_dir)
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--jobs", "4", "-S", command])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert sorted(captured.out.splitlines()) == [
+        "{}/account0/prod/eu-west-1/default".format(paths["working_dir"]),
+        "{}/account0/prod/eu-west-1/infra".format(paths["working_dir"]),
+        "{}/account0/prod/eu-west-4/default".format(paths["working_dir"]),
+        "{}/account0/prod/eu-west-4/infra".format(paths["working_dir"]),
+    ]
+
+
+def test_foreach_jobs_failure(tmp_working_dir_multiple_stacks, caplog):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", "2", "-S", 'sleep 0.2; [ "$TFWRAPPER_region" != eu-west-1 ] || exit 3'])
+
+    assert e.value.code == 3
+    assert "stacks were skipped" in caplog.text
+
+
+def test_foreach_jobs_invalid(tmp_working_dir_multiple_stacks):
+    with pytest.raises(ValueError) as e:
+        tfwrapper.main(["foreach", "-j", "0", "--", "true"])
+    assert "foreach: error: -j/--jobs must be a positive number" in str(e.value)
+
+
+def test_foreach_jobs_auto(tmp_working_dir_multiple_stacks, capfd, caplog, monkeypatch):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    monkeypatch.setattr(concurrency, "get_cpu_count", lambda: 2)
+    monkeypatch.setattr(concurrency, "get_available_memory", lambda: 8192)
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--jobs", "auto", "-S", 'echo "Error: ThrottlingException: Rate exceeded" >&2; pwd'])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert len(captured.out.splitlines()) == 4
+    assert captured.err.splitlines().count("Error: ThrottlingException: Rate exceeded") == 4
+    assert "Running 2 commands at a time, up to 4, from 2 CPUs and 8192 MiB of available memory" in caplog.text
+    assert "Running 1 commands at a time instead of 2 after API rate limit errors" in caplog.text
+
+
+def test_foreach_jobs_ctrl_c(tmp_working_dir_multiple_stacks, tmp_path):
+    paths = tmp_working_dir_multiple_stacks
+    started_dir = tmp_path / "started"
+    started_dir.mkdir()
+
+    command = 'trap "echo interrupted; exit 130" INT; touch "{}/$TFWRAPPER_stack"; sleep 10 >/dev/null 2>&1 & wait'.format(
+        started_dir
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-c", "import claranet_tfwrapper; claranet_tfwrapper.main()", "foreach", "-j", "2", "-S", command],
+        cwd=paths["working_dir"] / "account0/prod/eu-west-1",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+    )
+    for _ in range(100):
+        if len(os.listdir(started_dir)) == 2:
+            break
+        time.sleep(0.05)
+
+    start = time.time()
+    process.send_signal(signal.SIGINT)
+    stdout, stderr = process.communicate(timeout=10)
+
+    assert time.time() - start < 5
+    assert process.returncode == 130
+    assert stdout.splitlines() == ["interrupted", "interrupted"]
+    assert "Received Ctrl+C, forwarding it to 2 running commands" in stderr
+
+
+def test_foreach_output_prefix(tmp_working_dir_multiple_stacks, capfd):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", "4", "--output", "prefix", "-S", "echo first; echo second >&2; printf third"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    lines = captured.out.splitlines()
+    assert len(lines) == 12
+    for stack in ("eu-west-1/default", "eu-west-1/infra", "eu-west-4/default", "eu-west-4/infra"):
+        prefix = "[account0/prod/{}] ".format(stack)
+        assert [line for line in lines if line.startswith(prefix)] == [prefix + "first", prefix + "second", prefix + "third"]
+
+
+def test_foreach_output_group(tmp_working_dir_multiple_stacks, capfd):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", "4", "-o", "group", "-S", "echo first; sleep 0.1; echo second"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    groups = captured.out.split("==> ")[1:]
+    assert sorted(groups) == [
+        "account0/prod/{} <==\nfirst\nsecond\n".format(stack)
+        for stack in ("eu-west-1/default", "eu-west-1/infra", "eu-west-4/default", "eu-west-4/infra")
+    ]
+
+
+def test_foreach_output_group_spill(tmp_working_dir_multiple_stacks, capfd, monkeypatch):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod/eu-west-1/default"))
+    monkeypatch.setattr(output, "GROUP_BUFFER_SIZE", 10)
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-o", "group", "-S", "seq 10"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    expected = "".join("{}\n".format(i) for i in range(1, 11))
+    assert captured.out == "==> account0/prod/eu-west-1/default <==\n" + expected
+    log_file = paths["working_dir"] / ".run" / foreach.LOGS_DIRNAME / "account0_prod_eu-west-1_default.log"
+    assert log_file.read_text() == expected
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_foreach_keep_going_summary_json(tmp_working_dir_multiple_stacks, tmp_path, capfd, caplog, jobs):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    summary_file = tmp_path / "summary.json"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            [
+                "foreach",
+                "-j",
+                jobs,
+                "--keep-going",
+                "--summary-json",
+                str(summary_file),
+                "-S",
+                'echo "to $TFWRAPPER_stack" >&2; [ "$TFWRAPPER_region" != eu-west-1 ] || exit 3',
+            ]
+        )
+    captured = capfd.readouterr()
+
+    assert e.value.code == 3
+    assert "to default" in captured.err
+    assert "Command failed for 2 of 4 stacks: account0/prod/eu-west-1/default, account0/prod/eu-west-1/infra" in caplog.text
+
+    summary = json.loads(summary_file.read_text())
+    assert summary["command"] == ['echo "to $TFWRAPPER_stack" >&2; [ "$TFWRAPPER_region" != eu-west-1 ] || exit 3']
+    assert [(s["stack"], s["status"], s["returncode"], s["output_tail"]) for s in summary["stacks"]] == [
+        ("account0/prod/eu-west-1/default", "failure", 3, "to default\n"),
+        ("account0/prod/eu-west-1/infra", "failure", 3, "to infra\n"),
+        ("account0/prod/eu-west-4/default", "success", 0, "to default\n"),
+        ("account0/prod/eu-west-4/infra", "success", 0, "to infra\n"),
+    ]
+    assert all(s["duration"] >= 0 for s in summary["stacks"])
+
+
+def test_foreach_summary_junit(tmp_working_dir_multiple_stacks, tmp_path):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    report_file = tmp_path / "report.xml"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            [
+                "foreach",
+                "--summary-junit",
+                str(report_file),
+                "-S",
+                'seq 30 >&2; [ "$TFWRAPPER_stack" != infra ] || exit 2',
+            ]
+        )
+
+    assert e.value.code == 2
+    testsuite = ElementTree.parse(report_file).getroot().find("testsuite")
+    assert testsuite.attrib["tests"] == "4"
+    assert testsuite.attrib["failures"] == "1"
+    assert testsuite.attrib["skipped"] == "2"
+    testcases = testsuite.findall("testcase")
+    assert [testcase.attrib["name"] for testcase in testcases] == [
+        "account0/prod/eu-west-1/default",
+        "account0/prod/eu-west-1/infra",
+        "account0/prod/eu-west-4/default",
+        "account0/prod/eu-west-4/infra",
+    ]
+    assert len(testcases[0]) == 0
+    failure = testcases[1].find("failure")
+    assert failure.attrib["message"] == "Command failed with return code 2"
+    assert failure.text == "".join("{}\n".format(i) for i in range(11, 31))
+    assert testcases[2].find("skipped") is not None
+    assert testcases[3].find("skipped") is not None
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_foreach_timeout(tmp_working_dir_multiple_stacks, tmp_path, caplog, monkeypatch, jobs):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod/eu-west-1"))
+    monkeypatch.setattr(foreach, "WATCHDOG_INTERVAL", 0.1)
+    summary_file = tmp_path / "summary.json"
+
+    # the background sleep survives its shell and keeps its output open unless its process group is killed
+    start = time.monotonic()
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            [
+                "foreach",
+                "-j",
+                jobs,
+                "--keep-going",
+                "--timeout",
+                "1",
+                "--summary-json",
+                str(summary_file),
+                "-S",
+                '[ "$TFWRAPPER_stack" != infra ] || { echo hung >&2; sleep 30 & wait; }',
+            ]
+        )
+
+    assert time.monotonic() - start < 10
+    assert e.value.code == -signal.SIGTERM
+    assert 'Killing the command in "account0/prod/eu-west-1/infra" after a timeout of 1s' in caplog.text
+    summary = json.loads(summary_file.read_text())
+    assert [(s["stack"], s["status"], s["timeout"], s["output_tail"]) for s in summary["stacks"]] == [
+        ("account0/prod/eu-west-1/default", "success", None, ""),
+        ("account0/prod/eu-west-1/infra", "failure", "timeout", "hung\n"),
+    ]
+
+
+def test_foreach_inactivity_timeout(tmp_working_dir_multiple_stacks, capfd, caplog, monkeypatch):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod/eu-west-1"))
+    monkeypatch.setattr(foreach, "WATCHDOG_INTERVAL", 0.1)
+
+    # the default stack runs for longer than the inactivity timeout, but keeps writing output
+    command = (
+        'if [ "$TFWRAPPER_stack" = infra ]; then echo start; sleep 30; else for i in $(seq 8); do echo $i; sleep 0.2; done; fi'
+    )
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", "2", "-k", "--inactivity-timeout", "1", "-S", command])
+    captured = capfd.readouterr()
+
+    assert e.value.code == -signal.SIGTERM
+    assert sorted(captured.out.splitlines()) == sorted(["start", *(str(i) for i in range(1, 9))])
+    assert 'Killing the command in "account0/prod/eu-west-1/infra" after a inactivity timeout of 1s' in caplog.text
+    assert "account0/prod/eu-west-1/default" not in caplog.text
+
+
+def test_foreach_timeout_stack_config(tmp_working_dir_multiple_stacks, tmp_path, monkeypatch):
+    paths = tmp_working_dir_multiple_stacks
+    pathlib.Path(tfwrapper.get_stack_config_path(paths["conf_dir"], "account0", "prod", "eu-west-1", "infra")).write_text(
+        textwrap.dedent(
+            """
+            ---
+            foreach:
+              timeout: 1
+            terraform:
+              vars:
+                myvar: myvalue
+            """
+        )
+    )
+    os.chdir((paths["working_dir"] / "account0/prod/eu-west-1"))
+    monkeypatch.setattr(foreach, "WATCHDOG_INTERVAL", 0.1)
+    report_file = tmp_path / "report.xml"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-k", "--timeout", "20", "--summary-junit", str(report_file), "-S", "sleep 2"])
+
+    assert e.value.code == -signal.SIGTERM
+    testcases = ElementTree.parse(report_file).getroot().find("testsuite").findall("testcase")
+    assert testcases[0].find("failure") is None
+    assert testcases[1].find("failure").attrib["message"] == "Command killed after a timeout"
+
+
+def test_foreach_limits(tmp_working_dir_multiple_stacks, default_args):
+    paths = tmp_working_dir_multiple_stacks
+    stack_handle = foreach.StackHandle(
+        str(paths["working_dir"] / "account0/prod/eu-west-1/infra"),
+        "",
+        "account0",
+        "prod",
+        "eu-west-1",
+        "infra",
+        limits={"timeout": 0, "memory_limit": 512},
+    )
+    wrapper_config = {"timeout": 600, "inactivity_timeout": 60, "memory_limit": 1024}
+
+    assert foreach.get_limits(wrapper_config, stack_handle) == {
+        "timeout": 0,
+        "inactivity_timeout": 60,
+        "memory_limit": 512,
+    }
+    assert foreach.get_limits({}, stack_handle) == {"timeout": 0, "inactivity_timeout": 0, "memory_limit": 512}
+
+
+@pytest.mark.parametrize("command", [["-S", "ulimit -d"], ["--", "sh", "-c", "ulimit -d"]])
+def test_foreach_memory_limit(tmp_working_dir_multiple_stacks, capfd, monkeypatch, command):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod/eu-west-1/default"))
+    monkeypatch.setattr(foreach, "get_memory_scope_command", lambda: None)
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--memory-limit", "512", *command])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert captured.out == "524288\n"
+
+
+def test_foreach_memory_limit_scope(monkeypatch):
+    monkeypatch.setattr(foreach, "get_memory_scope_command", lambda: ["systemd-run", "--user", "--scope"])
+    scope = ["systemd-run", "--user", "--scope", "--property=MemoryMax=512M", "--"]
+
+    assert foreach.limit_command_memory({"args": ["terraform", "plan"], "env": {}}, 512) == {
+        "args": [*scope, "terraform", "plan"],
+        "env": {},
+        "shell": False,
+        "executable": None,
+    }
+    assert foreach.limit_command_memory({"args": ["echo $A"], "shell": True, "executable": "/bin/bash"}, 512) == {
+        "args": [*scope, "/bin/bash", "-c", "echo $A"],
+        "shell": False,
+        "executable": None,
+    }
+    assert foreach.limit_command_memory({"args": ["true"]}, 0) == {"args": ["true"]}
+
+
+@pytest.mark.parametrize("option", ["--timeout", "--inactivity-timeout", "--memory-limit"])
+def test_foreach_limits_invalid(tmp_working_dir_multiple_stacks, option):
+    with pytest.raises(ValueError) as e:
+        tfwrapper.main(["foreach", option, "-1", "--", "true"])
+    assert "foreach: error: {} must be a positive number or 0".format(option) in str(e.value)
+
+
+@pytest.fixture
+def tmp_working_dir_stack_dependencies(tmp_working_dir_multiple_stacks):
+    """In account0/prod, eu-west-1/default declares a dependency on eu-west-4/infra, which reads eu-west-1/infra state."""
+    paths = tmp_working_dir_multiple_stacks
+    pathlib.Path(tfwrapper.get_stack_config_path(paths["conf_dir"], "account0", "prod", "eu-west-1", "default")).write_text(
+        textwrap.dedent(
+            """
+            ---
+            depends_on:
+              - account0/prod/eu-west-4/infra
+              - account1/prod/eu-west-4/infra
+            terraform:
+              vars:
+                myvar: myvalue
+            """
+        )
+    )
+    (paths["working_dir"] / "account0/prod/eu-west-4/infra/main.tf").write_text(
+        textwrap.dedent(
+            """
+            data "terraform_remote_state" "infra" {
+              backend = "s3"
+              config = {
+                bucket = "my-centralized-terraform-states-bucket"
+                key    = "client/account0/prod/eu-west-1/infra/terraform.state"
+              }
+            }
+
+            data "terraform_remote_state" "dynamic" {
+              backend = "s3"
+              config = {
+                key = "client/${var.account}/prod/eu-west-4/default/terraform.state"
+              }
+            }
+            """
+        )
+    )
+    return paths
+
+
+def test_foreach_stack_dependencies(tmp_working_dir_stack_dependencies, default_args):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    wrapper_config = deepcopy(vars(default_args))
+    parents_count = tfwrapper.detect_config_dir(wrapper_config)
+    tfwrapper.detect_stack(wrapper_config, parents_count, raise_on_missing=False)
+    stacks = {stack_handle.path: stack_handle for stack_handle in foreach.select_stacks(wrapper_config)}
+    stack_dir = str(paths["working_dir"] / "account0/prod") + "/{}"
+
+    dependencies = foreach.get_stack_dependencies(wrapper_config, stacks)
+
+    assert dependencies == {
+        stack_dir.format("eu-west-1/default"): {stack_dir.format("eu-west-4/infra")},
+        stack_dir.format("eu-west-1/infra"): set(),
+        stack_dir.format("eu-west-4/default"): set(),
+        stack_dir.format("eu-west-4/infra"): {stack_dir.format("eu-west-1/infra")},
+    }
+    assert foreach.sort_stacks(dependencies) == [
+        stack_dir.format("eu-west-1/infra"),
+        stack_dir.format("eu-west-4/infra"),
+        stack_dir.format("eu-west-1/default"),
+        stack_dir.format("eu-west-4/default"),
+    ]
+
+
+def test_foreach_stack_dependencies_global_stack(tmp_working_dir_multiple_stacks):
+    paths = tmp_working_dir_multiple_stacks
+    (paths["working_dir"] / "account0/prod/eu-west-1/default/main.tf").write_text(
+        'data "terraform_remote_state" "global" {\n  config = { key = "client/account0/global/default/terraform.state" }\n}\n'
+    )
+
+    assert tfwrapper.get_stack_id(str(paths["working_dir"]), str(paths["working_dir"] / "account0/_global/default")) == (
+        "account0/global/default"
+    )
+    wrapper_config = {"rootdir": str(paths["working_dir"])}
+    stacks = {
+        stack_handle.path: stack_handle
+        for stack_handle in (
+            foreach.StackHandle(
+                str(paths["working_dir"] / "account0/_global/default"), None, "account0", "global", None, "default"
+            ),
+            foreach.StackHandle(
+                str(paths["working_dir"] / "account0/prod/eu-west-1/default"), None, "account0", "prod", "eu-west-1", "default"
+            ),
+        )
+    }
+    assert foreach.get_stack_dependencies(wrapper_config, stacks)[
+        str(paths["working_dir"] / "account0/prod/eu-west-1/default")
+    ] == {str(paths["working_dir"] / "account0/_global/default")}
+
+
+def test_foreach_stack_dependencies_cycle():
+    dependencies = {"a": {"c"}, "b": {"a"}, "c": {"b"}, "d": set()}
+    with pytest.raises(ValueError) as e:
+        foreach.sort_stacks(dependencies)
+    assert "foreach: error: dependency cycle between stacks: a -> c -> b -> a" in str(e.value)
+
+
+def test_foreach_stack_dependencies_order(tmp_working_dir_stack_dependencies, capfd):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-S", "echo $TFWRAPPER_region/$TFWRAPPER_stack"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert captured.out.splitlines() == ["eu-west-1/infra", "eu-west-4/infra", "eu-west-1/default", "eu-west-4/default"]
+
+
+def test_foreach_loads_stack_configs_lazily(tmp_working_dir_stack_dependencies, tmp_path, monkeypatch):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    events_file = tmp_path / "events"
+    events_file.touch()
+    load_stack_config_from_file = tfwrapper.load_stack_config_from_file
+
+    def load_and_record(stack_config_file):
+        if os.path.basename(stack_config_file).startswith("account0_prod_eu-"):
+            with open(events_file, "a") as f:
+                f.write("load {}\n".format(os.path.basename(stack_config_file)))
+        return load_stack_config_from_file(stack_config_file)
+
+    monkeypatch.setattr(tfwrapper, "load_stack_config_from_file", load_and_record)
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-S", "echo run $TFWRAPPER_region/$TFWRAPPER_stack >> {}".format(events_file)])
+
+    # dependencies come from the stack index, and each configuration is loaded right before its command
+    assert e.value.code == 0
+    assert events_file.read_text().splitlines() == [
+        "load account0_prod_eu-west-1_infra.yml",
+        "run eu-west-1/infra",
+        "load account0_prod_eu-west-4_infra.yml",
+        "run eu-west-4/infra",
+        "load account0_prod_eu-west-1_default.yml",
+        "run eu-west-1/default",
+        "load account0_prod_eu-west-4_default.yml",
+        "run eu-west-4/default",
+    ]
+
+
+def test_foreach_jobs_stack_dependencies(tmp_working_dir_stack_dependencies, tmp_path):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    events_file = tmp_path / "events"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            [
+                "foreach",
+                "-j",
+                "4",
+                "-S",
+                'echo "start $TFWRAPPER_region/$TFWRAPPER_stack" >> {0}; sleep 0.2; echo "end $TFWRAPPER_region/$TFWRAPPER_stack" >> {0}'.format(
+                    events_file
+                ),
+            ]
+        )
+
+    assert e.value.code == 0
+    events = events_file.read_text().splitlines()
+    # stacks without dependencies start at once, the other ones as soon as their dependency ended
+    assert sorted(events[:2]) == ["start eu-west-1/infra", "start eu-west-4/default"]
+    assert events.index("start eu-west-4/infra") > events.index("end eu-west-1/infra")
+    assert events.index("start eu-west-1/default") > events.index("end eu-west-4/infra")
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_foreach_stack_dependencies_failure(tmp_working_dir_stack_dependencies, tmp_path, caplog, jobs):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    summary_file = tmp_path / "summary.json"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            [
+                "foreach",
+                "-j",
+                jobs,
+                "-k",
+                "--summary-json",
+                str(summary_file),
+                "-S",
+                '[ "$TFWRAPPER_region/$TFWRAPPER_stack" != eu-west-1/infra ] || exit 4',
+            ]
+        )
+
+    assert e.value.code == 4
+    summary = json.loads(summary_file.read_text())
+    assert [(s["stack"], s["status"]) for s in summary["stacks"]] == [
+        ("account0/prod/eu-west-1/default", "skipped"),
+        ("account0/prod/eu-west-1/infra", "failure"),
+        ("account0/prod/eu-west-4/default", "success"),
+        ("account0/prod/eu-west-4/infra", "skipped"),
+    ]
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_foreach_resume(tmp_working_dir_stack_dependencies, tmp_path, caplog, jobs):
+    paths = tmp_working_dir_stack_dependencies
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    summary_file = tmp_path / "summary.json"
+    fixed = tmp_path / "fixed"
+    command = [
+        "foreach",
+        "-j",
+        jobs,
+        "-k",
+        "--summary-json",
+        str(summary_file),
+        "-S",
+        '[ "$TFWRAPPER_region/$TFWRAPPER_stack" != eu-west-1/infra ] || [ -e {} ] || exit 4'.format(fixed),
+    ]
+    checkpoints_dir = paths["working_dir"] / ".run" / foreach.CHECKPOINTS_DIRNAME
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(command)
+    assert e.value.code == 4
+    assert len(list(checkpoints_dir.iterdir())) == 1
+    assert "Use --resume to only execute the command" in caplog.text
+
+    # the stacks depending on the stacks which succeeded can start right away
+    fixed.touch()
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main([*command[:1], "--resume", *command[1:]])
+    assert e.value.code == 0
+    assert "Resuming: skipping 1 of 4 stacks which already succeeded" in caplog.text
+    summary = json.loads(summary_file.read_text())
+    assert [(s["stack"], s["status"]) for s in summary["stacks"]] == [
+        ("account0/prod/eu-west-1/default", "success"),
+        ("account0/prod/eu-west-1/infra", "success"),
+        ("account0/prod/eu-west-4/infra", "success"),
+    ]
+    assert list(checkpoints_dir.iterdir()) == []
+
+    caplog.clear()
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main([*command[:1], "--resume", *command[1:]])
+    assert e.value.code == 0
+    assert "No interrupted execution of this command for these stacks to resume" in caplog.text
+    assert len(json.loads(summary_file.read_text())["stacks"]) == 4
+
+
+def test_foreach_checkpoint(tmp_path):
+    wrapper_config = {"rootdir": str(tmp_path), "command": ["tfwrapper", "plan"], "shell": False}
+    stacks = [str(tmp_path / "account0/prod/eu-west-1/default"), str(tmp_path / "account0/prod/eu-west-1/infra")]
+    checkpoint_file = foreach.get_checkpoint_file(wrapper_config, stacks)
+
+    # keyed by the command and the selected stacks, whatever their order
+    assert checkpoint_file == foreach.get_checkpoint_file(wrapper_config, reversed(stacks))
+    assert checkpoint_file != foreach.get_checkpoint_file(wrapper_config, stacks[:1])
+    assert checkpoint_file != foreach.get_checkpoint_file({**wrapper_config, "command": ["true"]}, stacks)
+
+    wrapper_config["checkpoint_file"] = checkpoint_file
+    assert foreach.load_checkpoint(checkpoint_file) == set()
+    for stack, returncode in zip(stacks, (0, 1)):
+        foreach.record_checkpoint(wrapper_config, stack, {"returncode": returncode, "started_at": 0.0, "duration": 1.0})
+    with open(checkpoint_file, "a") as f:
+        f.write('{"stack": "account0/prod/eu-west-4/default", "ret')
+
+    assert foreach.load_checkpoint(checkpoint_file) == {"account0/prod/eu-west-1/default"}
+
+
+def test_foreach_select_shard():
+    dependencies = {"/root/a": set(), "/root/b": {"/root/a"}, "/root/c": set(), "/root/d": set(), "/root/e": set()}
+    durations = {"a": 30, "b": 30, "c": 50, "d": 20, "e": 10}
+    wrapper_config = {"rootdir": "/root"}
+
+    assert foreach.get_stack_groups(dependencies) == [["/root/a", "/root/b"], ["/root/c"], ["/root/d"], ["/root/e"]]
+    # a and b stay together, the other stacks balance shards from the longest to the shortest
+    assert foreach.select_shard(wrapper_config, dependencies, (1, 2), durations) == {"/root/a", "/root/b", "/root/e"}
+    assert foreach.select_shard(wrapper_config, dependencies, (2, 2), durations) == {"/root/c", "/root/d"}
+    # stacks without known duration take the median one
+    assert foreach.select_shard(wrapper_config, dependencies, (1, 2), {"c": 50, "d": 20, "e": 10}) == {"/root/c", "/root/e"}
+    # without any known duration, shards are balanced by number of stacks
+    assert [len(foreach.select_shard(wrapper_config, dependencies, (i, 3), {})) for i in (1, 2, 3)] == [2, 2, 1]
+
+
+def test_foreach_shard(tmp_working_dir_multiple_stacks, tmp_path, capfd):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    summary_file = tmp_path / "summary.json"
+    summary_file.write_text(
+        json.dumps(
+            {
+                "stacks": [
+                    {"stack": "account0/prod/eu-west-1/default", "duration": 10},
+                    {"stack": "account0/prod/eu-west-1/infra", "duration": 1},
+                    {"stack": "account0/prod/eu-west-4/default", "duration": 2},
+                    {"stack": "account0/prod/eu-west-4/infra", "duration": None},
+                ]
+            }
+        )
+    )
+
+    outputs = []
+    for shard in ("1/2", "2/2"):
+        with pytest.raises(SystemExit) as e:
+            tfwrapper.main(
+                [
+                    "foreach",
+                    "--shard",
+                    shard,
+                    "--shard-durations",
+                    str(summary_file),
+                    "-S",
+                    "echo $TFWRAPPER_region/$TFWRAPPER_stack",
+                ]
+            )
+        assert e.value.code == 0
+        outputs.append(capfd.readouterr().out.splitlines())
+
+    assert outputs == [["eu-west-1/default"], ["eu-west-1/infra", "eu-west-4/default", "eu-west-4/infra"]]
+
+
+def test_foreach_shard_local_history(tmp_working_dir_multiple_stacks, capfd):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    command = "echo $TFWRAPPER_region/$TFWRAPPER_stack"
+
+    outputs = []
+    # each CI job has its own history
+    for shard, durations in (("1/2", [100, 1, 1, 1]), ("2/2", [1, 1, 1, 100])):
+        history_file = paths["working_dir"] / ".run" / history.HISTORY_FILENAME
+        if history_file.exists():
+            history_file.unlink()
+        stacks = ["eu-west-1/default", "eu-west-1/infra", "eu-west-4/default", "eu-west-4/infra"]
+        history.record(
+            str(paths["working_dir"]),
+            [
+                {"started_at": 0, "stack": "account0/prod/" + stack, "command": command, "returncode": 0, "duration": duration}
+                for stack, duration in zip(stacks, durations)
+            ],
+        )
+        with pytest.raises(SystemExit) as e:
+            tfwrapper.main(["foreach", "--shard", shard, "-S", command])
+        assert e.value.code == 0
+        outputs.extend(capfd.readouterr().out.splitlines())
+
+    assert sorted(outputs) == ["eu-west-1/default", "eu-west-1/infra", "eu-west-4/default", "eu-west-4/infra"]
+
+
+@pytest.mark.parametrize("shard", ["0/2", "3/2", "1", "a/b"])
+def test_foreach_shard_invalid(shard):
+    with pytest.raises(ValueError) as e:
+        tfwrapper.parse_args(["foreach", "--shard", shard, "--", "true"])
+    assert "foreach: error: --shard must be I/N with 1 <= I <= N" in str(e.value)
+
+
+def test_foreach_history(tmp_working_dir_multiple_stacks, capfd):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-k", "-S", '[ "$TFWRAPPER_stack" != infra ] || exit 5'])
+    assert e.value.code == 5
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--", "true"])
+    assert e.value.code == 0
+    capfd.readouterr()
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["history", "--stack", "*/default", "--command", "*exit*"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    lines = captured.out.splitlines()
+    assert lines[0].split() == ["Started", "Stack", "Return", "code", "Duration", "Command"]
+    assert [line.split()[2:4] for line in lines[1:]] == [
+        ["account0/prod/eu-west-4/default", "0"],
+        ["account0/prod/eu-west-1/default", "0"],
+    ]
+
+    executions = history.query(str(paths["working_dir"]))
+    assert [(e["stack"], e["command"], e["returncode"]) for e in executions[:4]] == [
+        ("account0/prod/eu-west-4/infra", "true", 0),
+        ("account0/prod/eu-west-4/default", "true", 0),
+        ("account0/prod/eu-west-1/infra", "true", 0),
+        ("account0/prod/eu-west-1/default", "true", 0),
+    ]
+    assert [(e["stack"], e["returncode"]) for e in executions[4:]] == [
+        ("account0/prod/eu-west-4/infra", 5),
+        ("account0/prod/eu-west-4/default", 0),
+        ("account0/prod/eu-west-1/infra", 5),
+        ("account0/prod/eu-west-1/default", 0),
+    ]
+
+
+def test_foreach_jobs_longest_first(tmp_working_dir_multiple_stacks, tmp_path, caplog):
+    paths = tmp_working_dir_multiple_stacks
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    events_file = tmp_path / "events"
+    command = 'echo "$TFWRAPPER_region/$TFWRAPPER_stack" >> {}; sleep 0.1'.format(events_file)
+    history.record(
+        str(paths["working_dir"]),
+        [
+            {"started_at": 0, "stack": "account0/prod/" + stack, "command": command, "returncode": 0, "duration": duration}
+            for stack, duration in [
+                ("eu-west-1/default", 1),
+                ("eu-west-1/infra", 4),
+                ("eu-west-4/default", 2),
+                ("eu-west-4/infra", 3),
+            ]
+        ],
+    )
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", "2", "-S", command])
+
+    assert e.value.code == 0
+    events = events_file.read_text().splitlines()
+    assert sorted(events[:2]) == ["eu-west-1/infra", "eu-west-4/infra"]
+    assert sorted(events[2:]) == ["eu-west-1/default", "eu-west-4/default"]
+    assert re.search(r"1 of 4 stacks done, about \d+\.\ds left", caplog.text)
+    assert "4 of 4 stacks done, about 0.0s left" in caplog.text
+
+
+def test_foreach_stack_priorities():
+    dependencies = {"a": set(), "b": set(), "c": {"a"}, "d": {"c"}}
+
+    assert foreach.get_stack_priorities(dependencies, {}) == {"a": 3, "b": 1, "c": 2, "d": 1}
+    assert foreach.get_stack_priorities(dependencies, {"a": 1, "b": 10, "c": 2, "d": 3}) == {"a": 6, "b": 10, "c": 5, "d": 3}
+
+
+@pytest.fixture
+def tmp_working_dir_git(tmp_working_dir_multiple_stacks):
+    paths = tmp_working_dir_multiple_stacks
+    (paths["working_dir"] / ".run").mkdir(exist_ok=True)
+    (paths["working_dir"] / ".gitignore").write_text(".run\n")
+    for stack_dir in paths["working_dir"].glob("account*/*/*"):
+        (stack_dir / "main.tf").write_text("")
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+            cwd=paths["working_dir"],
+            check=True,
+            capture_output=True,
+        )
+
+    git("init")
+    git("add", ".")
+    git("commit", "-m", "base")
+    git("tag", "base")
+    paths["git"] = git
+    return paths
+
+
+def test_foreach_changed_since(tmp_working_dir_git, capfd):
+    paths = tmp_working_dir_git
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    # committed change of a stack configuration, uncommitted and untracked changes in stack directories
+    config_file = pathlib.Path(tfwrapper.get_stack_config_path(paths["conf_dir"], "account0", "prod", "eu-west-4", "infra"))
+    config_file.write_text(config_file.read_text() + "    othervar: othervalue\n")
+    paths["git"]("commit", "-am", "change")
+    (paths["working_dir"] / "account0/prod/eu-west-1/default/main.tf").write_text("# changed")
+    (paths["working_dir"] / "account0/prod/eu-west-1/default/modules/sub").mkdir(parents=True)
+    (paths["working_dir"] / "account0/prod/eu-west-1/default/modules/sub/main.tf").write_text("")
+    (paths["working_dir"] / "account0/_global/default/new.tf").write_text("")
+    (paths["working_dir"] / "account1/prod/eu-west-1/infra/new.tf").write_text("")
+    (paths["working_dir"] / "README.md").write_text("")
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--changed-since", "base", "-S", "echo $TFWRAPPER_region/$TFWRAPPER_stack"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert captured.out.splitlines() == ["eu-west-1/default", "eu-west-4/infra"]
+
+    os.chdir(paths["working_dir"])
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(
+            ["foreach", "--changed-since", "base", "-S", "echo $TFWRAPPER_account/$TFWRAPPER_environment/$TFWRAPPER_stack"]
+        )
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert captured.out.splitlines() == [
+        "account0/global/default",
+        "account0/prod/default",
+        "account0/prod/infra",
+        "account1/prod/infra",
+    ]
+
+
+def test_foreach_changed_since_config(tmp_working_dir_git, capfd):
+    paths = tmp_working_dir_git
+    os.chdir((paths["working_dir"] / "account0/prod"))
+    paths["wrapper_conf"].write_text("---\nalways_trigger_init: false\n")
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--changed-since", "base", "--", "pwd"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert len(captured.out.splitlines()) == 4
+    assert foreach.select_changed_stacks(
+        {"rootdir": str(paths["working_dir"]), "confdir": str(paths["conf_dir"])}, {"a": {}, "b": {}}, ["conf/config.yml"]
+    ) == {"a", "b"}
+
+
+def test_foreach_changed_since_invalid_ref(tmp_working_dir_git):
+    os.chdir(tmp_working_dir_git["working_dir"])
+    with pytest.raises(ValueError) as e:
+        tfwrapper.main(["foreach", "--changed-since", "unknown-ref", "--", "true"])
+    assert "foreach: error: cannot list the files changed since unknown-ref: " in str(e.value)
+
+
+def test_foreach_changed_since_module(tmp_working_dir_git, capfd):
+    paths = tmp_working_dir_git
+    (paths["working_dir"] / "modules/network/templates").mkdir(parents=True)
+    (paths["working_dir"] / "modules/network/templates/user_data.sh").write_text("")
+    (paths["working_dir"] / "modules/network/main.tf").write_text('module "subnet" {\n  source = "../subnet"\n}\n')
+    (paths["working_dir"] / "modules/subnet").mkdir()
+    (paths["working_dir"] / "modules/subnet/main.tf").write_text("")
+    (paths["working_dir"] / "account0/prod/eu-west-1/infra/main.tf").write_text(
+        'module "network" {\n  source = "../../../../modules/network"\n}\n'
+    )
+    (paths["working_dir"] / "account1/prod/eu-west-4/default/main.tf").write_text(
+        'module "subnet" {\n  source = "../../../../modules/subnet"\n}\n'
+    )
+    paths["git"]("add", ".")
+    paths["git"]("commit", "-m", "modules")
+    paths["git"]("tag", "modules")
+    os.chdir(paths["working_dir"])
+
+    outputs = []
+    for changed_file in ("modules/subnet/main.tf", "modules/network/templates/user_data.sh"):
+        (paths["working_dir"] / changed_file).write_text("# changed")
+        with pytest.raises(SystemExit) as e:
+            tfwrapper.main(
+                ["foreach", "--changed-since", "modules", "-S", "echo $TFWRAPPER_account/$TFWRAPPER_region/$TFWRAPPER_stack"]
+            )
+        assert e.value.code == 0
+        outputs.append(capfd.readouterr().out.splitlines())
+        paths["git"]("checkout", "--", ".")
+        paths["git"]("clean", "-fdx", "-e", ".run")
+
+    assert outputs == [
+        ["account0/eu-west-1/infra", "account1/eu-west-4/default"],
+        ["account0/eu-west-1/infra"],
+    ]
+    assert (paths["working_dir"] / ".run" / tfwrapper.MODULE_INDEX_FILENAME).exists()
+
+
+@pytest.fixture
+def tmp_working_dir_native_stacks(tmp_working_dir_regional_valid_legacy, fake_terraform, tmp_path):
+    paths = tmp_working_dir_regional_valid_legacy
+    (paths["region_dir"] / "otherstack").mkdir()
+    (paths["conf_dir"] / "testaccount_testenvironment_testregion_otherstack.yml").write_text(
+        "---\nterraform:\n  vars:\n    myvar: othervalue\n    version: '1.1.4'\n"
+    )
+    paths["terraform_log"] = tmp_path / "terraform.log"
+    fake_terraform.write_text(
+        '#!/bin/sh\necho "${{PWD##*/}} $* $TF_VAR_myvar $TF_VAR_stack $TFWRAPPER_stack" >> {}\n'.format(paths["terraform_log"])
+    )
+    return paths
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_foreach_native_subcommand(tmp_working_dir_native_stacks, monkeypatch, jobs):
+    paths = tmp_working_dir_native_stacks
+    prepared = []
+    prepare = tfwrapper.prepare
+    monkeypatch.setattr(tfwrapper, "prepare", lambda args, environ=None: prepared.append(args.stack) or prepare(args, environ))
+    monkeypatch.setenv("PATH", "/nonexistent")
+    saved = []
+    monkeypatch.setattr(tfwrapper, "save_context_cache", lambda rootdir, context_cache: saved.append(list(context_cache)))
+    monkeypatch.setattr(tfwrapper, "save_completion_data", lambda *args: pytest.fail("should not be saved"))
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "-j", jobs, "--", "tfwrapper", "plan", "--", "-input=false"])
+
+    # terraform is executed by foreach itself, with the environment prepared for each stack
+    assert e.value.code == 0
+    assert prepared[0] is None and sorted(prepared[1:]) == ["otherstack", "teststack"]
+    assert sorted(paths["terraform_log"].read_text().splitlines()) == [
+        "otherstack plan -input=false othervalue otherstack otherstack",
+        "teststack plan -input=false myvalue teststack teststack",
+    ]
+    assert "TF_VAR_stack" not in os.environ
+    # only the context of foreach itself is cached, not the one of each stack
+    assert len(saved) == 1 and [key[5] for key in saved[0]] == [None]
+
+
+@pytest.mark.parametrize("subcommand", foreach.NATIVE_SUBCOMMANDS)
+def test_foreach_native_subcommand_same_as_subprocess(
+    tmp_working_dir_native_stacks, fake_terraform, tmp_path, monkeypatch, subcommand
+):
+    executions_file = tmp_path / "executions"
+    fake_terraform.write_text(
+        textwrap.dedent(
+            """\
+            #!{}
+            import json, os, sys
+            with open({!r}, "a") as f:
+                f.write(json.dumps({{"argv": sys.argv, "cwd": os.getcwd(), "env": dict(os.environ)}}) + "\\n")
+            """.format(sys.executable, str(executions_file))
+        )
+    )
+    # tfwrapper executed by the shell, like the installed script
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "tfwrapper").write_text(
+        '#!/bin/sh\nexec {} -c "import claranet_tfwrapper; claranet_tfwrapper.main()" "$@"\n'.format(sys.executable)
+    )
+    (bin_dir / "tfwrapper").chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+    monkeypatch.setenv("TFWRAPPER_NO_DAEMON", "1")
+    # like a new tfwrapper process, with the home directory of the fake terraform
+    monkeypatch.setattr(tfwrapper, "HOME_DIR", os.environ["HOME"])
+
+    def run_foreach(*options):
+        executions_file.unlink(missing_ok=True)
+        with pytest.raises(SystemExit) as e:
+            tfwrapper.main(["foreach", *options, "--", "tfwrapper", subcommand])
+        assert e.value.code == 0
+        executions = [json.loads(line) for line in executions_file.read_text().splitlines()]
+        for execution in executions:
+            # set by the shell running tfwrapper
+            for name in ("OLDPWD", "PWD", "SHLVL", "_"):
+                execution["env"].pop(name, None)
+        return sorted(executions, key=lambda execution: execution["cwd"])
+
+    native = run_foreach()
+    subprocess_executions = run_foreach("--no-native")
+    assert len(native) == 2
+    assert native == subprocess_executions
+
+
+@pytest.mark.parametrize(
+    "command, prewarmed",
+    [(["tfwrapper", "plan"], True), (["tfwrapper", "validate"], False), (["--no-native", "tfwrapper", "plan"], False)],
+)
+def test_foreach_native_subcommand_prewarm(tmp_working_dir_native_stacks, monkeypatch, command, prewarmed):
+    calls = []
+    monkeypatch.setattr(foreach, "prewarm_credentials", lambda wrapper_config, stacks: calls.append(sorted(stacks)))
+
+    with pytest.raises(SystemExit):
+        tfwrapper.main(["foreach", *command[:-2], "--", *command[-2:]])
+
+    assert len(calls) == (1 if prewarmed else 0)
+
+
+def test_foreach_native_subcommand_failure(tmp_working_dir_native_stacks, caplog):
+    paths = tmp_working_dir_native_stacks
+    (paths["conf_dir"] / "testaccount_testenvironment_testregion_otherstack.yml").write_text("---\nunknown: key\n")
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--keep-going", "--", "tfwrapper", "validate"])
+
+    assert e.value.code == tfwrapper.RC_KO
+    assert paths["terraform_log"].read_text().splitlines() == ["teststack validate myvalue teststack teststack"]
+    assert "Command failed for 1 of 2 stacks: testaccount/testenvironment/testregion/otherstack" in caplog.text
+
+
+@pytest.mark.parametrize(
+    "argv, native",
+    [
+        (["foreach", "--", "tfwrapper", "-d", "init", "--", "-upgrade"], True),
+        (["foreach", "--", "/usr/local/bin/tfwrapper", "output"], True),
+        (["foreach", "--no-native", "--", "tfwrapper", "plan"], False),
+        (["foreach", "-S", "tfwrapper plan"], False),
+        (["foreach", "--", "tfwrapper", "apply"], False),
+        (["foreach", "--", "tfwrapper", "-s", "teststack", "plan"], False),
+        (["foreach", "--", "tfwrapper", "plan", "--pipe-plan"], False),
+        (["foreach", "--", "tfwrapper", "--unknown", "plan"], False),
+        (["foreach", "--", "terraform", "plan"], False),
+    ],
+)
+def test_get_foreach_native_args(tmp_working_dir_native_stacks, argv, native):
+    wrapper_config = tfwrapper.prepare(tfwrapper.parse_args(argv))
+
+    assert (foreach.get_native_args(wrapper_config) is not None) == native
+
+
+def test_get_foreach_native_args_always_trigger_init(tmp_working_dir_native_stacks):
+    tmp_working_dir_native_stacks["wrapper_conf"].write_text("---\nalways_trigger_init: true\n")
+
+    wrapper_config = tfwrapper.prepare(tfwrapper.parse_args(["foreach", "--", "tfwrapper", "plan"]))
+
+    assert foreach.get_native_args(wrapper_config) is None
+    wrapper_config = tfwrapper.prepare(tfwrapper.parse_args(["foreach", "--", "tfwrapper", "validate"]))
+    assert foreach.get_native_args(wrapper_config).subcommand == "validate"
@@ -64,6 +64,8 @@ def test_completion_no_args(monkeypatch, tmp_path):
             "--http-cache-dir",
             "-p",
             "--plugin-cache-dir",
+            "--timings",
+            "--timings-file",
             "apply",
             "console",
             "destroy",
@@ -86,6 +88,9 @@ def test_completion_no_args(monkeypatch, tmp_path):
             "workspace",
             "bootstrap",
             "foreach",
+            "history",
+            "index",
+            "daemon",
         ]
     )
 
@@ -116,6 +121,8 @@ def test_completion_arg_dash(monkeypatch, tmp_path):
             "--http-cache-dir",
             "-p",
             "--plugin-cache-dir",
+            "--timings",
+            "--timings-file",
         ]
     )
 
@@ -172,3 +179,62 @@ def test_completion_arg_workspace_select(monkeypatch, tmp_path):
             "default ",
         ]
     )
+
+
+@pytest.fixture
+def completion_project(tmp_path, monkeypatch):
+    project = tmp_path / "project"
+    (project / "conf").mkdir(parents=True)
+    (project / "conf" / "testaccount_testenvironment_testregion_teststack.yml").write_text("---\nterraform:\n  vars: {}\n")
+    stack_dir = project / "testaccount" / "testenvironment" / "testregion" / "teststack"
+    stack_dir.mkdir(parents=True)
+    tool = tmp_path / "fake-tofu"
+    tool.write_text('#!/bin/sh\nprintf "select\\nlist\\n"\n')
+    tool.chmod(0o755)
+    monkeypatch.setenv("PATH", "")
+    monkeypatch.chdir(stack_dir)
+    return {"project": project, "tool": tool}
+
+
+def test_completion_uses_precomputed_tool(monkeypatch, tmp_path, completion_project):
+    (completion_project["project"] / ".run").mkdir()
+    tfwrapper.save_completion_data(str(completion_project["project"]), str(completion_project["tool"]))
+
+    assert do_completion_test(monkeypatch, tmp_path, "tfwrapper workspace ") == " ".join(
+        ["-h", "--help", "list", "select"],
+    )
+
+
+def test_completion_does_not_resolve_anything(monkeypatch, tmp_path, completion_project):
+    def fail(*args, **kwargs):
+        raise AssertionError("completion must not load configurations nor resolve tools")
+
+    for function in ("detect_config_dir", "load_wrapper_config", "load_stack_config_from_file", "download_tool_from_github"):
+        monkeypatch.setattr(tfwrapper, function, fail)
+
+    assert do_completion_test(monkeypatch, tmp_path, "tfwrapper workspace ") == " ".join(["-h", "--help"])
+    assert not (completion_project["project"] / ".run").exists()
+
+
+def test_completion_data(tmp_path):
+    assert tfwrapper.load_completion_data(str(tmp_path)) == {}
+
+    (tmp_path / ".run").mkdir()
+    tfwrapper.save_completion_data(str(tmp_path), "/path/to/tofu")
+    assert tfwrapper.load_completion_data(str(tmp_path)) == {"tool_bin_path": "/path/to/tofu"}
+
+    (tmp_path / ".run" / "completion.json").write_text("{not json")
+    assert tfwrapper.load_completion_data(str(tmp_path)) == {}
+
+
+def test_completion_stack_components(monkeypatch, tmp_path, tmp_working_dir_empty_conf):
+    paths = tmp_working_dir_empty_conf
+    for account, environment, region, stack in [("account0", "global", None, "iam"), ("account0", "prod", "eu-west-1", "app")]:
+        (paths["conf_dir"] / tfwrapper.get_stack_config_filename(account, environment, region, stack)).write_text("")
+    tfwrapper.update_stack_index(str(paths["working_dir"]), "conf")
+
+    # options taking an optional value also complete the following arguments
+    assert "account0" in do_completion_test(monkeypatch, tmp_path, "tfwrapper -a ").split()
+    assert {"global", "prod"} <= set(do_completion_test(monkeypatch, tmp_path, "tfwrapper -a account0 -e ").split())
+    assert "eu-west-1" in do_completion_test(monkeypatch, tmp_path, "tfwrapper -e prod --region ").split()
+    assert do_completion_test(monkeypatch, tmp_path, "tfwrapper -s ia") == "iam "
@@ -0,0 +1,138 @@
+"""Test the adaptive concurrency of foreach."""
+
+import os
+
+import pytest
+
+from claranet_tfwrapper import concurrency
+
+
+@pytest.fixture
+def resources(tmp_path, monkeypatch):
+    """Provide fake cgroup and meminfo files, with 8 CPUs and 16 GiB of available memory outside of cgroups."""
+    cgroup_dir = tmp_path / "cgroup"
+    cgroup_dir.mkdir()
+    meminfo_file = tmp_path / "meminfo"
+    meminfo_file.write_text("MemTotal:       32000000 kB\nMemAvailable:   16777216 kB\n")
+    monkeypatch.setattr(concurrency, "CGROUP_DIR", str(cgroup_dir))
+    monkeypatch.setattr(concurrency, "MEMINFO_FILE", str(meminfo_file))
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)))
+    return cgroup_dir
+
+
+def test_resources(resources):
+    assert concurrency.get_cpu_count() == 8
+    assert concurrency.get_available_memory() == 16384
+
+
+def test_resources_cgroup_v2(resources):
+    (resources / "cpu.max").write_text("250000 100000\n")
+    (resources / "memory.max").write_text("{}\n".format(6 << 30))
+    (resources / "memory.current").write_text("{}\n".format(1 << 30))
+
+    assert concurrency.get_cpu_count() == 3
+    assert concurrency.get_available_memory() == 5120
+
+    (resources / "cpu.max").write_text("max 100000\n")
+    (resources / "memory.max").write_text("max\n")
+    assert concurrency.get_cpu_count() == 8
+    assert concurrency.get_available_memory() == 16384
+
+
+def test_resources_cgroup_v1(resources):
+    (resources / "cpu").mkdir()
+    (resources / "cpu" / "cpu.cfs_quota_us").write_text("200000\n")
+    (resources / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    (resources / "memory").mkdir()
+    (resources / "memory" / "memory.limit_in_bytes").write_text("{}\n".format(4 << 30))
+    (resources / "memory" / "memory.usage_in_bytes").write_text("{}\n".format(1 << 30))
+
+    assert concurrency.get_cpu_count() == 2
+    assert concurrency.get_available_memory() == 3072
+
+
+@pytest.mark.parametrize(
+    "memory_per_job, expected",
+    [
+        (None, (8, 10)),
+        (1024, (8, 16)),
+        (4096, (4, 4)),
+        (32768, (1, 1)),
+    ],
+)
+def test_from_resources(resources, memory_per_job, expected):
+    adaptive = concurrency.AdaptiveConcurrency.from_resources(memory_per_job)
+
+    assert (adaptive.limit, adaptive.maximum) == expected
+
+
+def test_additive_increase(resources):
+    adaptive = concurrency.AdaptiveConcurrency(2, 4, 1024)
+
+    # one more command after each round of as many commands as run at a time
+    for limit in (2, 2, 3, 3, 3, 4, 4, 4, 4, 4):
+        assert adaptive.limit == limit
+        adaptive.on_command_done()
+    assert adaptive.limit == 4
+
+
+def test_multiplicative_decrease_rate_limit(resources, monkeypatch):
+    adaptive = concurrency.AdaptiveConcurrency(8, 16, 1024)
+
+    adaptive.on_output_line(b"  Plan: 1 to add, 0 to change, 0 to destroy.\n")
+    assert adaptive.limit == 8
+    adaptive.on_output_line(b"Error: ThrottlingException: Rate exceeded\n")
+    assert adaptive.limit == 4
+    # the commands started before the decrease are not counted twice
+    adaptive.on_output_line(b"Error: ThrottlingException: Rate exceeded\n")
+    assert adaptive.limit == 4
+
+    monkeypatch.setattr(concurrency, "DECREASE_INTERVAL", 0)
+    for _ in range(4):
+        adaptive.on_output_line(b"googleapi: Error 429: Quota exceeded, rateLimitExceeded\n")
+    assert adaptive.limit == 1
+
+
+def test_multiplicative_decrease_memory(resources, tmp_path):
+    adaptive = concurrency.AdaptiveConcurrency(8, 16, 1024)
+    (tmp_path / "meminfo").write_text("MemAvailable:   512000 kB\n")
+
+    adaptive.on_command_done()
+
+    assert adaptive.limit == 4
+
+
+def test_multiplicative_decrease_throughput(resources, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(concurrency.time, "monotonic", lambda: now[0])
+    adaptive = concurrency.AdaptiveConcurrency(2, 8, 1024)
+
+    # 2 commands expected to last 1s in 1s, then 3 in 1s
+    for delay in (0.5, 0.5, 0.3, 0.3, 0.4):
+        now[0] += delay
+        adaptive.on_command_done(1.0)
+    assert adaptive.limit == 4
+
+    # 4 commands expected to last 1s in 4s
+    for _ in range(4):
+        now[0] += 1.0
+        adaptive.on_command_done(1.0)
+    assert adaptive.limit == 2
+
+
+def test_throughput_normalized(resources, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(concurrency.time, "monotonic", lambda: now[0])
+    adaptive = concurrency.AdaptiveConcurrency(2, 8, 1024)
+
+    # 2 commands expected to last 1s in 1s, then 3 commands expected to last 10s in 10s
+    for delay, expected_duration in ((0.5, 1.0), (0.5, 1.0), (3.0, 10.0), (3.0, 10.0), (4.0, 10.0)):
+        now[0] += delay
+        adaptive.on_command_done(expected_duration)
+    assert adaptive.limit == 4
+
+    # 4 commands in 40s, one of them without expected duration
+    for expected_duration in (1.0, None, 1.0, 1.0):
+        now[0] += 10.0
+        adaptive.on_command_done(expected_duration)
+    assert adaptive.limit == 5
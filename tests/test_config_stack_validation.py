@@ -0,0 +1,120 @@
+"""Test stack configuration validation and its cache."""
+
+import os
+from copy import deepcopy
+
+import pytest
+from schema import SchemaError
+
+import claranet_tfwrapper as tfwrapper
+
+FULL_STACK_CONFIG = {
+    "state_configuration_name": "aws-demo",
+    "depends_on": ["account0/global/default", "account0/prod/eu-west-1/network"],
+    "foreach": {"timeout": 3600, "inactivity_timeout": 600, "memory_limit": 4096},
+    "aws": {"general": {"account": "12345678910", "region": "eu-west-3"}, "credentials": {"profile": "myprofile"}},
+    "azure": {
+        "general": {"mode": "service_principal", "subscription_id": "sub", "directory_id": "dir"},
+        "alias": {
+            "mode": "user",
+            "subscription_id": "sub",
+            "directory_id": "dir",
+            "credentials": {"profile": "myprofile"},
+        },
+        "credential": {"profile": "myprofile"},
+        "credentials": {"profile": "myprofile"},
+    },
+    "gcp": {
+        "general": {"project": "myproject", "mode": "adc-user"},
+        "gke": [
+            {"name": "cluster1", "zone": "europe-west1-b", "refresh_kubeconfig": "never"},
+            {"name": "cluster2", "region": "europe-west1"},
+        ],
+    },
+    "terraform": {
+        "legacy": True,
+        "version": "1.1.4",
+        "vars": {"myvar": "myvalue"},
+        "custom-providers": {"foo": "1.0.0", "bar": {"version": "1.0.0", "extension": "zip"}},
+    },
+}
+
+
+def iter_paths(data, path=()):
+    yield path
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from iter_paths(value, path + (key,))
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            yield from iter_paths(value, path + (index,))
+
+
+def mutations():
+    """Yield variants of the full stack configuration with a single change each."""
+    yield FULL_STACK_CONFIG
+    yield None
+    yield {"terraform": {"vars": {}}}
+    yield {"terraform": {"vars": {}}, "foreach": {"timeout": -1}}
+    yield {"terraform": {"vars": {"myvar": "myvalue"}}, "gcp": {"general": {"project": "p", "mode": "m"}, "gke": []}}
+    for path in iter_paths(FULL_STACK_CONFIG):
+        for replacement in ("deleted", "unknown_key", 1, True, "string", {}, [], None):
+            if not path and replacement != "unknown_key":
+                continue
+            stack_config = deepcopy(FULL_STACK_CONFIG)
+            parent = stack_config
+            for key in path[:-1]:
+                parent = parent[key]
+            target = parent[path[-1]] if path else stack_config
+            if replacement == "deleted":
+                del parent[path[-1]]
+            elif replacement == "unknown_key":
+                if not isinstance(target, dict):
+                    continue
+                target["unknown"] = "value"
+            else:
+                parent[path[-1]] = replacement
+            yield stack_config
+
+
+@pytest.mark.parametrize("stack_config", list(mutations()))
+def test_is_valid_stack_config_matches_schema(stack_config):
+    try:
+        tfwrapper.get_stack_configuration_schema().validate(stack_config)
+        expected = True
+    except SchemaError:
+        expected = False
+    assert tfwrapper.is_valid_stack_config(stack_config) is expected
+
+
+def test_validate_stack_config_cache(tmp_working_dir_regional_valid_legacy, monkeypatch):
+    paths = tmp_working_dir_regional_valid_legacy
+    stack_config_file = str(paths["stack_conf"])
+    schema_cache_dir = paths["working_dir"] / ".run" / tfwrapper.SCHEMA_CACHE_DIRNAME
+    monkeypatch.setattr(tfwrapper, "_valid_stack_config_digests", set())
+
+    tfwrapper.load_stack_config_from_file(stack_config_file)
+    assert len(os.listdir(schema_cache_dir)) == 1
+
+    # the result for the previous content of the file is replaced
+    paths["stack_conf"].write_text(paths["stack_conf"].read_text() + "# changed\n")
+    monkeypatch.setattr(tfwrapper, "_valid_stack_config_digests", set())
+    tfwrapper.load_stack_config_from_file(stack_config_file)
+    assert len(os.listdir(schema_cache_dir)) == 1
+
+    # another process validating the same content relies on the cache
+    monkeypatch.setattr(tfwrapper, "_valid_stack_config_digests", set())
+    monkeypatch.setattr(tfwrapper, "is_valid_stack_config", lambda stack_config: pytest.fail("should not be validated"))
+    tfwrapper.load_stack_config_from_file(stack_config_file)
+
+
+def test_validate_stack_config_error(tmp_working_dir_regional_valid_legacy, caplog, monkeypatch):
+    monkeypatch.setattr(tfwrapper, "_valid_stack_config_digests", set())
+    paths = tmp_working_dir_regional_valid_legacy
+    paths["stack_conf"].write_text("---\nterraform:\n  vars:\n    myvar: 1\n")
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.load_stack_config_from_file(str(paths["stack_conf"]))
+    assert e.value.code == tfwrapper.RC_KO
+    assert "Key 'terraform' error:\nKey 'vars' error:\nKey 'myvar' error:\n1 should be instance of 'str'" in caplog.text
+    assert not (paths["working_dir"] / ".run" / tfwrapper.SCHEMA_CACHE_DIRNAME).exists()
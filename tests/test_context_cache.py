@@ -0,0 +1,120 @@
+"""Test the context resolved by an execution is reused by the next ones."""
+
+import os
+import time
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+
+
+def prepare(*args):
+    return tfwrapper.prepare(tfwrapper.parse_args(list(args) or ["plan"]))
+
+
+def test_context_cache(tmp_working_dir_regional_valid_legacy, fake_terraform, monkeypatch):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+
+    wrapper_config = prepare()
+    assert (paths["working_dir"] / ".run" / tfwrapper.CONTEXT_CACHE_FILENAME).is_file()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("context should be reused")
+
+    with monkeypatch.context() as m:
+        for function in ("detect_stack", "load_wrapper_config", "load_stack_config_from_file", "select_terraform_version"):
+            m.setattr(tfwrapper, function, fail)
+        cached_wrapper_config = prepare()
+
+    assert cached_wrapper_config == wrapper_config
+    assert cached_wrapper_config["tool_bin_path"] == str(fake_terraform)
+    assert os.environ["TF_VAR_myvar"] == "myvalue"
+
+
+def test_context_cache_invalidation(tmp_working_dir_regional_valid_legacy, fake_terraform):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+
+    assert prepare()["config"]["always_trigger_init"] is False
+
+    paths["wrapper_conf"].write_text("---\nalways_trigger_init: true\n")
+    assert prepare()["config"]["always_trigger_init"] is True
+
+    paths["stack_conf"].write_text("---\nterraform:\n  vars:\n    myvar: othervalue\n    version: '1.1.4'\n")
+    prepare()
+    assert os.environ["TF_VAR_myvar"] == "othervalue"
+
+
+def test_context_cache_per_directory(tmp_working_dir_regional_valid_legacy, fake_terraform):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+    assert prepare()["stack"] == "teststack"
+
+    os.chdir(paths["region_dir"])
+    wrapper_config = prepare("foreach", "--", "true")
+    assert wrapper_config["region"] == "testregion"
+    assert wrapper_config["stack"] is None
+
+
+def test_context_cache_corrupted(tmp_working_dir_regional_valid_legacy, fake_terraform):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+    (paths["working_dir"] / ".run" / tfwrapper.CONTEXT_CACHE_FILENAME).write_bytes(b"garbage")
+
+    assert prepare()["stack"] == "teststack"
+    assert len(tfwrapper.load_context_cache(str(paths["working_dir"]))) == 1
+
+
+def test_context_cache_partial_version_ttl(tmp_working_dir_regional_valid_legacy, fake_terraform, monkeypatch):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+    selected = []
+
+    def select_terraform_version(version):
+        selected.append(version)
+        return str(fake_terraform)
+
+    monkeypatch.setattr(tfwrapper, "select_terraform_version", select_terraform_version)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    # the latest patch release matching a partial version is looked up again once the releases cache expired
+    paths["stack_conf"].write_text("---\nterraform:\n  vars:\n    myvar: myvalue\n    version: '1.1'\n")
+    prepare()
+    prepare()
+    assert selected == ["1.1"]
+    now += tfwrapper.CONTEXT_CACHE_TOOL_TTL
+    prepare()
+    assert selected == ["1.1", "1.1"]
+
+    # exact versions do not expire
+    paths["stack_conf"].write_text("---\nterraform:\n  vars:\n    myvar: myvalue\n    version: '1.1.4'\n")
+    prepare()
+    now += tfwrapper.CONTEXT_CACHE_TOOL_TTL
+    prepare()
+    assert selected == ["1.1", "1.1", "1.1.4"]
+
+
+def test_context_cache_environment(tmp_working_dir_regional_valid_legacy, fake_terraform, monkeypatch):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+    prepare()
+
+    # variables the context does not depend on are ignored
+    monkeypatch.setenv("SOME_VARIABLE", "value")
+    with monkeypatch.context() as m:
+        m.setattr(tfwrapper, "detect_stack", lambda *args, **kwargs: pytest.fail("context should be reused"))
+        prepare()
+
+    resolved = []
+    original_detect_stack = tfwrapper.detect_stack
+    monkeypatch.setattr(
+        tfwrapper, "detect_stack", lambda *args, **kwargs: resolved.append(1) or original_detect_stack(*args, **kwargs)
+    )
+    monkeypatch.setenv("AWS_PROFILE", "other-profile")
+    prepare()
+    assert resolved == [1]
+
+    prepare()
+    assert resolved == [1]
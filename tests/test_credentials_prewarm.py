@@ -0,0 +1,140 @@
+"""Test the credentials acquired by foreach before preparing stacks."""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+import claranet_tfwrapper as tfwrapper
+from claranet_tfwrapper import azure, foreach
+
+STACK_CONFIG = {
+    "state_configuration_name": "aws-demo",
+    "aws": {"general": {"account": "123456789012", "region": "eu-west-1"}, "credentials": {"profile": "demo"}},
+    "azure": {
+        "general": {"mode": "user", "subscription_id": "sub0", "directory_id": "tenant0"},
+        "other": {"mode": "service_principal", "subscription_id": "sub1", "tenant_id": "tenant1"},
+        "credentials": {"profile": "sp-profile"},
+    },
+    "gcp": {"general": {"mode": "adc-user", "project": "project0"}},
+    "terraform": {"vars": {}},
+}
+
+
+def test_get_stack_credentials():
+    assert tfwrapper.get_stack_credentials(STACK_CONFIG) == (
+        ("state", "aws-demo"),
+        ("aws", "123456789012", "eu-west-1", "demo"),
+        ("azure", "sub0", "tenant0", "", None),
+        ("azure", "sub1", "tenant1", "other", "sp-profile"),
+        ("gcp",),
+    )
+
+
+def test_get_stack_credentials_invalid():
+    stack_config = {"aws": {"general": {}}, "azure": {"general": "invalid", "other": {"mode": "unknown"}}, "gcp": []}
+
+    assert tfwrapper.get_stack_credentials(stack_config) == (("state", None),)
+    assert tfwrapper.get_stack_credentials(None) == ()
+
+
+def test_prewarm_foreach_credentials(tmp_path, monkeypatch, caplog):
+    acquired = []
+
+    def get_session(wrapper_config, account, region, profile, backend_type=None, conf=None, environ=None):
+        acquired.append((backend_type, account, region, profile))
+        (os.environ if environ is None else environ)["AWS_ACCESS_KEY_ID"] = profile
+        if profile == "broken":
+            sys.exit(tfwrapper.RC_KO)
+
+    def set_context(wrapper_config, subscription_id, tenant_id, context_name, sp_profile=None, environ=None):
+        acquired.append(("azure", subscription_id, tenant_id, context_name, sp_profile))
+        raise azure.AzureError("Cannot log in with service principal {}".format(sp_profile))
+
+    monkeypatch.setattr(tfwrapper, "get_session", get_session)
+    monkeypatch.setattr(azure, "set_context", set_context)
+    monkeypatch.setattr(tfwrapper, "adc_check_user_credentials", lambda: acquired.append(("gcp",)))
+    monkeypatch.delenv("AWS_ACCESS_KEY_ID", raising=False)
+    wrapper_config = {
+        "jobs": 4,
+        "rootdir": str(tmp_path),
+        "state": {"aws-demo": {"state_backend_type": "aws", "state_account": "state", "state_region": "r", "state_profile": "p"}},
+    }
+    stacks = {
+        str(i): foreach.StackHandle(str(i), None, "account", "env", "region", str(i), credentials=credentials)
+        for i, credentials in enumerate(
+            [
+                tfwrapper.get_stack_credentials(STACK_CONFIG),
+                tfwrapper.get_stack_credentials(STACK_CONFIG),
+                (("state", None), ("aws", "123456789012", "eu-west-1", "broken")),
+            ]
+        )
+    }
+
+    with caplog.at_level(logging.INFO):
+        foreach.prewarm_credentials(wrapper_config, stacks)
+
+    # each credentials are acquired once, failures are logged, and the environment is left unchanged
+    assert sorted(acquired, key=str) == sorted(
+        [
+            ("aws", "state", "r", "p"),
+            ("aws", "123456789012", "eu-west-1", "demo"),
+            ("aws", "123456789012", "eu-west-1", "broken"),
+            ("azure", "sub0", "tenant0", "", None),
+            ("azure", "sub1", "tenant1", "other", "sp-profile"),
+            ("gcp",),
+        ],
+        key=str,
+    )
+    assert "Acquiring 6 credentials used by 3 stacks" in caplog.text
+    assert "Failed to acquire aws credentials 123456789012, eu-west-1, broken" in caplog.text
+    assert "Failed to acquire azure credentials: Cannot log in with service principal sp-profile" in caplog.text
+    assert "AWS_ACCESS_KEY_ID" not in os.environ
+
+
+def test_prewarm_foreach_credentials_sequential(tmp_path, monkeypatch):
+    acquired = []
+    running = []
+    gcp_checked = threading.Event()
+
+    def acquire(*credentials):
+        running.append(credentials)
+        assert len(running) == 1, "credentials which may prompt are acquired one at a time"
+        time.sleep(0.01)
+        acquired.append(credentials)
+        running.remove(credentials)
+
+    def get_session(wrapper_config, account, region, profile, backend_type=None, conf=None, environ=None):
+        acquire(account, region, profile)
+
+    monkeypatch.setattr(tfwrapper, "get_session", get_session)
+    monkeypatch.setattr(azure, "set_context", lambda wrapper_config, *credentials, environ=None: acquire(*credentials))
+    # the GCP check, a mere subprocess, runs meanwhile
+    monkeypatch.setattr(tfwrapper, "adc_check_user_credentials", gcp_checked.set)
+    wrapper_config = {
+        "jobs": 4,
+        "rootdir": str(tmp_path),
+        "state": {"aws-demo": {"state_backend_type": "aws", "state_account": "state", "state_region": "r", "state_profile": "b"}},
+    }
+    credentials = (
+        ("state", None),
+        ("aws", "1", "eu-west-1", "a"),
+        ("aws", "2", "eu-west-1", "b"),
+        ("aws", "1", "eu-west-3", "a"),
+        ("azure", "sub0", "tenant0", "", None),
+        ("gcp",),
+    )
+    stacks = {"0": foreach.StackHandle("0", None, "account", "env", "region", "0", credentials=credentials)}
+
+    foreach.prewarm_credentials(wrapper_config, stacks)
+
+    # grouped by profile, so that the session of a profile is reused
+    assert gcp_checked.is_set()
+    assert acquired == [
+        ("sub0", "tenant0", "", None),
+        ("1", "eu-west-1", "a"),
+        ("1", "eu-west-3", "a"),
+        ("state", "r", "b"),
+        ("2", "eu-west-1", "b"),
+    ]
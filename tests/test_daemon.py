@@ -0,0 +1,168 @@
+"""Test the daemon preparing executions for its clients."""
+
+import datetime
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+from claranet_tfwrapper import daemon, timings
+
+STACK_ARGS = ["-atestaccount", "-etestenvironment", "-rtestregion", "-steststack"]
+
+
+@pytest.fixture
+def running_daemon(tmp_working_dir_regional_valid_legacy, fake_terraform):
+    paths = tmp_working_dir_regional_valid_legacy
+    rootdir = str(paths["working_dir"])
+    thread = threading.Thread(target=daemon.serve, args=(rootdir, str(paths["conf_dir"]), 2))
+    thread.start()
+
+    socket_path = daemon.get_socket_path(rootdir)
+    for _ in range(100):
+        if daemon._send(socket_path, {"ping": True}):
+            break
+        time.sleep(0.05)
+
+    yield paths
+
+    thread.join(timeout=10)
+    assert not os.path.exists(socket_path)
+
+
+def test_get_socket_path(tmp_path):
+    assert daemon.get_socket_path("/project") == "/project/.run/tfwrapper.sock"
+
+    long_rootdir = "/" + "a" * 120
+    socket_path = daemon.get_socket_path(long_rootdir)
+    assert len(socket_path) <= daemon.SOCKET_PATH_MAX_LENGTH
+    assert os.path.dirname(socket_path) == os.path.join(tempfile.gettempdir(), "tfwrapper-{}".format(os.getuid()))
+    assert socket_path == daemon.get_socket_path(long_rootdir)
+    assert socket_path != daemon.get_socket_path(long_rootdir + "b")
+
+
+@pytest.fixture
+def listening_socket(tmp_path):
+    socket_path = str(tmp_path / "tfwrapper.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen()
+        server.settimeout(1)
+        yield socket_path, server
+
+
+def test_send_untrusted_socket(listening_socket, caplog, monkeypatch):
+    socket_path, server = listening_socket
+
+    os.chmod(socket_path, 0o666)
+    assert daemon._send(socket_path, {"environ": {"SECRET": "secret"}}) is None
+    assert "Ignoring daemon socket {} not owned by the current user or accessible by others".format(socket_path) in caplog.text
+
+    os.chmod(socket_path, 0o600)
+    monkeypatch.setattr(os, "getuid", lambda: os.geteuid() + 1)
+    assert daemon._send(socket_path, {"environ": {"SECRET": "secret"}}) is None
+
+    # nothing is sent to a daemon served by another user
+    monkeypatch.setattr(daemon, "is_private", lambda path, file_type: True)
+    assert daemon._send(socket_path, {"environ": {"SECRET": "secret"}}) is None
+    assert "Ignoring daemon socket {} served by user id {}".format(socket_path, os.geteuid()) in caplog.text
+    connection, _ = server.accept()
+    with connection:
+        connection.settimeout(1)
+        assert connection.recv(1024) == b""
+
+
+def test_serve_private_socket_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    rootdir = "/" + "a" * 120
+    socket_dir = tmp_path / "tfwrapper-{}".format(os.getuid())
+    socket_dir.mkdir(mode=0o755)
+    socket_dir.chmod(0o755)
+
+    assert daemon.serve(rootdir, str(tmp_path), 1) == tfwrapper.RC_KO
+
+    socket_dir.chmod(0o700)
+    monkeypatch.setattr(daemon, "warm_up", lambda: None)
+    assert daemon.serve(rootdir, str(tmp_path), 0.1) == tfwrapper.RC_OK
+
+
+def test_prepare_remotely_without_daemon(tmp_working_dir_regional_valid_legacy):
+    assert daemon.prepare_remotely("conf", STACK_ARGS + ["plan"]) is None
+
+
+def test_prepare_remotely(running_daemon, fake_terraform):
+    wrapper_config = daemon.prepare_remotely("conf", STACK_ARGS + ["plan"])
+
+    assert wrapper_config["subcommand"] == "plan"
+    assert wrapper_config["rootdir"] == str(running_daemon["working_dir"])
+    assert wrapper_config["stack"] == "teststack"
+    assert wrapper_config["tool_bin_path"] == str(fake_terraform)
+    assert os.environ["TF_VAR_myvar"] == "myvalue"
+    assert os.environ["TF_VAR_stack"] == "teststack"
+
+
+def test_prepare_remotely_exit(running_daemon, caplog):
+    (running_daemon["conf_dir"] / "testaccount_testenvironment_testregion_badstack.yml").write_text("---\nunknown: key\n")
+
+    with pytest.raises(SystemExit) as e:
+        daemon.prepare_remotely("conf", STACK_ARGS[:-1] + ["-sbadstack", "plan"])
+    assert e.value.code == tfwrapper.RC_KO
+    assert "Configuration error in" in caplog.text
+
+
+def test_daemon_clears_caches_on_config_change(running_daemon, monkeypatch):
+    cleared = []
+    monkeypatch.setattr(tfwrapper, "clear_caches", lambda: cleared.append(True))
+
+    daemon.prepare_remotely("conf", STACK_ARGS + ["validate"])
+    daemon.prepare_remotely("conf", STACK_ARGS + ["validate"])
+    assert cleared == []
+
+    running_daemon["wrapper_conf"].write_text("---\nalways_trigger_init: true\n")
+    wrapper_config = daemon.prepare_remotely("conf", STACK_ARGS + ["validate"])
+    assert cleared == [True]
+    assert wrapper_config["config"]["always_trigger_init"] is True
+
+
+def test_handle_timings(tmp_working_dir_regional_valid_legacy, fake_terraform):
+    request = {"argv": ["--timings"] + STACK_ARGS + ["validate"], "cwd": os.getcwd(), "environ": dict(os.environ)}
+    response = daemon.handle(request)
+
+    assert "config detection" in [p["name"] for p in response["timings"]]
+    assert not timings.is_enabled()
+
+
+def test_prepare_remotely_interaction_required(running_daemon, monkeypatch):
+    interactive_calls = []
+
+    def prepare(args, environ=None, interactive=True):
+        interactive_calls.append(interactive)
+        raise tfwrapper.InteractionRequired("Enter MFA code:")
+
+    monkeypatch.setattr(tfwrapper, "prepare", prepare)
+    # the client prepares the execution itself
+    assert daemon.prepare_remotely("conf", STACK_ARGS + ["plan"]) is None
+    assert interactive_calls == [False]
+
+
+@pytest.mark.parametrize(
+    "extra_config, expected",
+    [
+        ({"stack_config": {"date": datetime.date(2024, 1, 1)}}, "local"),
+        ({"aws_session": object()}, "error"),
+    ],
+)
+def test_handle_wrapper_config_whitelist(tmp_working_dir_regional_valid_legacy, monkeypatch, extra_config, expected):
+    monkeypatch.setattr(
+        tfwrapper, "prepare", lambda args, environ=None, interactive=True: {**vars(args), **extra_config, "rootdir": "/project"}
+    )
+    request = {"argv": STACK_ARGS + ["bootstrap"], "cwd": os.getcwd(), "environ": dict(os.environ)}
+    response = daemon.handle(request)
+
+    assert expected in response
+    assert "wrapper_config" not in response
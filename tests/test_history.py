@@ -0,0 +1,72 @@
+"""Test the history of foreach executions."""
+
+import pytest
+
+from claranet_tfwrapper import history
+
+
+def execution(stack, command, duration, returncode=0, started_at=0.0):
+    return {"started_at": started_at, "stack": stack, "command": command, "returncode": returncode, "duration": duration}
+
+
+def test_history_durations(tmp_path):
+    assert history.get_durations(str(tmp_path), "plan", ["a"]) == {}
+
+    history.record(
+        str(tmp_path),
+        [
+            execution("a", "plan", 10, started_at=1),
+            execution("a", "plan", 30, started_at=2),
+            execution("a", "plan", 20, started_at=3),
+            execution("a", "plan", 100, returncode=1, started_at=4),
+            execution("b", "apply", 5, started_at=1),
+            execution("c", "plan", 1000, returncode=1, started_at=1),
+        ],
+    )
+
+    # median of successful executions of the command, or of any command for the stack
+    assert history.get_durations(str(tmp_path), "plan", ["a", "b", "c", "d"]) == {"a": 20, "b": 5}
+
+
+def test_history_durations_latest_samples(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "ESTIMATE_SAMPLES", 2)
+    history.record(str(tmp_path), [execution("a", "plan", d, started_at=i) for i, d in enumerate([100, 100, 1, 3])])
+
+    assert history.get_durations(str(tmp_path), "plan", ["a"]) == {"a": 2}
+
+
+def test_history_max_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_MAX_ROWS", 3)
+    history.record(str(tmp_path), [execution("a", "plan", i, started_at=i) for i in range(5)])
+    history.record(str(tmp_path), [execution("a", "plan", 5, started_at=5)])
+
+    assert [e["duration"] for e in history.query(str(tmp_path))] == [5, 4, 3]
+
+
+def test_history_query(tmp_path):
+    assert history.query(str(tmp_path)) == []
+
+    history.record(
+        str(tmp_path),
+        [
+            execution("account0/prod/eu-west-1/default", "tfwrapper plan", 1, started_at=1),
+            execution("account0/prod/eu-west-1/infra", "tfwrapper plan", 2, started_at=2),
+            execution("account0/preprod/eu-west-1/default", "tfwrapper apply", 3, started_at=3),
+        ],
+    )
+
+    assert [e["duration"] for e in history.query(str(tmp_path))] == [3, 2, 1]
+    assert [e["duration"] for e in history.query(str(tmp_path), limit=1)] == [3]
+    assert [e["duration"] for e in history.query(str(tmp_path), stack="account0/prod/*")] == [2, 1]
+    assert [e["duration"] for e in history.query(str(tmp_path), command="*plan*", stack="*/default")] == [1]
+    assert history.query(str(tmp_path), limit=1)[0] == execution(
+        "account0/preprod/eu-west-1/default", "tfwrapper apply", 3, started_at=3
+    )
+
+
+@pytest.mark.parametrize(
+    "seconds, formatted",
+    [(0, "0.0s"), (12.34, "12.3s"), (59.9, "59.9s"), (185, "3m05s"), (3600, "1h00m"), (3725, "1h02m")],
+)
+def test_format_duration(seconds, formatted):
+    assert history.format_duration(seconds) == formatted
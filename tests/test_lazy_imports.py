@@ -0,0 +1,42 @@
+"""Test that heavy dependencies are only imported when needed."""
+
+import subprocess
+import sys
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "argcomplete",
+        "boto3",
+        "botocore",
+        "cachecontrol",
+        "colorlog",
+        "jinja2",
+        "natsort",
+        "requests",
+        "schema",
+        "semver",
+        "sqlite3",
+    ],
+)
+def test_import_does_not_load_heavy_dependencies(module):
+    process = subprocess.run(
+        [sys.executable, "-c", "import sys, claranet_tfwrapper; print({!r} in sys.modules)".format(module)],
+        stdout=subprocess.PIPE,
+        check=True,
+        encoding="utf-8",
+    )
+    assert process.stdout.strip() == "False"
+
+
+def test_lazy_module_attributes():
+    assert tfwrapper.__version__ == tfwrapper.get_version()
+    assert tfwrapper.stack_configuration_schema is tfwrapper.get_stack_configuration_schema()
+
+    with pytest.raises(AttributeError):
+        tfwrapper.some_unknown_attribute
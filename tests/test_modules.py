@@ -0,0 +1,84 @@
+"""Test the index of the local modules used by stacks."""
+
+import os
+import textwrap
+
+from claranet_tfwrapper import modules
+
+
+def write_module_block(path, *sources):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        "".join(
+            textwrap.dedent(
+                """
+                module "m{}" {{
+                  source = "{}"
+                  nested = {{ a = "b" }}
+                }}
+                """
+            ).format(i, source)
+            for i, source in enumerate(sources)
+        )
+    )
+
+
+def test_get_module_sources(tmp_path):
+    write_module_block(tmp_path / "stack/main.tf", "../modules/a", "./local", "claranet/x/azurerm", "git::https://x")
+    write_module_block(tmp_path / "stack/other.tf", "../modules/a/")
+    (tmp_path / "stack/README.md").write_text('module "m" { source = "../modules/b" }')
+
+    assert modules.get_module_sources(str(tmp_path / "stack")) == [str(tmp_path / "modules/a"), str(tmp_path / "stack/local")]
+
+
+def test_get_stacks_modules(tmp_path, monkeypatch):
+    index_file = str(tmp_path / ".run" / "module_index.pickle")
+    write_module_block(tmp_path / "stack1/main.tf", "../modules/a")
+    write_module_block(tmp_path / "stack2/main.tf", "../modules/b")
+    write_module_block(tmp_path / "stack3/main.tf")
+    write_module_block(tmp_path / "modules/a/main.tf", "../c")
+    write_module_block(tmp_path / "modules/b/main.tf", "../c")
+    # cycles between modules are not followed forever
+    write_module_block(tmp_path / "modules/c/main.tf", "../b", "../../stack1")
+    stacks = [str(tmp_path / "stack1"), str(tmp_path / "stack2"), str(tmp_path / "stack3")]
+
+    stacks_modules = modules.get_stacks_modules(index_file, stacks)
+
+    assert stacks_modules == {
+        stacks[0]: {str(tmp_path / "modules/a"), str(tmp_path / "modules/b"), str(tmp_path / "modules/c")},
+        stacks[1]: {
+            str(tmp_path / "modules/a"),
+            str(tmp_path / "modules/b"),
+            str(tmp_path / "modules/c"),
+            str(tmp_path / "stack1"),
+        },
+        stacks[2]: set(),
+    }
+    assert modules.get_module_stacks(stacks_modules) == {
+        str(tmp_path / "modules/a"): {stacks[0], stacks[1]},
+        str(tmp_path / "modules/b"): {stacks[0], stacks[1]},
+        str(tmp_path / "modules/c"): {stacks[0], stacks[1]},
+        str(tmp_path / "stack1"): {stacks[1]},
+    }
+
+    # only the directories which changed are parsed again
+    parsed = []
+    get_module_sources = modules.get_module_sources
+    monkeypatch.setattr(modules, "get_module_sources", lambda d: parsed.append(d) or get_module_sources(d))
+    assert modules.get_stacks_modules(index_file, stacks) == stacks_modules
+    assert parsed == []
+
+    write_module_block(tmp_path / "modules/b/main.tf")
+    os.utime(tmp_path / "modules/b/main.tf", ns=(1, 1))
+    assert modules.get_stacks_modules(index_file, stacks)[stacks[1]] == {str(tmp_path / "modules/b")}
+    assert parsed == [str(tmp_path / "modules/b")]
+
+
+def test_get_stacks_modules_invalid_index(tmp_path):
+    index_file = tmp_path / "module_index.pickle"
+    index_file.write_text("invalid")
+    write_module_block(tmp_path / "stack/main.tf", "../modules/a")
+
+    assert modules.get_stacks_modules(str(index_file), [str(tmp_path / "stack")]) == {
+        str(tmp_path / "stack"): {str(tmp_path / "modules/a")}
+    }
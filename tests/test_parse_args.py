@@ -69,7 +69,7 @@ def test_parse_args_foreach_help(capsys):
         tfwrapper.parse_args(["foreach", "-h"])
     assert e.value.code == 0
     captured = capsys.readouterr()
-    assert "usage: tfwrapper foreach [-h] [-S] ..." in captured.out
+    assert "usage: tfwrapper foreach [-h] [-S] [-j JOBS] [-o {stream,prefix,group}] [-k]" in captured.out
 
 
 def test_parse_args_foreach_no_args():
@@ -103,7 +103,7 @@ def test_parse_args_foreach_command(monkeypatch):
     monkeypatch.setenv("SHELL", "mybash")
     args = tfwrapper.parse_args(["foreach", "--", "ls", "-l"])
     assert args.subcommand == "foreach"
-    assert args.func == tfwrapper.foreach
+    assert args.func == tfwrapper.run_foreach
     assert args.shell is False
     assert args.executable is None
     assert args.command == ["ls", "-l"]
@@ -113,7 +113,7 @@ def test_parse_args_foreach_command_shell(monkeypatch):
     monkeypatch.setenv("SHELL", "mybash")
     args = tfwrapper.parse_args(["foreach", "-S", "ls -l | head -1"])
     assert args.subcommand == "foreach"
-    assert args.func == tfwrapper.foreach
+    assert args.func == tfwrapper.run_foreach
     assert args.shell is True
     assert args.executable == "mybash"
     assert args.command == ["ls -l | head -1"]
@@ -123,7 +123,7 @@ def test_parse_args_foreach_command_shell_long(monkeypatch):
     monkeypatch.setenv("SHELL", "mybash")
     args = tfwrapper.parse_args(["foreach", "--shell", "ls -l | head -1"])
     assert args.subcommand == "foreach"
-    assert args.func == tfwrapper.foreach
+    assert args.func == tfwrapper.run_foreach
     assert args.shell is True
     assert args.executable == "mybash"
     assert args.command == ["ls -l | head -1"]
@@ -174,3 +174,43 @@ def test_parse_args_version(capsys):
     assert e.value.code == 0
     captured = capsys.readouterr()
     assert re.match(r"^tfwrapper v\d+\.\d+\.\d+", captured.err)
+
+
+@pytest.mark.parametrize(
+    "args, subcommand",
+    [
+        ([], None),
+        (["-h"], None),
+        (["init"], "init"),
+        (["-d", "plan", "--", "-target", "apply"], "plan"),
+        (["-a", "init", "plan"], "plan"),
+        (["--account=init", "plan"], "plan"),
+        (["-c", "myconf", "-s", "foreach", "foreach", "--", "ls"], "foreach"),
+        (["some_invalid_command", "init"], None),
+    ],
+)
+def test_find_subcommand(args, subcommand):
+    assert tfwrapper.find_subcommand(args) == subcommand
+
+
+def test_parser_is_cached_and_only_contains_the_subcommand():
+    parser = tfwrapper.get_parser("init")
+    assert tfwrapper.get_parser("init") is parser
+
+    args = parser.parse_args(["-a", "plan", "init"])
+    assert args.account == "plan"
+    assert args.subcommand == "init"
+    with pytest.raises(SystemExit):
+        parser.parse_args(["plan"])
+
+
+def test_parse_args_single_pass_defaults(monkeypatch):
+    monkeypatch.setattr(tfwrapper, "DEFAULT_HTTP_CACHE_DIR", "/tmp/http-cache-dir")
+    args = tfwrapper.parse_args(["plan"])
+    assert args.debug is False
+    assert args.confdir == "conf"
+    assert args.account is None
+    assert args.environment is None
+    assert args.region is None
+    assert args.stack is None
+    assert args.http_cache_dir == "/tmp/http-cache-dir"
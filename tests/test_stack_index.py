@@ -0,0 +1,127 @@
+"""Test the index of the stacks of a project."""
+
+import os
+import pathlib
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+from claranet_tfwrapper import foreach
+
+STACKS = [
+    ("account0", "global", None, "default", "aws:\n  general: {account: '1', region: r}\n  credentials: {profile: p}\n"),
+    ("account0", "prod", "eu-west-1", "default", "azure:\n  general: {mode: user, subscription_id: s, directory_id: d}\n"),
+    ("account0", "prod", "eu-west-1", "app_web", ""),
+    ("account1", "test", "eu-west-3", "default", ""),
+]
+
+
+@pytest.fixture
+def tmp_working_dir_indexed_stacks(tmp_working_dir_empty_conf):
+    paths = tmp_working_dir_empty_conf
+    for account, environment, region, stack, provider_config in STACKS:
+        if stack != "default" or account != "account1":
+            pathlib.Path(tfwrapper.get_stack_dir(paths["working_dir"], account, environment, region, stack)).mkdir(parents=True)
+        pathlib.Path(tfwrapper.get_stack_config_path(paths["conf_dir"], account, environment, region, stack)).write_text(
+            provider_config + "terraform:\n  version: '1.{}'\n  vars:\n    myvar: myvalue\n".format(len(stack))
+        )
+    paths["wrapper_conf"].write_text("---\n")
+    (paths["conf_dir"] / "notastack.yml").write_text("---\n")
+    return paths
+
+
+def test_update_stack_index(tmp_working_dir_indexed_stacks, monkeypatch):
+    paths = tmp_working_dir_indexed_stacks
+
+    index = tfwrapper.update_stack_index(str(paths["working_dir"]), "conf")
+
+    assert {name: (e["stack"], e["tool_version"], e["provider"], e["dir_exists"]) for name, e in index.items()} == {
+        "account0_global_default.yml": (("account0", "global", None, "default"), "1.7", "aws", True),
+        "account0_prod_eu-west-1_app_web.yml": (("account0", "prod", "eu-west-1", "app_web"), "1.7", None, True),
+        "account0_prod_eu-west-1_default.yml": (("account0", "prod", "eu-west-1", "default"), "1.7", "azure", True),
+        "account1_test_eu-west-3_default.yml": (("account1", "test", "eu-west-3", "default"), "1.7", None, False),
+    }
+    assert tfwrapper.load_stack_index(str(paths["working_dir"])) == index
+
+    # only changed configuration files are loaded again, directories are checked again
+    loaded = []
+    get_stack_index_entry = tfwrapper.get_stack_index_entry
+    monkeypatch.setattr(tfwrapper, "get_stack_index_entry", lambda *args: loaded.append(args[1]) or get_stack_index_entry(*args))
+    (paths["conf_dir"] / "account0_prod_eu-west-1_default.yml").write_text("terraform:\n  version: '1.5'\n")
+    (paths["conf_dir"] / "account0_global_default.yml").unlink()
+    pathlib.Path(tfwrapper.get_stack_dir(paths["working_dir"], "account1", "test", "eu-west-3", "default")).mkdir(parents=True)
+
+    index = tfwrapper.update_stack_index(str(paths["working_dir"]), "conf")
+
+    assert sorted(loaded) == ["account0_prod_eu-west-1_default.yml", "notastack.yml"]
+    assert {name: (e["tool_version"], e["provider"], e["dir_exists"]) for name, e in index.items()} == {
+        "account0_prod_eu-west-1_app_web.yml": ("1.7", None, True),
+        "account0_prod_eu-west-1_default.yml": ("1.5", None, True),
+        "account1_test_eu-west-3_default.yml": ("1.7", None, True),
+    }
+
+
+def test_update_stack_index_invalid_yaml(tmp_working_dir_indexed_stacks):
+    paths = tmp_working_dir_indexed_stacks
+    (paths["conf_dir"] / "account1_test_eu-west-3_default.yml").write_text("terraform: [")
+
+    index = tfwrapper.update_stack_index(str(paths["working_dir"]), "conf")
+
+    assert index["account1_test_eu-west-3_default.yml"]["tool_version"] is None
+
+
+def test_update_stack_index_not_a_stack(tmp_working_dir_indexed_stacks, capfd):
+    paths = tmp_working_dir_indexed_stacks
+    (paths["conf_dir"] / "my_extra_file.yml").write_text("---\n")
+
+    index = tfwrapper.update_stack_index(str(paths["working_dir"]), "conf")
+
+    assert "my_extra_file.yml" not in index
+    assert not foreach.match_stack(("my", "extra", None, "file"), "*", "*", "*", "*")
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["foreach", "--", "pwd"])
+    captured = capfd.readouterr()
+
+    assert e.value.code == 0
+    assert len(captured.out.splitlines()) == 3
+
+
+@pytest.mark.parametrize(
+    "selection, expected",
+    [
+        ({}, ["account0/_global/default", "account0/prod/eu-west-1/app_web", "account0/prod/eu-west-1/default"]),
+        ({"environment": "global"}, ["account0/_global/default"]),
+        ({"environment": "global", "region": "eu-west-1"}, ["account0/_global/default"]),
+        ({"region": "eu-west-1"}, ["account0/prod/eu-west-1/app_web", "account0/prod/eu-west-1/default"]),
+        ({"stack": "default"}, ["account0/_global/default", "account0/prod/eu-west-1/default"]),
+        ({"stack": "app*"}, ["account0/prod/eu-west-1/app_web"]),
+        ({"account": "account1"}, []),
+    ],
+)
+def test_foreach_select_stacks_from_index(tmp_working_dir_indexed_stacks, default_args, selection, expected, caplog):
+    paths = tmp_working_dir_indexed_stacks
+    wrapper_config = dict(vars(default_args), **selection)
+    tfwrapper.detect_config_dir(wrapper_config)
+
+    stacks = list(foreach.select_stacks(wrapper_config))
+
+    assert [os.path.relpath(stack.path, paths["working_dir"]) for stack in stacks] == expected
+    assert all(stack.load_config()["terraform"]["version"] == "1.7" for stack in stacks)
+    if selection.get("account") == "account1":
+        assert "Stack config conf/account1_test_eu-west-3_default.yml has no matching directory" in caplog.text
+
+
+def test_index_subcommand(tmp_working_dir_indexed_stacks, capsys):
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["index", "--rebuild"])
+    captured = capsys.readouterr()
+
+    assert e.value.code == 0
+    assert [line.split() for line in captured.out.splitlines()] == [
+        ["Stack", "Config", "Directory", "Version", "Provider"],
+        ["account0/global/default", "account0_global_default.yml", "yes", "1.7", "aws"],
+        ["account0/prod/eu-west-1/app_web", "account0_prod_eu-west-1_app_web.yml", "yes", "1.7", "-"],
+        ["account0/prod/eu-west-1/default", "account0_prod_eu-west-1_default.yml", "yes", "1.7", "azure"],
+        ["account1/test/eu-west-3/default", "account1_test_eu-west-3_default.yml", "no", "1.7", "-"],
+    ]
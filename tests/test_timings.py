@@ -0,0 +1,107 @@
+"""Test the --timings and --timings-file arguments."""
+
+import json
+import os
+import re
+import threading
+
+import pytest
+
+import claranet_tfwrapper as tfwrapper
+from claranet_tfwrapper import timings
+
+
+def test_phase_not_recorded_when_disabled():
+    with timings.phase("something") as record:
+        assert record is None
+    assert not timings.is_enabled()
+    assert timings.get_phases() == []
+
+
+def test_phases_nesting():
+    timings.enable()
+    try:
+        with timings.phase("parent", "detail") as parent:
+            with timings.phase("child") as child:
+                child["cache"] = "hit"
+        phases = timings.get_phases()
+        report = timings.format_report()
+    finally:
+        timings.disable()
+
+    assert [p["name"] for p in phases] == ["parent", "child"]
+    assert parent["depth"] == 0 and child["depth"] == 1
+    assert parent["duration"] >= child["duration"] >= 0
+    assert report.splitlines()[0].split() == ["Phase", "Detail", "Duration"]
+    assert re.search(r"^parent +detail +\d+\.\d ms$", report, re.MULTILINE)
+    assert re.search(r"^  child +cache hit +\d+\.\d ms$", report, re.MULTILINE)
+    assert report.splitlines()[-1].startswith("total")
+
+
+def test_add_phases():
+    timings.enable()
+    try:
+        with timings.phase("daemon") as parent:
+            pass
+        timings.add_phases([{"name": "remote", "detail": None, "start": 0.5, "duration": 0.1, "depth": 0}], parent)
+        phases = timings.get_phases()
+    finally:
+        timings.disable()
+
+    assert phases[1]["name"] == "remote"
+    assert phases[1]["start"] == parent["start"] + 0.5
+    assert phases[1]["depth"] == 1
+
+
+def test_write_trace_threads(tmp_path):
+    trace_file = tmp_path / "trace.json"
+    started = threading.Barrier(2)
+
+    def run(name):
+        with timings.phase(name):
+            # both phases overlap
+            started.wait(timeout=5)
+            with timings.phase("child", name):
+                pass
+
+    timings.enable()
+    try:
+        with timings.phase("main"):
+            threads = [threading.Thread(target=run, args=(name,)) for name in ("first", "second")]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        timings.write_trace(trace_file)
+    finally:
+        timings.disable()
+
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    tids = {(event["name"], event["args"].get("detail")): event["tid"] for event in events}
+    assert tids[("main", None)] == 0
+    assert tids[("first", None)] == tids[("child", "first")] != tids[("second", None)] == tids[("child", "second")]
+    assert sorted(set(tids.values())) == [0, 1, 2]
+    assert all(event["name"] != "child" or "thread" not in event["args"] for event in events)
+
+
+def test_main_timings(tmp_working_dir_regional_valid_legacy, fake_terraform, capsys, tmp_path):
+    paths = tmp_working_dir_regional_valid_legacy
+    os.chdir(paths["stack_dir"])
+    trace_file = tmp_path / "trace.json"
+
+    with pytest.raises(SystemExit) as e:
+        tfwrapper.main(["--timings", "--timings-file", str(trace_file), "validate"])
+    assert e.value.code == 0
+    assert not timings.is_enabled()
+
+    report = capsys.readouterr().err
+    for name in ("config detection", "context cache", "yaml load", "version resolution"):
+        assert name in report
+    assert re.search(r"^terraform +validate +\d+\.\d ms$", report, re.MULTILINE)
+
+    trace = json.loads(trace_file.read_text())
+    events = {event["name"]: event for event in trace["traceEvents"]}
+    assert events["terraform"]["ph"] == "X"
+    assert events["terraform"]["args"] == {"detail": "validate"}
+    assert events["context cache"]["args"] == {"cache": "miss"}
+    assert events["version resolution"]["dur"] >= 0
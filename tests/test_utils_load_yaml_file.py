@@ -0,0 +1,77 @@
+"""Test utils: load_yaml_file."""
+
+import pytest
+import yaml
+
+from claranet_tfwrapper import utils
+
+
+@pytest.fixture
+def yaml_cache_dir(tmp_path):
+    utils.clear_yaml_cache()
+    utils.set_yaml_cache_dir(str(tmp_path / "yaml_cache"))
+    yield tmp_path / "yaml_cache"
+    utils.set_yaml_cache_dir(None)
+    utils.clear_yaml_cache()
+
+
+def test_load_yaml_file_uses_libyaml():
+    if yaml.__with_libyaml__:
+        assert utils.YamlLoader is yaml.CSafeLoader
+    else:
+        assert utils.YamlLoader is yaml.SafeLoader
+
+
+def test_load_yaml_file_returns_copies(tmp_path, yaml_cache_dir):
+    path = tmp_path / "config.yml"
+    path.write_text("---\nfoo:\n  bar: 1\n")
+
+    document = utils.load_yaml_file(path)
+    document["foo"]["bar"] = 2
+    assert utils.load_yaml_file(path) == {"foo": {"bar": 1}}
+
+
+def test_load_yaml_file_persistent_cache(tmp_path, yaml_cache_dir, monkeypatch):
+    path = tmp_path / "config.yml"
+    path.write_text("---\nfoo: bar\n")
+    assert utils.load_yaml_file(path) == {"foo": "bar"}
+    assert len(list(yaml_cache_dir.iterdir())) == 1
+
+    # same file parsed by another process
+    utils.clear_yaml_cache()
+    monkeypatch.setattr(utils.yaml, "load", lambda *args, **kwargs: pytest.fail("document should be loaded from cache"))
+    assert utils.load_yaml_file(path) == {"foo": "bar"}
+
+
+def test_load_yaml_file_invalidation(tmp_path, yaml_cache_dir):
+    path = tmp_path / "config.yml"
+    path.write_text("---\nfoo: bar\n")
+    assert utils.load_yaml_file(path) == {"foo": "bar"}
+
+    path.write_text("---\nfoo: bazz\n")
+    assert utils.load_yaml_file(path) == {"foo": "bazz"}
+    # the document of the previous content is replaced
+    assert len(list(yaml_cache_dir.iterdir())) == 1
+
+    other_path = tmp_path / "other.yml"
+    other_path.write_text("---\nfoo: bar\n")
+    assert utils.load_yaml_file(other_path) == {"foo": "bar"}
+    assert len(list(yaml_cache_dir.iterdir())) == 2
+
+
+def test_load_yaml_file_corrupted_cache(tmp_path, yaml_cache_dir):
+    path = tmp_path / "config.yml"
+    path.write_text("---\nfoo: bar\n")
+    utils.load_yaml_file(path)
+    for cache_file in yaml_cache_dir.iterdir():
+        cache_file.write_bytes(b"garbage")
+
+    utils.clear_yaml_cache()
+    assert utils.load_yaml_file(path) == {"foo": "bar"}
+
+
+def test_load_yaml_file_not_persistent(tmp_path, yaml_cache_dir):
+    path = tmp_path / "credentials.yml"
+    path.write_text("---\nsecret: value\n")
+    assert utils.load_yaml_file(path, persistent=False) == {"secret": "value"}
+    assert not yaml_cache_dir.exists()